@@ -28,6 +28,10 @@ keyword_paths["hc"]="data/keywords/hatecheck-keywords.csv"
 # keyword_paths["mt-jaen"]="data/keywords/mt-keywords.csv"
 # keyword_paths["accept"]="data/keywords/acc-keywords.csv"
 
+# to reuse answers across parallel jobs, export the same QUERY_CACHE_TOKEN everywhere, start
+# `python -m semslicer.model.cache_server --host 0.0.0.0` on one node and
+# export QUERY_CACHE_URL=http://<that node>:8765
+
 dataset=$1
 post_fix=''
 for method in 'zs' 'fs', 'fs-div', 'fs-div-teach', 'fs-syn' 'zs-gen' 'zs-ref'; do
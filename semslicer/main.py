@@ -3,7 +3,12 @@ from .utils.config import config
 from .utils.log import get_logger
 from .utils.file import read_txt_file, read_csv_file
 from .slicer import Slicer
+from .planner import plan_slicing
 from .promptgen.generator import PromptGenerator
+from .promptgen.selector import PromptSelector
+from .model.registry import configure_endpoints
+from .model.cache_store import configure_query_cache
+from .model.metering import METER, USAGE_SUMMARY_FILE
 import os
 
 logger = get_logger("INFO", "main")
@@ -20,6 +25,8 @@ def main():
 
     logger.info("Start running task: {exp}".format(exp=args.exp_name))
     logger.info("Config:\n{config}".format(config=config))
+    configure_endpoints(config["MODEL"].get("ENDPOINTS", {}))
+    configure_query_cache(config["MODEL"].get("USE_CACHE"))
 
     keyword_df = read_csv_file(config["EXPERIMENT"]["KEYWORDS_PATH"])
     keywords = keyword_df["keyword"].tolist()
@@ -37,13 +44,27 @@ def main():
     elif args.task == "slicing":
         slicer = Slicer(student_model=config["MODEL"]["STUDENT"], 
             teacher_model=config["MODEL"]["TEACHER"],
-            batch_size=config["SLICING"]["BATCH_SIZE"])
+            batch_size=config["SLICING"]["BATCH_SIZE"],
+            execution=config["SLICING"].get("EXECUTION", "online"),
+            batch_backend=config["SLICING"].get("BATCH_BACKEND", "openai"),
+            pack_size=config["SLICING"].get("PACK_SIZE", 1),
+            multi_keyword_size=config["SLICING"].get("MULTI_KEYWORD_SIZE", 1))
         if config["SLICING"]["SAMPLING"]:
             data = data.sample(n=config["SLICING"]["SAMPLE_SIZE"], random_state=42)
         slicer.annotate_batch(data, keywords, 
             use_calibrate=config["SLICING"]["CALIBRATE"], 
             add_few_shot=config["EXAMPLES"]["USE_FEW_SHOT"],)
             # use_cache=True)
+    elif args.task == "plan":
+        plan_slicing(data, keywords)
+    elif args.task == "prompt_analysis":
+        selector = PromptSelector(noise_estimate_flag=config["PROMPT_ANALYSIS"]["NOISE_ESTIMATE"])
+        selector.analyze(keywords)
+
+    # per stage / keyword / model usage of this task, next to slice_result.csv
+    summary_path = os.path.join(os.path.dirname(config["EXPERIMENT"]["SLICE_RESULT_PATH"]),
+        "{task}_{file}".format(task=args.task, file=USAGE_SUMMARY_FILE))
+    METER.write_summary(summary_path)
 
 
 if __name__ == "__main__":
@@ -0,0 +1,226 @@
+import hashlib
+import json
+import os
+import shutil
+import time
+from ..utils.log import get_logger
+from .cache_store import get_response_cache
+
+logger = get_logger("INFO", "batch")
+
+# the Batch API accepts at most 50,000 requests per input file
+MAX_BATCH_REQUESTS = 50000
+BATCH_POLL_INTERVAL = float(os.environ.get("OPENAI_BATCH_POLL_INTERVAL", 60))
+BATCH_ENDPOINT = "/v1/chat/completions"
+MANIFEST_FILE = "manifest.json"
+
+
+def _extract_content(line):
+    """Return the answer of one output line, or None if the request failed."""
+    response = line.get("response") or {}
+    if line.get("error") is not None or response.get("status_code") != 200:
+        return None
+    choices = response["body"]["choices"]
+    contents = [choice["message"]["content"] for choice in choices]
+    return contents[0] if len(contents) == 1 else contents
+
+
+class OpenAIBatchBackend:
+    """Submits JSONL files to the OpenAI Batch API."""
+
+    def __init__(self, client=None):
+        if client is None:
+            from .client_pool import get_client
+            client = get_client()
+        self.client = client
+
+    def submit(self, input_path):
+        with open(input_path, "rb") as f:
+            input_file = self.client.files.create(file=f, purpose="batch")
+        batch = self.client.batches.create(
+            input_file_id=input_file.id, endpoint=BATCH_ENDPOINT, completion_window="24h"
+        )
+        return batch.id
+
+    def poll(self, batch_id, output_path):
+        """Return the batch status; once completed, the output is written to `output_path`."""
+        batch = self.client.batches.retrieve(batch_id)
+        if batch.status == "completed" and batch.output_file_id is not None:
+            content = self.client.files.content(batch.output_file_id)
+            with open(output_path, "wb") as f:
+                f.write(content.read())
+        return batch.status
+
+
+def local_answer(body):
+    # deterministic yes/no from the request content
+    digest = hashlib.sha256(json.dumps(body["messages"], sort_keys=True).encode("utf-8")).digest()
+    return "yes" if digest[0] % 2 == 0 else "no"
+
+
+class LocalBatchBackend:
+    """File-based stand-in for the Batch API, for runs without network access.
+
+    A submitted batch completes on its first poll; `answer_fn(body)` produces the
+    content of every response.
+    """
+
+    def __init__(self, work_dir, answer_fn=local_answer):
+        self.work_dir = work_dir
+        self.answer_fn = answer_fn
+        os.makedirs(work_dir, exist_ok=True)
+
+    def submit(self, input_path):
+        with open(input_path, "rb") as f:
+            batch_id = "batch_local_" + hashlib.sha256(f.read()).hexdigest()[:16]
+        shutil.copyfile(input_path, os.path.join(self.work_dir, batch_id + ".input.jsonl"))
+        return batch_id
+
+    def poll(self, batch_id, output_path):
+        input_path = os.path.join(self.work_dir, batch_id + ".input.jsonl")
+        if not os.path.exists(input_path):
+            return "failed"
+        with open(input_path) as f_in, open(output_path, "w") as f_out:
+            for line in f_in:
+                request = json.loads(line)
+                body = {"choices": [{"index": 0, "message": {"role": "assistant", "content": self.answer_fn(request["body"])}}]}
+                f_out.write(json.dumps({
+                    "custom_id": request["custom_id"],
+                    "response": {"status_code": 200, "body": body},
+                    "error": None,
+                }) + "\n")
+        return "completed"
+
+
+class BatchRunner:
+    """Runs (cache key, request body) pairs through a batch backend and merges answers into the response cache.
+
+    Progress is kept in `work_dir/manifest.json`, so a restarted run polls the batches
+    it already submitted instead of submitting them again.
+    """
+
+    def __init__(self, backend, work_dir, cache=None, poll_interval=BATCH_POLL_INTERVAL):
+        self.backend = backend
+        self.work_dir = work_dir
+        self.cache = cache if cache is not None else get_response_cache()
+        self.poll_interval = poll_interval
+        os.makedirs(work_dir, exist_ok=True)
+        self.manifest_path = os.path.join(work_dir, MANIFEST_FILE)
+        self.manifest = self._load_manifest()
+
+    def _load_manifest(self):
+        if os.path.exists(self.manifest_path):
+            with open(self.manifest_path) as f:
+                return json.load(f)
+        return {"batches": []}
+
+    def _save_manifest(self):
+        tmp_path = self.manifest_path + ".tmp"
+        with open(tmp_path, "w") as f:
+            json.dump(self.manifest, f, indent=2)
+        os.replace(tmp_path, self.manifest_path)
+
+    def submit(self, requests):
+        """Submit requests that are neither cached nor part of an unfinished batch."""
+        requests = list(dict(requests).items())
+        cached = self.cache.get_many([key for key, _ in requests])
+        submitted = set()
+        for batch in self.manifest["batches"]:
+            if batch["status"] not in ("merged", "failed", "expired", "cancelled"):
+                submitted.update(batch["custom_ids"])
+        pending = [(key, body) for (key, body), value in zip(requests, cached) if value is None and key not in submitted]
+        logger.info("{total} requests: {cached} cached, {submitted} already submitted, {pending} to submit".format(
+            total=len(requests), cached=sum(value is not None for value in cached),
+            submitted=len(submitted), pending=len(pending)))
+
+        for start in range(0, len(pending), MAX_BATCH_REQUESTS):
+            chunk = pending[start : start + MAX_BATCH_REQUESTS]
+            input_path = os.path.join(self.work_dir, "input_{}.jsonl".format(len(self.manifest["batches"])))
+            with open(input_path, "w") as f:
+                for key, body in chunk:
+                    f.write(json.dumps({"custom_id": key, "method": "POST", "url": BATCH_ENDPOINT, "body": body}) + "\n")
+            batch_id = self.backend.submit(input_path)
+            self.manifest["batches"].append({
+                "batch_id": batch_id,
+                "input_path": input_path,
+                "custom_ids": [key for key, _ in chunk],
+                "status": "submitted",
+            })
+            self._save_manifest()
+            logger.info("submitted batch {batch_id} with {n} requests".format(batch_id=batch_id, n=len(chunk)))
+
+    def wait(self):
+        """Poll every unfinished batch until it is done; merge completed outputs into the cache."""
+        while True:
+            unfinished = [batch for batch in self.manifest["batches"]
+                          if batch["status"] not in ("merged", "failed", "expired", "cancelled")]
+            if len(unfinished) == 0:
+                return
+            for batch in unfinished:
+                output_path = os.path.join(self.work_dir, batch["batch_id"] + ".output.jsonl")
+                status = self.backend.poll(batch["batch_id"], output_path)
+                if status == "completed":
+                    self._merge(batch, output_path)
+                elif status in ("failed", "expired", "cancelled"):
+                    batch["status"] = status
+                    logger.warning("batch {batch_id} {status}".format(batch_id=batch["batch_id"], status=status))
+                self._save_manifest()
+            if any(batch["status"] not in ("merged", "failed", "expired", "cancelled") for batch in unfinished):
+                time.sleep(self.poll_interval)
+
+    def _merge(self, batch, output_path):
+        items = []
+        with open(output_path) as f:
+            for line in f:
+                line = json.loads(line)
+                items.append((line["custom_id"], _extract_content(line)))
+        merged = self.cache.put_many(items)
+        batch["status"] = "merged"
+        logger.info("merged {merged} of {total} responses from batch {batch_id}".format(
+            merged=merged, total=len(batch["custom_ids"]), batch_id=batch["batch_id"]))
+
+    def run(self, requests):
+        self.submit(requests)
+        self.wait()
+
+
+if __name__ == "__main__":
+    # resume smoke test: local backend for the batches, a mock server for any request that misses the cache
+    import tempfile
+    import pandas as pd
+    from . import cache_store
+    from .metering import collect_usage
+    from .mock_server import start_server
+    from .registry import configure_endpoints
+    from ..slicer import Slicer, to_dialog
+
+    work_dir = tempfile.mkdtemp(prefix="batch_smoke_")
+    cache_store.CACHE_DB = os.path.join(work_dir, "query_cache.sqlite")
+    server = start_server()
+    configure_endpoints({"mock-student": server.base_url})
+    try:
+        slicer = Slicer(student_model="mock-student", creator_model="mock-student", teacher_model="mock-student",
+                        execution="batch", batch_backend="local")
+        data = pd.DataFrame({"context": ["A young man and his parents met.", "The meeting started late.",
+                                         "My grandmother turned ninety.", "The hotel room was clean."]})
+        prompt = "Does the text mention anything about age?"
+        requests = slicer.generator.batch_requests(to_dialog(data, prompt))
+        backend_dir = os.path.join(work_dir, "local_backend")
+
+        # interrupted run: submitted, never polled
+        BatchRunner(LocalBatchBackend(backend_dir), work_dir, poll_interval=0).submit(requests)
+        # restarted run: picks the batch up from the manifest instead of submitting it again
+        runner = BatchRunner(LocalBatchBackend(backend_dir), work_dir, poll_interval=0)
+        runner.run(requests)
+        assert [batch["status"] for batch in runner.manifest["batches"]] == ["merged"]
+        assert len([name for name in os.listdir(backend_dir) if name.endswith(".input.jsonl")]) == 1
+
+        # the online path must read every row from the cache
+        with collect_usage() as reported:
+            meta_result, _, _ = slicer.annotate(data, prompt)
+        assert reported["cache_hits"] == len(data), reported
+        assert server.stats()["requests"] == 0, server.stats()
+        assert meta_result == [local_answer(body) for _, body in requests]
+        logger.info("batch resume smoke test passed: {n} rows from the cache".format(n=len(data)))
+    finally:
+        server.stop()
@@ -0,0 +1,119 @@
+import argparse
+import csv
+import os
+import threading
+from ..utils.log import get_logger
+from .metering import count_text_tokens
+
+logger = get_logger("INFO", "batching")
+
+# padded tokens (rows x longest row) allowed per local-model batch; 0 = fixed-size batches in input order
+MAX_BATCH_TOKENS = int(os.environ.get("MAX_BATCH_TOKENS", 16384))
+DEFAULT_DATA = ["data/data/hotel.csv", "data/data/hatecheck.csv"]
+
+
+def plan_batches(lengths, batch_size, max_tokens=MAX_BATCH_TOKENS):
+    """Split indices of `lengths` into batches of at most `batch_size` rows.
+
+    With a token budget, rows are sorted by length and a batch is closed once
+    one more row would make rows x longest row exceed `max_tokens`, so rows of
+    similar length are padded together. A single row over the budget gets its
+    own batch.
+    """
+    if max_tokens <= 0:
+        return [list(range(start, min(start + batch_size, len(lengths)))) for start in range(0, len(lengths), batch_size)]
+    batches = []
+    batch = []
+    for index in sorted(range(len(lengths)), key=lambda i: lengths[i]):
+        # sorted ascending, so the new row is the longest of the batch
+        if len(batch) > 0 and (len(batch) == batch_size or (len(batch) + 1) * lengths[index] > max_tokens):
+            batches.append(batch)
+            batch = []
+        batch.append(index)
+    if len(batch) > 0:
+        batches.append(batch)
+    return batches
+
+
+def run_batched(run, items, lengths, batch_size, max_tokens=MAX_BATCH_TOKENS, meter=None):
+    """Call `run(batch_items)` for each planned batch and return its per-item results in input order."""
+    results = [None] * len(items)
+    for batch in plan_batches(lengths, batch_size, max_tokens):
+        if meter is not None:
+            meter.record([lengths[i] for i in batch])
+        for i, result in zip(batch, run([items[i] for i in batch])):
+            results[i] = result
+    return results
+
+
+class PaddingMeter:
+    """Real vs padded tokens of the batches a local model has run."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.reset()
+
+    def record(self, lengths):
+        with self._lock:
+            self.batches += 1
+            self.rows += len(lengths)
+            self.real_tokens += sum(lengths)
+            self.padded_tokens += len(lengths) * max(lengths, default=0)
+
+    def state(self):
+        with self._lock:
+            return {
+                "batches": self.batches,
+                "rows": self.rows,
+                "real_tokens": self.real_tokens,
+                "padded_tokens": self.padded_tokens,
+                "padding_waste": 1 - self.real_tokens / self.padded_tokens if self.padded_tokens > 0 else 0.0,
+            }
+
+    def reset(self):
+        with self._lock:
+            self.batches = 0
+            self.rows = 0
+            self.real_tokens = 0
+            self.padded_tokens = 0
+
+
+def padding_state(lengths, batch_size, max_tokens):
+    meter = PaddingMeter()
+    for batch in plan_batches(lengths, batch_size, max_tokens):
+        meter.record([lengths[i] for i in batch])
+    return meter.state()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Compare padding waste of fixed-size and token-budget batches.")
+    parser.add_argument("paths", type=str, nargs="*", default=DEFAULT_DATA, help="csv files with a context column")
+    parser.add_argument("--tokenizer", type=str, default=None,
+                        help="Hugging Face tokenizer to count tokens with (default: a tiktoken / 4-characters-per-token estimate)")
+    parser.add_argument("--batch_size", type=int, default=40)
+    parser.add_argument("--max_tokens", type=int, default=MAX_BATCH_TOKENS)
+    parser.add_argument("--prefix_tokens", type=int, default=0,
+                        help="tokens of the shared prompt added to every row (0 when the prefix is cached)")
+    args = parser.parse_args()
+
+    if args.tokenizer is not None:
+        from transformers import AutoTokenizer
+
+        tokenizer = AutoTokenizer.from_pretrained(args.tokenizer)
+        count = lambda text: len(tokenizer(text)["input_ids"])
+    else:
+        count = lambda text: count_text_tokens("gpt-3.5-turbo", text)
+
+    for path in args.paths:
+        with open(path, newline="", encoding="utf-8") as f:
+            lengths = [args.prefix_tokens + count(row["context"]) for row in csv.DictReader(f)]
+        for name, max_tokens in [("fixed", 0), ("token_budget", args.max_tokens)]:
+            state = padding_state(lengths, args.batch_size, max_tokens)
+            print("{path} {name}: {rows} rows in {batches} batches, {real} real / {padded} padded tokens "
+                  "({waste:.1%} padding)".format(path=path, name=name, rows=state["rows"], batches=state["batches"],
+                                                 real=state["real_tokens"], padded=state["padded_tokens"],
+                                                 waste=state["padding_waste"]))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,120 @@
+import argparse
+import hmac
+import json
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from ..utils.log import get_logger
+from .cache_store import CACHE_DB, CACHE_TOKEN, ResponseCache
+
+logger = get_logger("INFO", "cache_server")
+
+# loopback only by default; serving other nodes is an explicit --host choice
+CACHE_SERVER_HOST = "127.0.0.1"
+CACHE_SERVER_PORT = 8765
+
+
+class CacheServer(ThreadingHTTPServer):
+    """Shares one ResponseCache with jobs on other nodes over HTTP.
+
+    Protocol (JSON bodies, keys are digests from `digest_key`):
+        POST /get  {"keys": [...]}            -> {"values": [value or null, ...]}
+        POST /put  {"items": [[key, value]]}  -> {"stored": n}
+        GET  /stats                           -> {"entries": n, "gets": n, "hits": n, "puts": n}
+
+    With a `token`, /get and /put require an `Authorization: Bearer <token>` header.
+    """
+
+    daemon_threads = True
+
+    def __init__(self, cache, host=CACHE_SERVER_HOST, port=CACHE_SERVER_PORT, token=None):
+        super().__init__((host, port), _CacheHandler)
+        self.cache = cache
+        self.token = token
+        self.counts = {"gets": 0, "hits": 0, "puts": 0}
+        self.counts_lock = threading.Lock()
+
+    def count(self, **increments):
+        with self.counts_lock:
+            for name, n in increments.items():
+                self.counts[name] += n
+
+
+class _CacheHandler(BaseHTTPRequestHandler):
+
+    protocol_version = "HTTP/1.1"
+
+    def log_message(self, format, *args):
+        pass
+
+    def _send_json(self, status, body):
+        data = json.dumps(body, ensure_ascii=False).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def do_GET(self):
+        if self.path == "/stats":
+            self._send_json(200, dict(self.server.counts, entries=len(self.server.cache)))
+        else:
+            self._send_json(404, {"error": "not found"})
+
+    def _authorized(self):
+        if not self.server.token:
+            return True
+        expected = "Bearer " + self.server.token
+        return hmac.compare_digest(self.headers.get("Authorization", "").encode("utf-8"), expected.encode("utf-8"))
+
+    def do_POST(self):
+        length = int(self.headers.get("Content-Length", 0))
+        try:
+            body = json.loads(self.rfile.read(length) or b"{}")
+        except ValueError:
+            self._send_json(400, {"error": "invalid JSON"})
+            return
+        if not self._authorized():
+            self._send_json(401, {"error": "unauthorized"})
+            return
+        server = self.server
+        if self.path == "/get":
+            values = server.cache.get_many(body.get("keys", []))
+            server.count(gets=len(values), hits=sum(value is not None for value in values))
+            self._send_json(200, {"values": values})
+        elif self.path == "/put":
+            stored = server.cache.put_many([(key, value) for key, value in body.get("items", [])])
+            server.count(puts=stored)
+            self._send_json(200, {"stored": stored})
+        else:
+            self._send_json(404, {"error": "not found"})
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Serve a query response cache to jobs on other nodes.")
+    parser.add_argument("--db", type=str, default=CACHE_DB, help="cache database path")
+    parser.add_argument("--host", type=str, default=CACHE_SERVER_HOST,
+                        help="interface to listen on; use 0.0.0.0 to serve jobs on other nodes")
+    parser.add_argument("--port", type=int, default=CACHE_SERVER_PORT)
+    parser.add_argument("--token", type=str, default=CACHE_TOKEN,
+                        help="shared secret required on /get and /put (default: QUERY_CACHE_TOKEN)")
+    args = parser.parse_args()
+
+    if not args.token and args.host not in ["127.0.0.1", "localhost", "::1"]:
+        logger.warning("serving on {host} without a token: anyone who can reach this node can write "
+                       "answers into the cache; set QUERY_CACHE_TOKEN or --token".format(host=args.host))
+    cache = ResponseCache(args.db)
+    server = CacheServer(cache, host=args.host, port=args.port, token=args.token)
+    logger.info("serving {db} ({n} entries) on http://{host}:{port}".format(
+        db=args.db, n=len(cache), host=args.host, port=args.port))
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        cache.close()
+        logger.info("stats: {stats}".format(stats=server.counts))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,480 @@
+import argparse
+import glob
+import gzip
+import hashlib
+import json
+import os
+import pickle
+import re
+import sqlite3
+import threading
+import time
+import urllib.error
+import urllib.request
+from collections import OrderedDict
+from ..utils.log import get_logger
+
+logger = get_logger("INFO", "cache")
+
+CACHE_DB = os.environ.get("QUERY_CACHE_PATH", "query_cache.sqlite")
+# entries older than this many seconds are treated as misses (unset = never expire)
+CACHE_TTL = float(os.environ["QUERY_CACHE_TTL"]) if os.environ.get("QUERY_CACHE_TTL") else None
+# size of the in-process hot tier
+HOT_CACHE_BYTES = int(os.environ.get("QUERY_CACHE_HOT_BYTES", 64 * 1024 * 1024))
+# sqlite limits the number of host parameters in a single statement
+LOOKUP_CHUNK = 500
+# optional shared cache server (see cache_server.py), consulted after the local store
+CACHE_URL = os.environ.get("QUERY_CACHE_URL")
+REMOTE_TIMEOUT = float(os.environ.get("QUERY_CACHE_REMOTE_TIMEOUT", 5))
+# shared secret the cache server requires on /get and /put (unset = no authentication)
+CACHE_TOKEN = os.environ.get("QUERY_CACHE_TOKEN")
+# whether Generators read and write the cache: QUERY_CACHE=1/0, otherwise on when a cache path or server is set
+USE_QUERY_CACHE = (os.environ["QUERY_CACHE"] == "1") if os.environ.get("QUERY_CACHE") \
+    else bool(CACHE_URL or os.environ.get("QUERY_CACHE_PATH"))
+# after a remote error, the remote tier is skipped for this many seconds
+REMOTE_RETRY_AFTER = 60.0
+BUNDLE_SUFFIX = ".jsonl.gz"
+DIGEST_PATTERN = re.compile(r"[0-9a-f]{64}")
+
+
+def serialize_key(key):
+    """Canonical serialization of a query key (tuple of prompt, model, params, ...)."""
+    return json.dumps(key, ensure_ascii=False, separators=(",", ":"), sort_keys=True)
+
+
+def digest_key(key):
+    """Fixed-size key: sha256 hex digest of the canonical serialization.
+
+    Digests (64 lowercase hex characters) are passed through unchanged, so
+    callers can hash once and reuse; any other key is hashed.
+    """
+    if isinstance(key, str) and DIGEST_PATTERN.fullmatch(key):
+        return key
+    return hashlib.sha256(serialize_key(key).encode("utf-8")).hexdigest()
+
+
+def _value_size(value):
+    if isinstance(value, str):
+        return len(value.encode("utf-8"))
+    if isinstance(value, (list, tuple)):
+        return sum(_value_size(v) for v in value)
+    return len(json.dumps(value, ensure_ascii=False).encode("utf-8"))
+
+
+class LRUCache:
+    """In-memory LRU keyed by digests, bounded by the total size of stored values."""
+
+    def __init__(self, max_bytes=HOT_CACHE_BYTES):
+        self.max_bytes = max_bytes
+        self.current_bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return entry[0]
+
+    def put(self, key, value):
+        if value is None:
+            return
+        # digest + value, ignoring per-object overhead
+        size = len(key) + _value_size(value)
+        if size > self.max_bytes:
+            return
+        with self._lock:
+            if key in self._entries:
+                self.current_bytes -= self._entries.pop(key)[1]
+            self._entries[key] = (value, size)
+            self.current_bytes += size
+            while self.current_bytes > self.max_bytes:
+                _, (_, evicted_size) = self._entries.popitem(last=False)
+                self.current_bytes -= evicted_size
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self.current_bytes = 0
+
+    def __len__(self):
+        return len(self._entries)
+
+    def stats(self):
+        return {"entries": len(self._entries), "bytes": self.current_bytes, "max_bytes": self.max_bytes,
+                "hits": self.hits, "misses": self.misses}
+
+
+class ResponseCache:
+    """Persistent response cache backed by a single SQLite file in WAL mode.
+
+    Lookups and inserts are done per key, so a run never has to load or rewrite
+    the whole cache. Several processes can read and write the same file; writers
+    are serialized by SQLite and wait up to `timeout` seconds for the lock.
+    Entries older than `ttl` seconds are ignored on lookup and dropped by `compact`.
+    """
+
+    def __init__(self, path=CACHE_DB, timeout=60, ttl=CACHE_TTL):
+        self.path = path
+        self.timeout = timeout
+        self.ttl = ttl
+        self._lock = threading.Lock()
+        self._conn = None
+        self._pid = None
+
+    def _connect(self):
+        # connections must not be shared across fork()
+        if self._conn is None or self._pid != os.getpid():
+            conn = sqlite3.connect(self.path, timeout=self.timeout, isolation_level=None, check_same_thread=False)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS responses ("
+                "key TEXT PRIMARY KEY, value TEXT NOT NULL, created_at REAL NOT NULL)"
+            )
+            self._conn = conn
+            self._pid = os.getpid()
+        return self._conn
+
+    def get_many(self, keys):
+        """Return the cached values for `keys`, in order, with None for misses."""
+        keys = [digest_key(key) for key in keys]
+        min_created_at = time.time() - self.ttl if self.ttl is not None else 0
+        found = {}
+        with self._lock:
+            conn = self._connect()
+            for start in range(0, len(keys), LOOKUP_CHUNK):
+                chunk = keys[start : start + LOOKUP_CHUNK]
+                rows = conn.execute(
+                    "SELECT key, value FROM responses WHERE created_at >= ? AND key IN ({})".format(
+                        ",".join("?" * len(chunk))),
+                    [min_created_at] + chunk,
+                ).fetchall()
+                found.update(rows)
+        return [json.loads(found[key]) if key in found else None for key in keys]
+
+    def get(self, key):
+        return self.get_many([key])[0]
+
+    def put_many(self, items):
+        """Insert (key, value) pairs in one transaction. None values are not cached."""
+        now = time.time()
+        rows = [
+            (digest_key(key), json.dumps(value, ensure_ascii=False), now)
+            for key, value in items
+            if value is not None
+        ]
+        if len(rows) == 0:
+            return 0
+        with self._lock:
+            conn = self._connect()
+            conn.execute("BEGIN IMMEDIATE")
+            try:
+                conn.executemany("INSERT OR REPLACE INTO responses (key, value, created_at) VALUES (?, ?, ?)", rows)
+                conn.execute("COMMIT")
+            except BaseException:
+                conn.execute("ROLLBACK")
+                raise
+        return len(rows)
+
+    def put(self, key, value):
+        return self.put_many([(key, value)])
+
+    def __contains__(self, key):
+        return self.get(key) is not None
+
+    def __len__(self):
+        with self._lock:
+            return self._connect().execute("SELECT COUNT(*) FROM responses").fetchone()[0]
+
+    def compact(self, ttl=None):
+        """Drop entries older than `ttl` (default: the cache ttl) and reclaim disk space."""
+        ttl = ttl if ttl is not None else self.ttl
+        removed = 0
+        with self._lock:
+            conn = self._connect()
+            if ttl is not None:
+                removed = conn.execute("DELETE FROM responses WHERE created_at < ?", (time.time() - ttl,)).rowcount
+            conn.execute("PRAGMA wal_checkpoint(TRUNCATE)")
+            conn.execute("VACUUM")
+        logger.info("compacted {path}: removed {n} expired entries".format(path=self.path, n=removed))
+        return removed
+
+    def close(self):
+        with self._lock:
+            if self._conn is not None and self._pid == os.getpid():
+                self._conn.close()
+            self._conn = None
+
+    def export_bundle(self, out_dir, since=None):
+        """Write entries created at or after `since` to a gzipped JSONL bundle in `out_dir`.
+
+        The bundle is named after the sha256 of its content, so exporting the same
+        entries twice gives the same file. Returns the bundle path, or None if empty.
+        """
+        with self._lock:
+            rows = self._connect().execute(
+                "SELECT key, value, created_at FROM responses WHERE created_at >= ? ORDER BY key",
+                (since if since is not None else 0,),
+            ).fetchall()
+        if len(rows) == 0:
+            logger.info("nothing to export from {path}".format(path=self.path))
+            return None
+        content = "".join(
+            json.dumps({"key": key, "value": json.loads(value), "created_at": created_at}, ensure_ascii=False) + "\n"
+            for key, value, created_at in rows
+        ).encode("utf-8")
+        digest = hashlib.sha256(content).hexdigest()
+        os.makedirs(out_dir, exist_ok=True)
+        bundle_path = os.path.join(out_dir, digest + BUNDLE_SUFFIX)
+        if not os.path.exists(bundle_path):
+            tmp_path = bundle_path + ".tmp{}".format(os.getpid())
+            # mtime=0 keeps the compressed file byte-identical across exports
+            with gzip.GzipFile(tmp_path, "wb", mtime=0) as f:
+                f.write(content)
+            os.replace(tmp_path, bundle_path)
+        logger.info("exported {n} entries to {bundle}".format(n=len(rows), bundle=bundle_path))
+        return bundle_path
+
+    def import_bundle(self, bundle_path):
+        """Merge a bundle written by `export_bundle`; newer local entries are kept.
+
+        The content is checked against the digest in the file name, and bundles already
+        imported into this store are skipped.
+        """
+        with gzip.open(bundle_path, "rb") as f:
+            content = f.read()
+        digest = hashlib.sha256(content).hexdigest()
+        name = os.path.basename(bundle_path)
+        if name.endswith(BUNDLE_SUFFIX) and name[: -len(BUNDLE_SUFFIX)] != digest:
+            raise ValueError("bundle {path} does not match its digest".format(path=bundle_path))
+        rows = []
+        for line in content.decode("utf-8").splitlines():
+            if line.strip() == "":
+                continue
+            entry = json.loads(line)
+            rows.append((entry["key"], json.dumps(entry["value"], ensure_ascii=False), entry["created_at"]))
+        with self._lock:
+            conn = self._connect()
+            conn.execute("CREATE TABLE IF NOT EXISTS bundles (digest TEXT PRIMARY KEY, imported_at REAL NOT NULL)")
+            if conn.execute("SELECT 1 FROM bundles WHERE digest = ?", (digest,)).fetchone() is not None:
+                logger.info("bundle {path} already imported".format(path=bundle_path))
+                return 0
+            conn.execute("BEGIN IMMEDIATE")
+            try:
+                before = conn.total_changes
+                conn.executemany(
+                    "INSERT INTO responses (key, value, created_at) VALUES (?, ?, ?) "
+                    "ON CONFLICT(key) DO UPDATE SET value = excluded.value, created_at = excluded.created_at "
+                    "WHERE excluded.created_at > responses.created_at",
+                    rows,
+                )
+                imported = conn.total_changes - before
+                conn.execute("INSERT INTO bundles (digest, imported_at) VALUES (?, ?)", (digest, time.time()))
+                conn.execute("COMMIT")
+            except BaseException:
+                conn.execute("ROLLBACK")
+                raise
+        logger.info("imported {n} of {total} entries from {path}".format(n=imported, total=len(rows), path=bundle_path))
+        return imported
+
+    def migrate_pickle(self, pickle_path, batch_size=5000):
+        """Import a legacy `query_cache.pkl` (dict of key tuple -> response)."""
+        with open(pickle_path, "rb") as f:
+            legacy = pickle.load(f)
+        items = list(legacy.items())
+        imported = 0
+        for start in range(0, len(items), batch_size):
+            imported += self.put_many(items[start : start + batch_size])
+        logger.info("imported {n} of {total} entries from {path}".format(n=imported, total=len(items), path=pickle_path))
+        return imported
+
+
+class RemoteCache:
+    """Client for a shared cache server (cache_server.py), keyed by digests.
+
+    Lookups and writes are best effort: on a network error the remote tier is
+    skipped for REMOTE_RETRY_AFTER seconds and the run continues with the local store.
+    """
+
+    def __init__(self, url, timeout=REMOTE_TIMEOUT, token=CACHE_TOKEN):
+        self.url = url.rstrip("/")
+        self.timeout = timeout
+        self.token = token
+        self.hits = 0
+        self._down_until = 0.0
+
+    def _post(self, path, body):
+        if time.monotonic() < self._down_until:
+            return None
+        headers = {"Content-Type": "application/json"}
+        if self.token:
+            headers["Authorization"] = "Bearer " + self.token
+        request = urllib.request.Request(
+            self.url + path,
+            data=json.dumps(body, ensure_ascii=False).encode("utf-8"),
+            headers=headers,
+        )
+        try:
+            with urllib.request.urlopen(request, timeout=self.timeout) as response:
+                return json.loads(response.read())
+        except (urllib.error.URLError, OSError, ValueError) as e:
+            self._down_until = time.monotonic() + REMOTE_RETRY_AFTER
+            logger.warning("cache server {url} unavailable ({error}); retrying in {delay}s".format(
+                url=self.url, error=e, delay=REMOTE_RETRY_AFTER))
+            return None
+
+    def get_many(self, keys):
+        keys = [digest_key(key) for key in keys]
+        values = []
+        for start in range(0, len(keys), LOOKUP_CHUNK):
+            chunk = keys[start : start + LOOKUP_CHUNK]
+            response = self._post("/get", {"keys": chunk})
+            values += response["values"] if response is not None else [None] * len(chunk)
+        self.hits += sum(value is not None for value in values)
+        return values
+
+    def get(self, key):
+        return self.get_many([key])[0]
+
+    def put_many(self, items):
+        items = [[digest_key(key), value] for key, value in items if value is not None]
+        stored = 0
+        for start in range(0, len(items), LOOKUP_CHUNK):
+            response = self._post("/put", {"items": items[start : start + LOOKUP_CHUNK]})
+            stored += response["stored"] if response is not None else 0
+        return stored
+
+    def put(self, key, value):
+        return self.put_many([(key, value)])
+
+
+class TieredCache:
+    """Bounded in-memory LRU in front of the persistent store, same interface as ResponseCache.
+
+    With a `remote` tier, local misses are looked up there and copied into the local
+    store; new entries are written to both.
+    """
+
+    def __init__(self, store, hot=None, remote=None):
+        self.store = store
+        self.hot = hot if hot is not None else LRUCache()
+        self.remote = remote
+
+    def get_many(self, keys):
+        keys = [digest_key(key) for key in keys]
+        values = [self.hot.get(key) for key in keys]
+        missing = [i for i, value in enumerate(values) if value is None]
+        if len(missing) > 0:
+            for i, value in zip(missing, self.store.get_many([keys[i] for i in missing])):
+                if value is not None:
+                    self.hot.put(keys[i], value)
+                    values[i] = value
+        missing = [i for i, value in enumerate(values) if value is None]
+        if self.remote is not None and len(missing) > 0:
+            fetched = []
+            for i, value in zip(missing, self.remote.get_many([keys[i] for i in missing])):
+                if value is not None:
+                    self.hot.put(keys[i], value)
+                    values[i] = value
+                    fetched.append((keys[i], value))
+            self.store.put_many(fetched)
+        return values
+
+    def get(self, key):
+        return self.get_many([key])[0]
+
+    def put_many(self, items):
+        items = [(digest_key(key), value) for key, value in items]
+        for key, value in items:
+            self.hot.put(key, value)
+        stored = self.store.put_many(items)
+        if self.remote is not None:
+            self.remote.put_many(items)
+        return stored
+
+    def put(self, key, value):
+        return self.put_many([(key, value)])
+
+    def __contains__(self, key):
+        return self.get(key) is not None
+
+    def __len__(self):
+        return len(self.store)
+
+    def compact(self, ttl=None):
+        self.hot.clear()
+        return self.store.compact(ttl)
+
+    def close(self):
+        self.store.close()
+
+
+_caches = {}
+_caches_lock = threading.Lock()
+
+
+def configure_query_cache(enabled):
+    """Turn the response cache on or off for Generators created afterwards (MODEL.USE_CACHE); None keeps the default."""
+    global USE_QUERY_CACHE
+    if enabled is not None:
+        USE_QUERY_CACHE = bool(enabled)
+
+
+def query_cache_enabled():
+    return USE_QUERY_CACHE
+
+
+def get_response_cache(path=None):
+    """Return the process-wide (hot tier + on-disk store [+ QUERY_CACHE_URL server]) cache for `path`."""
+    path = path or CACHE_DB
+    with _caches_lock:
+        if path not in _caches:
+            remote = RemoteCache(CACHE_URL) if CACHE_URL else None
+            _caches[path] = TieredCache(ResponseCache(path), remote=remote)
+        return _caches[path]
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Manage the on-disk query response cache.")
+    parser.add_argument("--db", type=str, default=CACHE_DB, help="cache database path")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+    migrate_parser = subparsers.add_parser("migrate", help="import a legacy pickle cache")
+    migrate_parser.add_argument("pickle_path", type=str, nargs="?", default="query_cache.pkl")
+    compact_parser = subparsers.add_parser("compact", help="drop expired entries and reclaim disk space")
+    compact_parser.add_argument("--ttl", type=float, default=CACHE_TTL, help="maximum entry age in seconds")
+    subparsers.add_parser("stats", help="print the number of cached entries")
+    export_parser = subparsers.add_parser("export", help="write entries to a content-addressed bundle")
+    export_parser.add_argument("out_dir", type=str)
+    export_parser.add_argument("--since", type=float, default=None, help="only entries created after this unix time")
+    import_parser = subparsers.add_parser("import", help="merge bundles (files or directories of bundles)")
+    import_parser.add_argument("paths", type=str, nargs="+")
+    args = parser.parse_args()
+
+    cache = ResponseCache(args.db)
+    if args.command == "migrate":
+        cache.migrate_pickle(args.pickle_path)
+    elif args.command == "compact":
+        cache.compact(args.ttl)
+    elif args.command == "stats":
+        print("{n} entries in {path}".format(n=len(cache), path=args.db))
+    elif args.command == "export":
+        bundle_path = cache.export_bundle(args.out_dir, since=args.since)
+        if bundle_path is not None:
+            print(bundle_path)
+    elif args.command == "import":
+        for path in args.paths:
+            bundle_paths = sorted(glob.glob(os.path.join(path, "*" + BUNDLE_SUFFIX))) if os.path.isdir(path) else [path]
+            for bundle_path in bundle_paths:
+                cache.import_bundle(bundle_path)
+    cache.close()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,112 @@
+import asyncio
+import os
+import threading
+import weakref
+import httpx
+import openai
+
+# connection pool settings shared by every OpenAI client in the process
+OPENAI_POOL_SIZE = int(os.environ.get("OPENAI_POOL_SIZE", 64))
+OPENAI_KEEPALIVE = float(os.environ.get("OPENAI_KEEPALIVE", 30))
+OPENAI_TIMEOUT = float(os.environ.get("OPENAI_TIMEOUT", 60))
+OPENAI_CONNECT_TIMEOUT = float(os.environ.get("OPENAI_CONNECT_TIMEOUT", 10))
+# query_openai retries on its own (with the rate limiter), so the async client does not
+OPENAI_CLIENT_RETRIES = int(os.environ.get("OPENAI_CLIENT_RETRIES", 0))
+
+_sync_clients = {}
+_async_clients = weakref.WeakKeyDictionary()
+_lock = threading.Lock()
+# (pid, loop, thread) of the background event loop that runs async queries
+_background = None
+
+
+def _limits():
+    return httpx.Limits(
+        max_connections=OPENAI_POOL_SIZE,
+        max_keepalive_connections=OPENAI_POOL_SIZE,
+        keepalive_expiry=OPENAI_KEEPALIVE,
+    )
+
+
+def _timeout():
+    return httpx.Timeout(OPENAI_TIMEOUT, connect=OPENAI_CONNECT_TIMEOUT)
+
+
+def _api_key(base_url):
+    # self-hosted OpenAI-compatible servers usually accept any key
+    if base_url is not None:
+        return os.environ.get("OPENAI_API_KEY", "EMPTY")
+    return None
+
+
+def get_client(base_url=None):
+    """Return the process-wide synchronous client for `base_url` (default: OPENAI_BASE_URL or api.openai.com)."""
+    key = (os.getpid(), base_url)
+    with _lock:
+        if key not in _sync_clients:
+            _sync_clients[key] = openai.OpenAI(
+                base_url=base_url,
+                api_key=_api_key(base_url),
+                timeout=_timeout(),
+                http_client=httpx.Client(limits=_limits(), timeout=_timeout()),
+            )
+        return _sync_clients[key]
+
+
+def get_async_client(base_url=None):
+    """Return the async client for `base_url` bound to the running event loop.
+
+    httpx connection pools cannot be shared between event loops, so there is one
+    client per (loop, base_url); it is reused by every request on that loop.
+    """
+    loop = asyncio.get_running_loop()
+    with _lock:
+        clients = _async_clients.setdefault(loop, {})
+        if base_url not in clients:
+            clients[base_url] = openai.AsyncOpenAI(
+                base_url=base_url,
+                api_key=_api_key(base_url),
+                timeout=_timeout(),
+                max_retries=OPENAI_CLIENT_RETRIES,
+                http_client=httpx.AsyncClient(limits=_limits(), timeout=_timeout()),
+            )
+        return clients[base_url]
+
+
+def _background_loop():
+    global _background
+    with _lock:
+        if _background is None or _background[0] != os.getpid():
+            loop = asyncio.new_event_loop()
+            thread = threading.Thread(target=loop.run_forever, name="openai-event-loop", daemon=True)
+            thread.start()
+            _background = (os.getpid(), loop, thread)
+        return _background[1:]
+
+
+def run_async(coro):
+    """Run `coro` on the process-wide background event loop and wait for its result.
+
+    The loop lives as long as the process, so its async clients keep their
+    keep-alive connections from one query to the next. Safe to call from any
+    thread except the loop's own.
+    """
+    loop, thread = _background_loop()
+    if threading.current_thread() is thread:
+        raise RuntimeError("run_async called from the background event loop")
+    future = asyncio.run_coroutine_threadsafe(coro, loop)
+    try:
+        return future.result()
+    except BaseException:
+        # e.g. KeyboardInterrupt in the caller: stop the queries instead of leaving them running
+        future.cancel()
+        raise
+
+
+async def close_async_clients():
+    """Close the clients of the running loop; call before the loop is shut down."""
+    loop = asyncio.get_running_loop()
+    with _lock:
+        clients = _async_clients.pop(loop, {})
+    for client in clients.values():
+        await client.close()
@@ -0,0 +1,107 @@
+import os
+import torch
+from ..utils.log import get_logger
+
+logger = get_logger("INFO", "constrained")
+
+# label-task requests to local models decode only label tokens (0 = free generation)
+CONSTRAINED_DECODING = os.environ.get("CONSTRAINED_DECODING", "1") == "1"
+# new-token caps per task type for local models; None = no cap
+MAX_NEW_TOKENS = {
+    "label": int(os.environ.get("MAX_NEW_TOKENS_LABEL", 8)),
+    "rationale": int(os.environ.get("MAX_NEW_TOKENS_RATIONALE", 256)),
+    "paraphrase": int(os.environ.get("MAX_NEW_TOKENS_PARAPHRASE", 512)),
+    None: None,
+}
+
+
+def cap_new_tokens(task, max_gen_len):
+    if task not in MAX_NEW_TOKENS:
+        raise ValueError("unknown task type {task}, expected one of {tasks}".format(task=task, tasks=list(MAX_NEW_TOKENS)))
+    cap = MAX_NEW_TOKENS[task]
+    return max_gen_len if cap is None else min(max_gen_len, cap)
+
+
+class LabelTrie:
+    """Token sequences of a label space; tells which tokens may follow a partial answer."""
+
+    def __init__(self, tokenizer, labels):
+        self.labels = labels
+        self.eos_token_id = tokenizer.eos_token_id
+        self.sequences = [tuple(tokenizer(label, add_special_tokens=False)["input_ids"]) for label in labels]
+        self.max_length = max(len(sequence) for sequence in self.sequences) + 1
+
+    def allowed(self, generated):
+        """Tokens allowed after `generated`; end of sequence once a label is complete."""
+        generated = tuple(generated)
+        if generated in self.sequences:
+            return [self.eos_token_id]
+        allowed = {sequence[len(generated)] for sequence in self.sequences
+                   if len(sequence) > len(generated) and sequence[:len(generated)] == generated}
+        # finished rows are padded until the whole batch stops
+        return sorted(allowed) if len(allowed) > 0 else [self.eos_token_id]
+
+    def finished(self, generated):
+        return tuple(generated) in self.sequences or (len(generated) > 0 and generated[-1] == self.eos_token_id)
+
+    def decode(self, generated):
+        generated = tuple(token for token in generated if token != self.eos_token_id)
+        for label, sequence in zip(self.labels, self.sequences):
+            if generated[:len(sequence)] == sequence:
+                return label
+        return ""
+
+
+@torch.no_grad()
+def generate_labels(model, tokenizer, prompts, labels, batch_size, decoder_only):
+    """Greedy decoding restricted to `labels`, stopping as soon as every row has a full label.
+
+    Decoder-only tokenizers must pad on the left so the generated tokens of
+    every row start at the same position.
+    """
+    trie = LabelTrie(tokenizer, labels)
+    texts = []
+    for i in range(0, len(prompts), batch_size):
+        inputs = tokenizer(prompts[i:i + batch_size], return_tensors="pt", padding=True,
+                           truncation=not decoder_only).to(model.device)
+        start = inputs["input_ids"].shape[1] if decoder_only else 1
+        outputs = model.generate(
+            **inputs,
+            do_sample=False,
+            max_new_tokens=trie.max_length,
+            eos_token_id=trie.eos_token_id,
+            pad_token_id=tokenizer.pad_token_id,
+            prefix_allowed_tokens_fn=lambda batch_id, input_ids: trie.allowed(input_ids[start:].tolist()),
+        )
+        texts += [trie.decode(output[start:].tolist()) for output in outputs]
+    return texts
+
+
+@torch.no_grad()
+def decode_labels(model, trie, logits, past_key_values, attention_mask):
+    """Constrained greedy decoding of a decoder-only model, continued from a forward pass over the prompts.
+
+    `logits` are the next-token logits at the end of each prompt and
+    `past_key_values` / `attention_mask` cover the prompts.
+    """
+    generated = [[] for _ in range(logits.shape[0])]
+    for step in range(trie.max_length):
+        mask = torch.full_like(logits, float("-inf"))
+        for row, tokens in enumerate(generated):
+            mask[row, trie.allowed(tokens)] = 0
+        next_tokens = (logits + mask).argmax(dim=-1)
+        for row, token in enumerate(next_tokens.tolist()):
+            if not trie.finished(generated[row]):
+                generated[row].append(token)
+        if all(trie.finished(tokens) for tokens in generated):
+            break
+        attention_mask = torch.cat([attention_mask, attention_mask.new_ones(attention_mask.shape[0], 1)], dim=1)
+        outputs = model(
+            input_ids=next_tokens[:, None],
+            attention_mask=attention_mask,
+            position_ids=attention_mask.sum(dim=1, keepdim=True) - 1,
+            past_key_values=past_key_values,
+            use_cache=True,
+        )
+        logits, past_key_values = outputs.logits[:, -1, :], outputs.past_key_values
+    return [trie.decode(tokens) for tokens in generated]
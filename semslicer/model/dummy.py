@@ -0,0 +1,79 @@
+import hashlib
+import json
+import os
+import threading
+import time
+import torch
+from ..utils.log import get_logger
+from .rate_limit import estimate_tokens
+
+logger = get_logger("INFO", "dummy")
+
+# simulated student model, for running the pipeline without a GPU or API key
+DUMMY_SEED = int(os.environ.get("DUMMY_SEED", 0))
+DUMMY_POSITIVE_RATE = float(os.environ.get("DUMMY_POSITIVE_RATE", 0.5))
+# seconds of simulated model time per dialog
+DUMMY_COST_PER_ITEM = float(os.environ.get("DUMMY_COST_PER_ITEM", 0.0))
+
+
+class DummyModel:
+    """Deterministic stand-in for a model: the answer to a dialog is a hash of the dialog and the seed.
+
+    The first label ("yes" by default) is answered for a `positive_rate` fraction of
+    dialogs, with a confidence between 0.5 and 1 that is also derived from the hash.
+    Each dialog costs `cost_per_item` seconds of sleep, and prompt/completion tokens are
+    counted with the same 4-characters-per-token estimate the rate limiter uses.
+    """
+
+    def __init__(self, model_name="dummy", seed=DUMMY_SEED, positive_rate=DUMMY_POSITIVE_RATE,
+                 cost_per_item=DUMMY_COST_PER_ITEM):
+        self.model_name = model_name
+        self.seed = seed
+        self.positive_rate = positive_rate
+        self.cost_per_item = cost_per_item
+        self._lock = threading.Lock()
+        self.num_requests = 0
+        self.prompt_tokens = 0
+        self.completion_tokens = 0
+
+    def _draw(self, dialog):
+        """Two uniform numbers in [0, 1) for `dialog`: one picks the answer, one its confidence."""
+        digest = hashlib.sha256(json.dumps([self.seed, dialog], sort_keys=True).encode("utf-8")).digest()
+        return int.from_bytes(digest[:8], "big") / 2 ** 64, int.from_bytes(digest[8:16], "big") / 2 ** 64
+
+    def score(self, dialog, labels=["yes", "no"]):
+        """Return (answer, probability tensor over `labels`)."""
+        answer_draw, confidence_draw = self._draw(dialog)
+        answer_idx = 0 if answer_draw < self.positive_rate or len(labels) == 1 else 1
+        confidence = 0.5 + 0.5 * confidence_draw
+        probs = torch.full((len(labels),), (1 - confidence) / max(len(labels) - 1, 1))
+        probs[answer_idx] = confidence if len(labels) > 1 else 1.0
+        return labels[answer_idx], probs
+
+    def count_tokens(self, dialogs):
+        return sum(estimate_tokens(dialog, max_tokens=0) for dialog in dialogs)
+
+    def completion(self, dialogs, return_prob=False, labels=None, **kwargs):
+        """Answer `dialogs`; with `return_prob`, also return an n x len(labels) probability tensor."""
+        labels = labels if labels is not None else ["yes", "no"]
+        if self.cost_per_item > 0:
+            time.sleep(self.cost_per_item * len(dialogs))
+        scored = [self.score(dialog, labels) for dialog in dialogs]
+        texts = [answer for answer, _ in scored]
+        with self._lock:
+            self.num_requests += len(dialogs)
+            self.prompt_tokens += self.count_tokens(dialogs)
+            self.completion_tokens += len(dialogs)
+        if return_prob:
+            probs = torch.stack([prob for _, prob in scored]) if len(scored) > 0 else torch.empty(0, len(labels))
+            return texts, probs
+        return texts
+
+    def usage(self):
+        with self._lock:
+            return {
+                "requests": self.num_requests,
+                "prompt_tokens": self.prompt_tokens,
+                "completion_tokens": self.completion_tokens,
+                "simulated_seconds": self.num_requests * self.cost_per_item,
+            }
@@ -0,0 +1,102 @@
+import concurrent.futures
+import contextvars
+import threading
+import time
+from collections import deque
+
+# number of recent latencies kept per generator
+LATENCY_WINDOW = 200
+# no hedging until this many latencies have been observed
+MIN_LATENCY_SAMPLES = 10
+HEDGE_PERCENTILE = 95
+
+
+def _start(fn, context, attempt):
+    """Run `fn(attempt)` in `context` on a thread of its own and return its Future.
+
+    Attempts never wait in a shared pool's queue, so abandoned (timed-out or
+    losing) attempts cannot delay the start of later calls.
+    """
+    future = concurrent.futures.Future()
+
+    def run():
+        if not future.set_running_or_notify_cancel():
+            return
+        try:
+            future.set_result(context.run(fn, attempt))
+        except BaseException as e:
+            future.set_exception(e)
+
+    threading.Thread(target=run, name="hedge-{}".format(attempt), daemon=True).start()
+    return future
+
+
+class LatencyTracker:
+    """Sliding window of recent request latencies (seconds)."""
+
+    def __init__(self, window=LATENCY_WINDOW):
+        self._latencies = deque(maxlen=window)
+        self._lock = threading.Lock()
+
+    def record(self, seconds):
+        with self._lock:
+            self._latencies.append(seconds)
+
+    def percentile(self, q, min_samples=MIN_LATENCY_SAMPLES):
+        with self._lock:
+            latencies = sorted(self._latencies)
+        if len(latencies) < max(min_samples, 1):
+            return None
+        index = min(len(latencies) - 1, int(round(q / 100 * (len(latencies) - 1))))
+        return latencies[index]
+
+    def stats(self):
+        return {
+            "count": len(self._latencies),
+            "p50": self.percentile(50, min_samples=1),
+            "p95": self.percentile(95, min_samples=1),
+            "p99": self.percentile(99, min_samples=1),
+        }
+
+
+def call_with_deadline(fn, deadline=None, hedge_after=None, tracker=None):
+    """Run `fn(attempt)` with an optional deadline and one hedged duplicate.
+
+    If the first attempt is still running after `hedge_after` seconds, `fn(1)` is
+    started as well and the first successful result wins. A TimeoutError is raised once
+    `deadline` seconds have passed. Losing or timed-out attempts cannot be interrupted;
+    they finish in the background and their results are dropped.
+    """
+    start = time.monotonic()
+    # attempts run in worker threads but report into the caller's context (e.g. metering)
+    context = contextvars.copy_context()
+    futures = [_start(fn, context.copy(), 0)]
+    error = None
+    while True:
+        elapsed = time.monotonic() - start
+        timeouts = []
+        if deadline is not None:
+            timeouts.append(deadline - elapsed)
+        if hedge_after is not None and len(futures) == 1:
+            timeouts.append(hedge_after - elapsed)
+        timeout = max(0.0, min(timeouts)) if len(timeouts) > 0 else None
+
+        pending = [future for future in futures if not future.done()]
+        done, _ = concurrent.futures.wait(pending, timeout=timeout, return_when=concurrent.futures.FIRST_COMPLETED)
+        for future in futures:
+            if future.done():
+                if future.exception() is None:
+                    if tracker is not None:
+                        tracker.record(time.monotonic() - start)
+                    return future.result()
+                error = future.exception()
+
+        elapsed = time.monotonic() - start
+        all_failed = all(future.done() for future in futures)
+        if hedge_after is not None and len(futures) == 1 and (elapsed >= hedge_after or all_failed):
+            futures.append(_start(fn, context.copy(), 1))
+            continue
+        if all_failed:
+            raise error
+        if deadline is not None and elapsed >= deadline:
+            raise TimeoutError("request did not finish within {:.1f}s".format(deadline))
@@ -0,0 +1,71 @@
+import concurrent.futures
+import threading
+
+
+class InflightTable:
+    """Process-wide table of pending requests, so identical concurrent requests share one result.
+
+    Futures are `concurrent.futures.Future`s: threads wait with `.result()`, async
+    tasks with `await asyncio.wrap_future(future)`.
+    """
+
+    def __init__(self):
+        self._futures = {}
+        self._lock = threading.Lock()
+
+    def claim(self, keys):
+        """Split `keys` into the unique keys this caller must compute and futures for keys already in flight."""
+        owned = []
+        waiting = {}
+        with self._lock:
+            for key in dict.fromkeys(keys):
+                if key in self._futures:
+                    waiting[key] = self._futures[key]
+                else:
+                    self._futures[key] = concurrent.futures.Future()
+                    owned.append(key)
+        return owned, waiting
+
+    def resolve(self, key, value):
+        with self._lock:
+            future = self._futures.pop(key, None)
+        if future is not None:
+            future.set_result(value)
+
+    def fail(self, key, exception):
+        with self._lock:
+            future = self._futures.pop(key, None)
+        if future is not None:
+            future.set_exception(exception)
+
+    def __len__(self):
+        return len(self._futures)
+
+
+INFLIGHT = InflightTable()
+
+
+def run_coalesced(keys, compute, table=INFLIGHT):
+    """Return one value per key, computing only keys no other caller is already computing.
+
+    `compute(owned_keys)` must return a list of values aligned with `owned_keys`. The
+    caller computes its own keys before waiting on others, so two callers waiting on
+    each other's keys cannot deadlock.
+    """
+    owned, waiting = table.claim(keys)
+    values = {}
+    if len(owned) > 0:
+        try:
+            owned_values = compute(owned)
+            if len(owned_values) != len(owned):
+                raise ValueError("expected {} values, got {}".format(len(owned), len(owned_values)))
+        except BaseException as e:
+            for key in owned:
+                table.fail(key, e)
+            raise
+        for key, value in zip(owned, owned_values):
+            table.resolve(key, value)
+            values[key] = value
+    for key, future in waiting.items():
+        values[key] = future.result()
+    return [values[key] for key in keys]
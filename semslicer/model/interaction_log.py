@@ -0,0 +1,207 @@
+import argparse
+import atexit
+import glob
+import gzip
+import json
+import os
+import re
+import threading
+import time
+from ..utils.log import get_logger
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+logger = get_logger("INFO", "interaction_log")
+
+# log of every query_batch request (unset = no log); a .gz or .zst suffix compresses it
+INTERACTIONS_SAVE_PATH = os.environ.get("INTERACTIONS_SAVE_PATH")
+# the log is rotated once it grows past this many bytes (on disk)
+INTERACTIONS_MAX_BYTES = int(os.environ.get("INTERACTIONS_MAX_BYTES", 256 * 1024 * 1024))
+# records buffered in memory before they are written
+INTERACTIONS_BUFFER_SIZE = int(os.environ.get("INTERACTIONS_BUFFER_SIZE", 256))
+
+
+def _split_suffix(path):
+    """'log.jsonl.gz' -> ('log', '.jsonl.gz'); the compression is taken from the last suffix."""
+    match = re.match(r"^(.*?)((?:\.jsonl)?(?:\.gz|\.zst)?)$", path)
+    return match.group(1), match.group(2)
+
+
+def _compression(path):
+    if path.endswith(".gz"):
+        return "gzip"
+    if path.endswith(".zst"):
+        if zstandard is None:
+            raise ImportError("zstandard is required for .zst interaction logs: pip install zstandard")
+        return "zstd"
+    return None
+
+
+def _encode(data, compression):
+    # every flush is a self-contained gzip member / zstd frame, so appending keeps the file valid
+    if compression == "gzip":
+        return gzip.compress(data)
+    if compression == "zstd":
+        return zstandard.ZstdCompressor().compress(data)
+    return data
+
+
+def _decode(data, compression):
+    if compression == "gzip":
+        return gzip.decompress(data)
+    if compression == "zstd":
+        reader = zstandard.ZstdDecompressor().stream_reader(data, read_across_frames=True)
+        return reader.read()
+    return data
+
+
+class InteractionLog:
+    """Append-only JSONL log of model requests, one record per line.
+
+    Records are buffered and written `buffer_size` at a time with a single append,
+    so concurrent writers (threads or processes) never interleave partial lines.
+    When the file passes `max_bytes` it is renamed to `<name>.<n><suffix>` and a new
+    one is started; `read_interactions` reads all of them.
+    """
+
+    def __init__(self, path, max_bytes=INTERACTIONS_MAX_BYTES, buffer_size=INTERACTIONS_BUFFER_SIZE):
+        self.path = path
+        self.max_bytes = max_bytes
+        self.buffer_size = buffer_size
+        self.compression = _compression(path)
+        self._buffer = []
+        self._lock = threading.Lock()
+        directory = os.path.dirname(path)
+        if directory != "":
+            os.makedirs(directory, exist_ok=True)
+
+    def append(self, record):
+        with self._lock:
+            self._buffer.append(record)
+            if len(self._buffer) >= self.buffer_size:
+                self._flush()
+
+    def extend(self, records):
+        with self._lock:
+            self._buffer.extend(records)
+            if len(self._buffer) >= self.buffer_size:
+                self._flush()
+
+    def flush(self):
+        with self._lock:
+            self._flush()
+
+    def _flush(self):
+        if len(self._buffer) == 0:
+            return
+        data = "".join(json.dumps(record, ensure_ascii=False) + "\n" for record in self._buffer).encode("utf-8")
+        self._buffer = []
+        self._rotate()
+        with open(self.path, "ab") as f:
+            f.write(_encode(data, self.compression))
+
+    def _rotate(self):
+        if not os.path.exists(self.path) or os.path.getsize(self.path) < self.max_bytes:
+            return
+        base, suffix = _split_suffix(self.path)
+        index = 1
+        while os.path.exists("{base}.{index}{suffix}".format(base=base, index=index, suffix=suffix)):
+            index += 1
+        rotated = "{base}.{index}{suffix}".format(base=base, index=index, suffix=suffix)
+        os.replace(self.path, rotated)
+        logger.info("rotated interaction log to {path}".format(path=rotated))
+
+
+_logs = {}
+_logs_lock = threading.Lock()
+
+
+def get_interaction_log(path=None):
+    """Return the process-wide log for `path` (default: INTERACTIONS_SAVE_PATH), or None if unset."""
+    path = path or INTERACTIONS_SAVE_PATH
+    if path is None:
+        return None
+    with _logs_lock:
+        if path not in _logs:
+            _logs[path] = InteractionLog(path)
+        return _logs[path]
+
+
+@atexit.register
+def flush_interaction_logs():
+    for interaction_log in list(_logs.values()):
+        interaction_log.flush()
+
+
+def make_record(model_name, params, prompt, response, cache_hit, info=None):
+    """One log record; `info` holds per-request measurements (latency, token counts, attempts)."""
+    info = info or {}
+    return {
+        "time": time.time(),
+        "model": model_name,
+        "params": params,
+        "prompt": prompt,
+        "response": response,
+        "cache_hit": cache_hit,
+        "latency": info.get("latency"),
+        "prompt_tokens": info.get("prompt_tokens"),
+        "completion_tokens": info.get("completion_tokens"),
+        "cached_tokens": info.get("cached_tokens"),
+        "attempts": info.get("attempts"),
+    }
+
+
+def log_paths(path):
+    """`path` and its rotated files, oldest first."""
+    base, suffix = _split_suffix(path)
+    rotated = glob.glob("{base}.*{suffix}".format(base=glob.escape(base), suffix=suffix))
+    pattern = re.compile(r"^" + re.escape(base) + r"\.(\d+)" + re.escape(suffix) + r"$")
+    rotated = sorted((int(pattern.match(p).group(1)), p) for p in rotated if pattern.match(p))
+    paths = [p for _, p in rotated]
+    if os.path.exists(path):
+        paths.append(path)
+    return paths
+
+
+def iter_interactions(path):
+    for log_path in log_paths(path):
+        with open(log_path, "rb") as f:
+            data = _decode(f.read(), _compression(log_path))
+        for line in data.decode("utf-8").splitlines():
+            if line.strip() != "":
+                yield json.loads(line)
+
+
+def read_interactions(path=None):
+    """Load an interaction log (with its rotated files) into a DataFrame."""
+    import pandas as pd
+
+    return pd.DataFrame(list(iter_interactions(path or INTERACTIONS_SAVE_PATH)))
+
+
+def summarize(df):
+    """Per-model request counts, cache hit rate, latency percentiles and token totals."""
+    fresh = df[~df["cache_hit"]]
+    summary = df.groupby("model").agg(requests=("prompt", "size"), cache_hit_rate=("cache_hit", "mean"))
+    summary["latency_p50"] = fresh.groupby("model")["latency"].quantile(0.5)
+    summary["latency_p95"] = fresh.groupby("model")["latency"].quantile(0.95)
+    summary["prompt_tokens"] = fresh.groupby("model")["prompt_tokens"].sum()
+    summary["completion_tokens"] = fresh.groupby("model")["completion_tokens"].sum()
+    return summary
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Summarize an interaction log.")
+    parser.add_argument("path", type=str, nargs="?", default=INTERACTIONS_SAVE_PATH)
+    args = parser.parse_args()
+    df = read_interactions(args.path)
+    print("{n} records".format(n=len(df)))
+    if len(df) > 0:
+        print(summarize(df).to_string())
+
+
+if __name__ == "__main__":
+    main()
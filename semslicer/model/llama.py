@@ -3,6 +3,7 @@ import os.path as osp
 import torch
 import torch.cuda
 import torch.backends.cudnn
+import torch.nn.functional as F
 import argparse
 from transformers import (
     AutoTokenizer,
@@ -12,10 +13,26 @@ from transformers import (
 from typing import List, Dict
 import time
 import concurrent.futures
+import threading
+from functools import partial
+from collections import OrderedDict
 from ..utils.log import get_logger
+from .constrained import LabelTrie, decode_labels
+from .batching import PaddingMeter, plan_batches, run_batched
+
+try:
+    from transformers import DynamicCache
+except ImportError:
+    DynamicCache = None
 
 logger = get_logger("INFO", "llama")
 
+LABEL_SPACE = ['yes', 'no']
+# reuse the keys and values of the shared [INST] <<SYS>> ... <</SYS>> block across rows
+LLAMA_PREFIX_CACHE = os.environ.get("LLAMA_PREFIX_CACHE", "1") == "1"
+# prefixes kept per GPU; each entry holds every layer's keys and values for its tokens
+LLAMA_PREFIX_CACHE_SIZE = int(os.environ.get("LLAMA_PREFIX_CACHE_SIZE", 4))
+
 def _divide_list_into_sublists(input_list, num_sublists, batch_size):
     avg_len = int(len(input_list) / num_sublists) + 1
     if avg_len >= batch_size:
@@ -38,7 +55,64 @@ You are a helpful, respectful and honest assistant. Always answer as helpfully a
 If a question does not make any sense, or is not factually coherent, explain why instead of answering something not correct. If you don't know the answer to a question, please don't share false information."""
 
 
+def _format_dialog(dialog, mimic_starting_response=''):
+    """Llama-2 chat prompt for a [system,] user, assistant, user, ... dialog."""
+    if dialog[0]["role"] != "system":
+        dialog = [
+            {
+                "role": "system",
+                "content": DEFAULT_SYSTEM_PROMPT,
+            }
+        ] + dialog
+    dialog = [
+        {
+            "role": dialog[1]["role"],
+            "content": B_SYS
+            + dialog[0]["content"]
+            + E_SYS
+            + dialog[1]["content"],
+        }
+    ] + dialog[2:]
+    dialog_tokens: str = "".join(
+        [
+            f"{B_INST} {(prompt['content']).strip()} {E_INST} {(answer['content']).strip()} "
+            for prompt, answer in zip(
+                dialog[::2],
+                dialog[1::2],
+            )
+        ]
+    )
+    dialog_tokens += f"{B_INST} {(dialog[-1]['content']).strip()} {E_INST} {mimic_starting_response}"
+    assert all([msg["role"] == "user" for msg in dialog[::2]]) and all(
+        [msg["role"] == "assistant" for msg in dialog[1::2]]
+    ), (
+        "model only supports 'system', 'user' and 'assistant' roles, "
+        "starting with 'system', then 'user' and alternating (u/a/u/a/u...)"
+    )
+    assert (
+        dialog[-1]["role"] == "user"
+    ), f"Last message must be from user, got {dialog[-1]['role']}"
+    return dialog_tokens
+
+
+def _run_pipeline(pipe, prompts, **kwargs):
+    return pipe(prompts, batch_size=len(prompts), **kwargs)
+
+
+def _system_prefix(dialog):
+    """Start of the prompt shared by every dialog with this system prompt."""
+    system = dialog[0]["content"] if dialog[0]["role"] == "system" else DEFAULT_SYSTEM_PROMPT
+    return f"{B_INST} {B_SYS}{system}{E_SYS}"
+
+
 class Llama2Wrapper:
+    """Llama-2 chat models on every visible GPU (or the CPU).
+
+    `model` and `tokenizer` can be passed in instead of being loaded from
+    `model_name`, e.g. a small random-weight causal LM to test the scoring
+    path on the CPU.
+    """
+
     def __init__(
         self,
         model_name,
@@ -46,49 +120,68 @@ class Llama2Wrapper:
         debug_mode=False,
         load_4bit=False,
         batch_size=40,
+        model=None,
+        tokenizer=None,
     ):
         self.model_name = model_name
-        self.no_cuda = (os.environ["CUDA_VISIBLE_DEVICES"] == "")
+        self.no_cuda = (os.environ.get("CUDA_VISIBLE_DEVICES") == "")
         self.use_cuda = not self.no_cuda
         START_TIME = time.perf_counter()
-        logger.info("Start loading {}...".format(model_name))
-        if self.use_cuda:
-            from transformers import BitsAndBytesConfig
-            quantization_config = BitsAndBytesConfig(
-                load_in_4bit=load_4bit,
-                bnb_4bit_quant_type="nf4",
-                bnb_4bit_compute_dtype=torch.bfloat16,
-            )
+        if model is not None:
+            self.tokenizer = tokenizer
+            self.device_count = 1
+            self.model = [model]
+            self.model[-1].eval()
+            load_4bit = False
         else:
-            quantization_config = None
-        self.tokenizer = AutoTokenizer.from_pretrained(
-            model_name,
-        )
-        device_map = {
-            'model.embed_tokens': "nan", 
-            'model.norm': "nan", 
-            'lm_head': 'nan'
-        }
-        for i in range(40):
-            device_map[f'model.layers.{i}'] = "nan"
-        self.device_count = torch.cuda.device_count()
-        logger.info(f"Using {self.device_count} GPUs")
-        self.model = []
-        for item in range(self.device_count):
-            for layer in device_map:
-                device_map[layer] = item
-            self.model.append(
-                AutoModelForCausalLM.from_pretrained(
-                    model_name,
-                    device_map=device_map,
-                    quantization_config=quantization_config,
+            logger.info("Start loading {}...".format(model_name))
+            if self.use_cuda:
+                from transformers import BitsAndBytesConfig
+                quantization_config = BitsAndBytesConfig(
+                    load_in_4bit=load_4bit,
+                    bnb_4bit_quant_type="nf4",
+                    bnb_4bit_compute_dtype=torch.bfloat16,
                 )
+            else:
+                quantization_config = None
+            self.tokenizer = AutoTokenizer.from_pretrained(
+                model_name,
             )
-            self.model[-1].eval()
-        logger.info("Done with {:.2f} seconds.".format(time.perf_counter() - START_TIME))
+            device_map = {
+                'model.embed_tokens': "nan", 
+                'model.norm': "nan", 
+                'lm_head': 'nan'
+            }
+            for i in range(40):
+                device_map[f'model.layers.{i}'] = "nan"
+            self.device_count = torch.cuda.device_count()
+            logger.info(f"Using {self.device_count} GPUs")
+            self.model = []
+            for item in range(self.device_count):
+                for layer in device_map:
+                    device_map[layer] = item
+                self.model.append(
+                    AutoModelForCausalLM.from_pretrained(
+                        model_name,
+                        device_map=device_map,
+                        quantization_config=quantization_config,
+                    )
+                )
+                self.model[-1].eval()
+            if self.device_count == 0:
+                # no GPU: a single full-precision copy on the CPU
+                self.model.append(AutoModelForCausalLM.from_pretrained(model_name))
+                self.model[-1].eval()
+                self.device_count = 1
+                load_4bit = False
+            logger.info("Done with {:.2f} seconds.".format(time.perf_counter() - START_TIME))
         self.debug_mode = debug_mode
         self.is_chat_model = is_chat_model
-        if load_4bit:
+        if self.tokenizer.pad_token_id is None:
+            self.tokenizer.pad_token_id = self.model[0].config.eos_token_id
+        # pad on the left so the last position of every row is the end of its prompt
+        self.tokenizer.padding_side = "left"
+        if load_4bit or self.model[0].device.type == "cpu":
             self.pipeline = [
                 pipeline(
                     "text-generation",
@@ -109,6 +202,14 @@ class Llama2Wrapper:
             ]
         for pipe, model in zip(self.pipeline, self.model):
             pipe.tokenizer.pad_token_id = model.config.eos_token_id
+        self.use_prefix_cache = LLAMA_PREFIX_CACHE
+        self.padding = PaddingMeter()
+        self._prefix_caches = [OrderedDict() for _ in self.model]
+        # coalesced, hedged and concurrent calls can share a device's cache
+        self._prefix_cache_locks = [threading.Lock() for _ in self.model]
+        self._prefix_lock = threading.Lock()
+        self._prefix_stats = {"hits": 0, "misses": 0, "rows": 0, "reused_tokens": 0, "suffix_tokens": 0,
+                              "time_saved": 0.0}
 
     @torch.no_grad()
     def chat_completion(
@@ -118,91 +219,219 @@ class Llama2Wrapper:
         calc_str=None,
         batch_size=40,
         mimic_starting_response='',
+        labels=None,
     ) -> List[
         List[Dict[str, str]]
     ]:  
         assert self.is_chat_model
+        if return_prob:
+            return self.score_labels(dialogs, labels=labels, batch_size=batch_size,
+                                     mimic_starting_response=mimic_starting_response)
         divided_dialogs = _divide_list_into_sublists(dialogs, self.device_count, batch_size)
         dialog_input = []
         for dialogs in divided_dialogs:
             prompt_tokens = []
             for dialog in dialogs:
-                if dialog[0]["role"] != "system":
-                    dialog = [
-                        {
-                            "role": "system",
-                            "content": DEFAULT_SYSTEM_PROMPT,
-                        }
-                    ] + dialog
-                dialog = [
-                    {
-                        "role": dialog[1]["role"],
-                        "content": B_SYS
-                        + dialog[0]["content"]
-                        + E_SYS
-                        + dialog[1]["content"],
-                    }
-                ] + dialog[2:]
-                dialog_tokens: str = "".join(
-                    [
-                        f"{B_INST} {(prompt['content']).strip()} {E_INST} {(answer['content']).strip()} "
-                        for prompt, answer in zip(
-                            dialog[::2],
-                            dialog[1::2],
-                        )
-                    ]
-                )
-                dialog_tokens += f"{B_INST} {(dialog[-1]['content']).strip()} {E_INST} {mimic_starting_response}"
-                assert all([msg["role"] == "user" for msg in dialog[::2]]) and all(
-                    [msg["role"] == "assistant" for msg in dialog[1::2]]
-                ), (
-                    "model only supports 'system', 'user' and 'assistant' roles, "
-                    "starting with 'system', then 'user' and alternating (u/a/u/a/u...)"
-                )
-                assert (
-                    dialog[-1]["role"] == "user"
-                ), f"Last message must be from user, got {dialog[-1]['role']}"
+                dialog_tokens = _format_dialog(dialog, mimic_starting_response)
                 prompt_tokens.append(dialog_tokens)
                 logger.debug(dialog_tokens)
             dialog_input.append(prompt_tokens)
-        if return_prob:
-            raise("Not implemented yet")
-            # assert calc_str is not None
-            # input_ids = self.tokenizer.encode(
-            #     prompt_tokens[0] + " " + calc_str,
-            #     return_tensors="pt")
-            # str_encoded = self.tokenizer.encode(
-            #     calc_str, return_tensors="pt")[0]
-            # if self.use_cuda:
-            #     input_ids = input_ids.cuda(0)
-            #     str_encoded = str_encoded.cuda(0)
-            # res = self.model(input_ids).logits[0][-1-len(str_encoded):-1]
-            # res = torch.gather(torch.softmax(res, dim=-1), 1, str_encoded.unsqueeze(1))
-            # res = torch.sum(torch.log(res)) / len(str_encoded)
-            # return res.cpu().item()
-        else:
-            generated_results = []
-            import time
-            with concurrent.futures.ThreadPoolExecutor(max_workers=self.device_count) as executor:
-                futures = []
-                for i in range(self.device_count):
-                    if len(dialog_input[i]) > 0:
-                        futures.append(
-                            executor.submit(
-                                self.pipeline[i], 
-                                dialog_input[i], 
-                                temperature=temperature, 
-                                top_p=top_p, 
-                                max_length=max_gen_len, 
-                                return_full_text=False,
-                                batch_size=batch_size,
-                            )
+        generated_results = []
+        with concurrent.futures.ThreadPoolExecutor(max_workers=self.device_count) as executor:
+            futures = []
+            for i in range(self.device_count):
+                if len(dialog_input[i]) > 0:
+                    run = partial(
+                        _run_pipeline,
+                        self.pipeline[i],
+                        temperature=temperature,
+                        top_p=top_p,
+                        max_new_tokens=max_gen_len,
+                        return_full_text=False,
+                    )
+                    futures.append(
+                        executor.submit(
+                            run_batched,
+                            run,
+                            dialog_input[i],
+                            self._token_lengths(dialog_input[i]),
+                            batch_size,
+                            meter=self.padding,
                         )
-                for future in futures:
-                    generated_results += future.result()
-            for pipeline in self.pipeline:
-                pipeline.call_count=0
-            return generated_results
+                    )
+            for future in futures:
+                generated_results += future.result()
+        for pipeline in self.pipeline:
+            pipeline.call_count=0
+        logger.info("padding: {stats}".format(stats=self.padding.state()))
+        return generated_results
+
+    def padding_stats(self):
+        return self.padding.state()
+
+    def _token_lengths(self, prompts):
+        return [len(ids) for ids in self.tokenizer(prompts)["input_ids"]]
+
+    def label_ids(self, labels):
+        """Token id each label starts with; labels are told apart by their first token."""
+        ids = [self.tokenizer(label, add_special_tokens=False)["input_ids"][0] for label in labels]
+        assert len(set(ids)) == len(ids), "labels {} share their first token".format(labels)
+        return ids
+
+    def prefix_cache_stats(self):
+        with self._prefix_lock:
+            return dict(self._prefix_stats)
+
+    def _prefix_kv(self, device, prefix_ids):
+        """KV cache of `prefix_ids` (1 x L) on one device, computed once and kept in an LRU."""
+        model = self.model[device]
+        cache = self._prefix_caches[device]
+        key = tuple(prefix_ids[0].tolist())
+        # held while computing, so concurrent callers wait for one computation instead of repeating it;
+        # callers keep their entry even if it is evicted afterwards
+        with self._prefix_cache_locks[device]:
+            if key in cache:
+                cache.move_to_end(key)
+                return cache[key], True
+            start = time.perf_counter()
+            outputs = model(input_ids=prefix_ids.to(model.device), use_cache=True)
+            past = outputs.past_key_values
+            entry = {
+                "past": past.to_legacy_cache() if hasattr(past, "to_legacy_cache") else past,
+                "seconds": time.perf_counter() - start,
+            }
+            cache[key] = entry
+            if len(cache) > LLAMA_PREFIX_CACHE_SIZE:
+                cache.popitem(last=False)
+            return entry, False
+
+    def _forward(self, model, prompts):
+        inputs = self.tokenizer(prompts, return_tensors="pt", padding=True).to(model.device)
+        # positions count from the first real token of each left-padded row
+        position_ids = (inputs["attention_mask"].cumsum(dim=1) - 1).clamp(min=0)
+        outputs = model(**inputs, position_ids=position_ids, use_cache=True)
+        return outputs.logits[:, -1, :], outputs.past_key_values, inputs["attention_mask"]
+
+    def _forward_with_prefix(self, device, prefix, prompts):
+        """Run only the part of each prompt after `prefix`, on top of the prefix's cached keys and values."""
+        model = self.model[device]
+        prefix_tokens = self.tokenizer(prefix)["input_ids"]
+        rows = [self.tokenizer(prompt)["input_ids"] for prompt in prompts]
+        # split where every row's own tokenization still matches the prefix, leaving each row a token
+        length = len(prefix_tokens)
+        for row in rows:
+            common = 0
+            while common < min(length, len(row) - 1) and row[common] == prefix_tokens[common]:
+                common += 1
+            length = common
+        if length == 0:
+            return self._forward(model, prompts)
+        entry, hit = self._prefix_kv(device, torch.tensor([prefix_tokens[:length]]))
+
+        suffixes = [row[length:] for row in rows]
+        width = max(len(suffix) for suffix in suffixes)
+        pad = self.tokenizer.pad_token_id
+        input_ids = torch.tensor([[pad] * (width - len(suffix)) + suffix for suffix in suffixes], device=model.device)
+        suffix_mask = torch.tensor([[0] * (width - len(suffix)) + [1] * len(suffix) for suffix in suffixes],
+                                   device=model.device)
+        # padding sits between prefix and suffix; it is masked out and skipped by the positions
+        attention_mask = torch.cat([suffix_mask.new_ones(len(rows), length), suffix_mask], dim=1)
+        position_ids = (attention_mask.cumsum(dim=1) - 1)[:, length:]
+        past = tuple((key.expand(len(rows), -1, -1, -1), value.expand(len(rows), -1, -1, -1))
+                     for key, value in entry["past"])
+        if DynamicCache is not None:
+            past = DynamicCache.from_legacy_cache(past)
+        outputs = model(input_ids=input_ids, attention_mask=attention_mask, position_ids=position_ids,
+                        past_key_values=past, use_cache=True)
+
+        with self._prefix_lock:
+            stats = self._prefix_stats
+            stats["hits" if hit else "misses"] += 1
+            stats["rows"] += len(rows)
+            stats["reused_tokens"] += length * (len(rows) if hit else len(rows) - 1)
+            stats["suffix_tokens"] += sum(len(suffix) for suffix in suffixes)
+            # what recomputing the prefix for each of these rows would have cost
+            stats["time_saved"] += entry["seconds"] * (len(rows) if hit else len(rows) - 1)
+        return outputs.logits[:, -1, :], outputs.past_key_values, attention_mask
+
+    def _forward_batches(self, device, dialogs, batch_size, mimic_starting_response=''):
+        """Yield (indices, last-token logits, past_key_values, attention_mask) per batch of `dialogs`.
+
+        Dialogs with the same system prompt (question + few-shot examples) are
+        batched together so their shared prefix is computed only once.
+        """
+        groups = {}
+        for index, dialog in enumerate(dialogs):
+            groups.setdefault(_system_prefix(dialog), []).append(index)
+        for prefix, indices in groups.items():
+            # the label is the next word, so the prompt must not end with the space before it
+            group_prompts = [_format_dialog(dialogs[j], mimic_starting_response).rstrip() for j in indices]
+            lengths = self._token_lengths(group_prompts)
+            if self.use_prefix_cache:
+                # only the part after the cached prefix is padded and run
+                prefix_length = len(self.tokenizer(prefix)["input_ids"])
+                lengths = [max(1, length - prefix_length) for length in lengths]
+            for planned in plan_batches(lengths, batch_size):
+                self.padding.record([lengths[k] for k in planned])
+                batch = [indices[k] for k in planned]
+                prompts = [group_prompts[k] for k in planned]
+                if self.use_prefix_cache:
+                    yield (batch,) + self._forward_with_prefix(device, prefix, prompts)
+                else:
+                    yield (batch,) + self._forward(self.model[device], prompts)
+
+    @torch.no_grad()
+    def _score_batches(self, device, dialogs, label_ids, batch_size, mimic_starting_response):
+        probs = [None] * len(dialogs)
+        for batch, logits, _, _ in self._forward_batches(device, dialogs, batch_size, mimic_starting_response):
+            for j, prob in zip(batch, F.softmax(logits[:, label_ids].to(torch.float32), dim=1).cpu()):
+                probs[j] = prob
+        return torch.stack(probs)
+
+    @torch.no_grad()
+    def _generate_label_batches(self, device, dialogs, trie, batch_size, mimic_starting_response):
+        texts = [None] * len(dialogs)
+        for batch, logits, past, attention_mask in self._forward_batches(device, dialogs, batch_size,
+                                                                         mimic_starting_response):
+            for j, text in zip(batch, decode_labels(self.model[device], trie, logits, past, attention_mask)):
+                texts[j] = text
+        return texts
+
+    def _run_on_devices(self, worker, dialogs, batch_size, *args):
+        divided_dialogs = _divide_list_into_sublists(dialogs, self.device_count, batch_size)
+        with concurrent.futures.ThreadPoolExecutor(max_workers=self.device_count) as executor:
+            futures = [
+                executor.submit(worker, device, part, *args)
+                for device, part in enumerate(divided_dialogs) if len(part) > 0
+            ]
+            results = [future.result() for future in futures]
+        if self.use_prefix_cache:
+            logger.info("prefix cache: {stats}".format(stats=self.prefix_cache_stats()))
+        logger.info("padding: {stats}".format(stats=self.padding.state()))
+        return results
+
+    def score_labels(self, dialogs, labels=None, batch_size=40, mimic_starting_response=''):
+        """Label probabilities from the next-token logits at the end of each prompt.
+
+        Returns (texts, probs): the most likely label of each dialog and a
+        len(dialogs) x len(labels) tensor, as `FlanT5Wrapper.score_labels` does.
+        """
+        labels = labels or LABEL_SPACE
+        label_ids = self.label_ids(labels)
+        if len(dialogs) == 0:
+            return [], torch.empty(0, len(labels))
+        probs = torch.cat(self._run_on_devices(self._score_batches, dialogs, batch_size,
+                                               label_ids, batch_size, mimic_starting_response), dim=0)
+        texts = [labels[i] for i in probs.argmax(dim=1).tolist()]
+        return texts, probs
+
+    def generate_labels(self, dialogs, labels=None, batch_size=40, mimic_starting_response=''):
+        """Greedy answers restricted to `labels`; decoding stops once each answer is a full label."""
+        trie = LabelTrie(self.tokenizer, labels or LABEL_SPACE)
+        results = self._run_on_devices(self._generate_label_batches, dialogs, batch_size,
+                                       trie, batch_size, mimic_starting_response)
+        return [text for texts in results for text in texts]
+
 
 # class Llama2Wrapper:
 #     def __init__(
@@ -359,4 +588,37 @@ class Llama2Wrapper:
 #                 batch_size=batch_size,
 #                 do_sample=True
 #             )
-#             return generated_results
\ No newline at end of file
+#             return generated_results
+
+if __name__ == "__main__":
+    # scoring and prefix cache smoke test on the CPU with a tiny random-weight Llama
+    from transformers import LlamaConfig, LlamaForCausalLM
+
+    parser = argparse.ArgumentParser(description="Score yes/no labels with a tiny random-weight Llama on the CPU.")
+    parser.add_argument("--tokenizer", type=str, default="hf-internal-testing/llama-tokenizer")
+    args = parser.parse_args()
+    tokenizer = AutoTokenizer.from_pretrained(args.tokenizer)
+    config = LlamaConfig(vocab_size=len(tokenizer), hidden_size=32, intermediate_size=64,
+                         num_hidden_layers=2, num_attention_heads=4)
+    wrapper = Llama2Wrapper("tiny-llama", is_chat_model=True, model=LlamaForCausalLM(config), tokenizer=tokenizer)
+    dialogs = [
+        [
+            {"role": "system", "content": "Does the text mention anything about age? Answer ONLY yes or no."},
+            {"role": "user", "content": "Text: {text}\nAnswer:".format(text=text)},
+        ] for text in ["A young man and his parents met.", "The meeting started late.", "Hi"]
+    ]
+    texts, probs = wrapper.score_labels(dialogs, batch_size=2)
+    assert probs.shape == (len(dialogs), len(LABEL_SPACE))
+    assert torch.allclose(probs.sum(dim=1), torch.ones(len(dialogs)))
+    # left padding must not change a prompt's scores
+    _, single = wrapper.score_labels(dialogs[2:], batch_size=1)
+    assert torch.allclose(probs[2], single[0], atol=1e-5)
+    # the shared-prefix KV cache must not change scores or answers either
+    wrapper.use_prefix_cache = False
+    uncached_texts, uncached_probs = wrapper.score_labels(dialogs, batch_size=2)
+    assert torch.allclose(probs, uncached_probs, atol=1e-5)
+    assert wrapper.generate_labels(dialogs, batch_size=2) == uncached_texts
+    wrapper.use_prefix_cache = True
+    assert wrapper.generate_labels(dialogs, batch_size=2) == uncached_texts
+    logger.info("prefix cache: {stats}".format(stats=wrapper.prefix_cache_stats()))
+    logger.info("texts = {texts}, probs = {probs}".format(texts=texts, probs=probs))
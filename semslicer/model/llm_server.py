@@ -1,33 +1,72 @@
+import time
 import torch
 from .llama import Llama2Wrapper
-from .t5 import FlanT5Wrapper
+from .t5 import FlanT5Wrapper, T5_SCORING_MODE
 from transformers import T5Tokenizer, T5ForConditionalGeneration, pipeline
 from .openai import OpenAIModel
+from .dummy import DummyModel
+from .query_utils import OPENAI_MODELS
+from .registry import register_backend, create_backend, get_endpoint_pool
+from .cache_store import digest_key, query_cache_enabled
+from .inflight import run_coalesced
+from .hedging import LatencyTracker, call_with_deadline, HEDGE_PERCENTILE
+from .metering import METER, collect_usage, count_text_tokens
+from .constrained import CONSTRAINED_DECODING, cap_new_tokens
+
+# API retries for deadline-bound calls; the default 100 retries can outlive any deadline
+DEADLINE_RETRY = 3
+
+
+# built-in backends, tried in this order; models listed under MODEL.ENDPOINTS take precedence
+@register_backend("openai", lambda model_name: get_endpoint_pool(model_name) is not None)
+def _openai_compatible_backend(model_name, model_size='', batch_size=10, use_cache=False):
+    return OpenAIModel(model_name, use_cache=use_cache, endpoints=get_endpoint_pool(model_name))
+
+
+@register_backend("llama", lambda model_name: model_name == 'llama2')
+def _llama_backend(model_name, model_size='', batch_size=10, use_cache=False):
+    return Llama2Wrapper(
+        "meta-llama/Llama-2-{}-hf".format(model_size),
+        is_chat_model=True,
+        load_4bit=True,
+        batch_size=batch_size
+    )
+
+
+@register_backend("t5", lambda model_name: 'flan-t5' in model_name)
+def _t5_backend(model_name, model_size='', batch_size=10, use_cache=False):
+    return FlanT5Wrapper(
+        f"google/{model_name}",
+        is_chat_model=True,
+        load_4bit=True,
+        batch_size=batch_size
+    )
+
+
+@register_backend("openai", lambda model_name: model_name in OPENAI_MODELS)
+def _openai_backend(model_name, model_size='', batch_size=10, use_cache=False):
+    return OpenAIModel(model_name, use_cache=use_cache)
+
+
+@register_backend("dummy", lambda model_name: model_name == 'dummy')
+def _dummy_backend(model_name, model_size='', batch_size=10, use_cache=False):
+    return DummyModel(model_name)
+
 
 class Generator:
 
-    def __init__(self, model_name, model_size='', batch_size=10):
+    def __init__(self, model_name, model_size='', batch_size=10, use_cache=None):
+        """use_cache: read and write the response cache; None follows QUERY_CACHE / MODEL.USE_CACHE."""
+        if use_cache is None:
+            use_cache = query_cache_enabled()
         self.model_name = model_name
         self.model_size = model_size
-        if model_name == 'llama2':
-            try:
-                self.generator = Llama2Wrapper(
-                    "meta-llama/Llama-2-{}-hf".format(model_size),
-                    is_chat_model=True,
-                    load_4bit=True,
-                    batch_size=batch_size
-                )
-            except:
-                assert False
-        if 'flan-t5' in model_name:
-            self.generator = FlanT5Wrapper(
-                    f"google/{model_name}",
-                    is_chat_model=True,
-                    load_4bit=True,
-                    batch_size=batch_size
-            )
-        if model_name in ['gpt-3.5-turbo', 'gpt-4-turbo-preview']:
-            self.generator = OpenAIModel(model_name)
+        # latencies of deadline-bound / hedged calls
+        self.latency = LatencyTracker()
+        self.backend_kind, self.generator = create_backend(
+            model_name, model_size=model_size, batch_size=batch_size, use_cache=use_cache)
+        if self.backend_kind is None:
+            raise ValueError("no backend registered for model {}".format(model_name))
 
     def _send_request(
         self,
@@ -39,12 +78,105 @@ class Generator:
         return_probs=False,
         labels=None,
         mimic_starting_response='',
+        deadline=None,
+        hedge=False,
+        task=None,
     ):
         '''
         example for dialogs:[[{"role": "user", "content": "what is the recipe of mayonnaise?"}]]
+
+        task: "label", "rationale" or "paraphrase"; caps new tokens on local models, and "label"
+            restricts their answers to `labels` (see semslicer.model.constrained)
+
+        deadline: raise TimeoutError if no answer within this many seconds
+        hedge: send a duplicate once the call runs past the p95 of recent latencies; first answer wins
         '''
+        kwargs = dict(max_gen_len=max_gen_len, temperature=temperature, top_p=top_p, batch_size=batch_size,
+                      return_probs=return_probs, labels=labels, mimic_starting_response=mimic_starting_response,
+                      task=task)
+        start = time.monotonic()
+        with collect_usage() as reported:
+            if deadline is None and not hedge:
+                results = self._send_request_once(dialogs, **kwargs)
+            else:
+                hedge_after = self.latency.percentile(HEDGE_PERCENTILE) if hedge else None
+                results = call_with_deadline(
+                    lambda attempt: self._send_request_once(dialogs, attempt=attempt, retry=DEADLINE_RETRY, **kwargs),
+                    deadline=deadline,
+                    hedge_after=hedge_after,
+                    tracker=self.latency,
+                )
+        self._record_usage(dialogs, results[0] if return_probs else results, time.monotonic() - start, reported)
+        return results
+
+    def _record_usage(self, dialogs, texts, wall_time, reported):
+        if self.backend_kind == "openai":
+            # the API reports actual token counts; cache hits and coalesced requests cost nothing
+            prompt_tokens, completion_tokens = reported["prompt_tokens"], reported["completion_tokens"]
+        else:
+            prompt_tokens = self.compute_total_tokens(dialogs)
+            completion_tokens = sum(self.count_tokens([text for text in texts if isinstance(text, str)]))
+        METER.record(self.model_name, len(dialogs), prompt_tokens, completion_tokens, wall_time,
+                     cache_hits=reported["cache_hits"], cached_tokens=reported["cached_tokens"])
+
+    def latency_stats(self):
+        """p50/p95/p99 (seconds) of recent deadline-bound or hedged calls."""
+        return self.latency.stats()
+
+    def _send_request_once(self, dialogs, attempt=0, retry=100, **kwargs):
+        return_probs = kwargs["return_probs"]
+        if self.backend_kind == "openai":
+            # query_batch already coalesces in-flight API requests; hedged duplicates opt out
+            return self._dispatch(dialogs, retry=retry, coalesce=(attempt == 0), **kwargs)
+        if attempt > 0:
+            return self._dispatch(dialogs, **kwargs)
+
+        # identical dialogs pending in other threads are awaited instead of recomputed
+        params = {k: v for k, v in kwargs.items() if k != 'batch_size'}
+        keys = [digest_key((self.model_name, self.model_size, dialog, params)) for dialog in dialogs]
+        key2dialog = dict(zip(keys, dialogs))
+
+        def compute(owned_keys):
+            owned_dialogs = [key2dialog[key] for key in owned_keys]
+            results = self._dispatch(owned_dialogs, **kwargs)
+            if return_probs:
+                texts, probs = results
+                return list(zip(texts, probs))
+            return results
+
+        results = run_coalesced(keys, compute)
+        if return_probs:
+            texts = [text for text, _ in results]
+            probs = torch.stack([prob for _, prob in results]) if len(results) > 0 else torch.empty(0)
+            return texts, probs
+        return results
+
+    def _dispatch(
+        self,
+        dialogs,
+        max_gen_len=1024,
+        temperature=0.01,
+        top_p=0.9,
+        batch_size=10,
+        return_probs=False,
+        labels=None,
+        mimic_starting_response='',
+        retry=100,
+        coalesce=True,
+        task=None,
+    ):
         results = []
-        if self.model_name == 'llama2':
+        if self.backend_kind in ["t5", "llama"]:
+            max_gen_len = cap_new_tokens(task, max_gen_len)
+            if task == "label" and CONSTRAINED_DECODING and not return_probs:
+                if self.backend_kind == "llama":
+                    return self.generator.generate_labels(dialogs, labels=labels, batch_size=batch_size,
+                                                          mimic_starting_response=mimic_starting_response)
+                return self.generator.generate_labels(dialogs, labels=labels, batch_size=batch_size)
+        if self.backend_kind == "llama":
+            if return_probs:
+                return self.generator.score_labels(dialogs, labels=labels, batch_size=batch_size,
+                                                   mimic_starting_response=mimic_starting_response)
             results = self.generator.chat_completion(
                 dialogs,
                 max_gen_len=max_gen_len,
@@ -54,7 +186,9 @@ class Generator:
                 mimic_starting_response=mimic_starting_response
             )
             return [result[0]['generated_text'].strip() for result in results]
-        if 'flan-t5' in self.model_name:
+        if self.backend_kind == "t5":
+            if return_probs and T5_SCORING_MODE == "single_step":
+                return self.generator.score_labels(dialogs, labels=labels, batch_size=batch_size)
             results = self.generator.completion(
                 dialogs, 
                 max_gen_len=max_gen_len,
@@ -70,7 +204,9 @@ class Generator:
                 return texts, probs
             else:
                 return texts
-        if self.model_name in ['gpt-3.5-turbo', 'gpt-4-turbo-preview']:
+        if self.backend_kind == "dummy":
+            return self.generator.completion(dialogs, return_prob=return_probs, labels=labels)
+        if self.backend_kind == "openai":
             results = self.generator._send_request(
                 dialogs,
                 batch_size=batch_size,
@@ -79,22 +215,39 @@ class Generator:
                 top_p=top_p,
                 return_probs=return_probs,
                 labels=labels,
-                mimic_starting_response=mimic_starting_response
+                mimic_starting_response=mimic_starting_response,
+                retry=retry,
+                coalesce=coalesce,
             )
             return results
 
         return results
 
+    def batch_requests(self, dialogs, temperature=0.01):
+        """Batch API requests matching what `_send_request(dialogs, temperature=...)` would send."""
+        if self.backend_kind == "openai":
+            return self.generator.batch_requests(dialogs, temperature=temperature)
+        raise NotImplementedError("batch execution is not supported for {}".format(self.model_name))
+
+    def padding_stats(self):
+        """Real vs padded tokens of local-model batches; None for API backends."""
+        if self.backend_kind in ["t5", "llama"]:
+            return self.generator.padding_stats()
+        return None
+
+    def count_tokens(self, texts):
+        """Tokens of each text, with the model's own tokenizer where there is one."""
+        if self.backend_kind in ["t5", "llama"]:
+            return [len(self.generator.tokenizer.encode(text)) for text in texts]
+        return [count_text_tokens(self.model_name, text) for text in texts]
+
     def compute_total_tokens(self, dialogs):
-        if 'flan-t5' in self.model_name:
-            dialog_inputs = [dialog[0]["content"] + '\n' + dialog[1]["content"] for dialog in dialogs]
-            return sum([len(self.generator.tokenizer.encode(dialog)) for dialog in dialog_inputs])
-        else:
-            return None
-        
+        dialog_inputs = ['\n'.join(message["content"] for message in dialog) for dialog in dialogs]
+        return sum(self.count_tokens(dialog_inputs))
+
 
 if __name__ == "__main__":
-    generator = Generator('flan-t5', 'large')
+    generator = Generator('flan-t5-large')
 
     input_template = """Text: {text}
 Answer:"""
@@ -0,0 +1,140 @@
+import contextvars
+import csv
+import os
+import threading
+from contextlib import contextmanager
+from ..utils.log import get_logger
+
+try:
+    import tiktoken
+except ImportError:
+    tiktoken = None
+
+logger = get_logger("INFO", "metering")
+
+# USD per 1K (prompt, completion) tokens
+COST_PER_1K_TOKENS = {
+    "gpt-3.5-turbo": (0.0005, 0.0015),
+    "gpt-4-turbo-preview": (0.01, 0.03),
+}
+# cached prompt tokens (prefix caching) are billed at this fraction of the prompt price
+CACHED_TOKEN_PRICE = 0.5
+# USD per hour of wall time for local models (e.g. the GPU price), 0 = not counted
+LOCAL_COST_PER_HOUR = float(os.environ.get("LOCAL_COST_PER_HOUR", 0))
+USAGE_SUMMARY_FILE = "usage_summary.csv"
+SUMMARY_FIELDS = ["stage", "keyword", "model", "calls", "requests", "cache_hits",
+                  "prompt_tokens", "cached_tokens", "completion_tokens", "wall_time", "cost"]
+
+_stage = contextvars.ContextVar("metering_stage", default=("other", None))
+# usage reported by the backend (e.g. API token counts) for the call being measured
+_reported = contextvars.ContextVar("metering_reported", default=None)
+_encodings = {}
+
+
+def count_text_tokens(model_name, text):
+    """Tokens in `text` with the model's tiktoken encoding, or a 4-characters-per-token estimate."""
+    if tiktoken is not None:
+        if model_name not in _encodings:
+            try:
+                _encodings[model_name] = tiktoken.encoding_for_model(model_name)
+            except KeyError:
+                _encodings[model_name] = None
+        if _encodings[model_name] is not None:
+            return len(_encodings[model_name].encode(text))
+    return len(text) // 4
+
+
+def estimate_cost(model_name, prompt_tokens, completion_tokens, wall_time, cached_tokens=0):
+    if model_name in COST_PER_1K_TOKENS:
+        prompt_price, completion_price = COST_PER_1K_TOKENS[model_name]
+        billed_prompt_tokens = prompt_tokens - cached_tokens * (1 - CACHED_TOKEN_PRICE)
+        return (billed_prompt_tokens * prompt_price + completion_tokens * completion_price) / 1000
+    return wall_time / 3600 * LOCAL_COST_PER_HOUR
+
+
+@contextmanager
+def stage(name, keyword=None):
+    """Tag model calls in this block with a pipeline stage (and keyword, inherited if not given)."""
+    _, outer_keyword = _stage.get()
+    token = _stage.set((name, keyword if keyword is not None else outer_keyword))
+    try:
+        yield
+    finally:
+        _stage.reset(token)
+
+
+@contextmanager
+def collect_usage():
+    """Collect usage reported by backends (see `report_usage`) during one measured call."""
+    reported = {"cache_hits": 0, "prompt_tokens": 0, "completion_tokens": 0, "cached_tokens": 0, "api_requests": 0}
+    token = _reported.set(reported)
+    try:
+        yield reported
+    finally:
+        _reported.reset(token)
+
+
+def report_usage(cache_hits=0, prompt_tokens=0, completion_tokens=0, cached_tokens=0, api_requests=0):
+    """Called by backends that know actual usage; ignored outside `collect_usage`."""
+    reported = _reported.get()
+    if reported is None:
+        return
+    reported["cache_hits"] += cache_hits
+    reported["prompt_tokens"] += prompt_tokens
+    reported["completion_tokens"] += completion_tokens
+    reported["cached_tokens"] += cached_tokens
+    reported["api_requests"] += api_requests
+
+
+class Meter:
+    """Usage totals per (stage, keyword, model)."""
+
+    def __init__(self):
+        self._totals = {}
+        self._lock = threading.Lock()
+
+    def record(self, model_name, requests, prompt_tokens, completion_tokens, wall_time, cache_hits=0, cached_tokens=0):
+        stage_name, keyword = _stage.get()
+        cost = estimate_cost(model_name, prompt_tokens, completion_tokens, wall_time, cached_tokens=cached_tokens)
+        with self._lock:
+            totals = self._totals.setdefault((stage_name, keyword or "", model_name), {
+                "calls": 0, "requests": 0, "cache_hits": 0, "prompt_tokens": 0, "cached_tokens": 0,
+                "completion_tokens": 0, "wall_time": 0.0, "cost": 0.0,
+            })
+            totals["calls"] += 1
+            totals["requests"] += requests
+            totals["cache_hits"] += cache_hits
+            totals["prompt_tokens"] += prompt_tokens
+            totals["cached_tokens"] += cached_tokens
+            totals["completion_tokens"] += completion_tokens
+            totals["wall_time"] += wall_time
+            totals["cost"] += cost
+
+    def rows(self):
+        with self._lock:
+            return [dict(stage=stage_name, keyword=keyword, model=model_name, **totals)
+                    for (stage_name, keyword, model_name), totals in sorted(self._totals.items())]
+
+    def total(self):
+        total = {"requests": 0, "cache_hits": 0, "prompt_tokens": 0, "cached_tokens": 0, "completion_tokens": 0,
+                 "wall_time": 0.0, "cost": 0.0}
+        for row in self.rows():
+            for name in total:
+                total[name] += row[name]
+        return total
+
+    def write_summary(self, path):
+        rows = self.rows()
+        with open(path, "w", newline="") as f:
+            writer = csv.DictWriter(f, fieldnames=SUMMARY_FIELDS)
+            writer.writeheader()
+            for row in rows:
+                writer.writerow(dict(row, wall_time=round(row["wall_time"], 3), cost=round(row["cost"], 6)))
+        logger.info("usage: {total}; per stage in {path}".format(total=self.total(), path=path))
+
+    def reset(self):
+        with self._lock:
+            self._totals.clear()
+
+
+METER = Meter()
@@ -0,0 +1,339 @@
+import argparse
+import json
+import math
+import random
+import threading
+import time
+import uuid
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from ..utils.log import get_logger
+from .batch_api import local_answer
+from .rate_limit import TokenBucket, estimate_tokens
+
+try:
+    import pytest
+except ImportError:
+    pytest = None
+
+logger = get_logger("INFO", "mock_server")
+
+MOCK_HOST = "127.0.0.1"
+CHAT_PATHS = {"/v1/chat/completions", "/chat/completions"}
+LATENCY_DISTRIBUTIONS = ["fixed", "uniform", "exponential", "lognormal"]
+# probability mass the mock puts on its answer in returned logprobs
+ANSWER_PROB = 0.9
+
+
+class MockConfig:
+    """Behaviour of the mock server; every field but `seed` can be changed while it is running.
+
+    latency: seconds per request, drawn from `latency_dist` with mean `latency_mean`
+        (`latency_spread` is the half-width for uniform and sigma for lognormal)
+    error_429_rate / error_5xx_rate / timeout_rate: fraction of requests failing that way
+    timeout_seconds: how long a "timed out" request hangs before the connection is dropped
+    rpm / tpm: rate limits enforced and reported in x-ratelimit-* headers (0 = unlimited)
+    """
+
+    def __init__(
+        self,
+        latency_dist="fixed",
+        latency_mean=0.05,
+        latency_spread=0.5,
+        error_429_rate=0.0,
+        error_5xx_rate=0.0,
+        timeout_rate=0.0,
+        timeout_seconds=120.0,
+        rpm=0,
+        tpm=0,
+        seed=0,
+    ):
+        assert latency_dist in LATENCY_DISTRIBUTIONS
+        self.latency_dist = latency_dist
+        self.latency_mean = latency_mean
+        self.latency_spread = latency_spread
+        self.error_429_rate = error_429_rate
+        self.error_5xx_rate = error_5xx_rate
+        self.timeout_rate = timeout_rate
+        self.timeout_seconds = timeout_seconds
+        self.rpm = rpm
+        self.tpm = tpm
+        self.seed = seed
+
+    def sample_latency(self, rng):
+        if self.latency_dist == "fixed":
+            return self.latency_mean
+        if self.latency_dist == "uniform":
+            return max(0.0, rng.uniform(self.latency_mean - self.latency_spread, self.latency_mean + self.latency_spread))
+        if self.latency_dist == "exponential":
+            return rng.expovariate(1.0 / self.latency_mean) if self.latency_mean > 0 else 0.0
+        # lognormal with the given mean, so long tails can be simulated with a large spread
+        mu = math.log(max(self.latency_mean, 1e-6)) - self.latency_spread ** 2 / 2
+        return rng.lognormvariate(mu, self.latency_spread)
+
+
+class MockOpenAIServer(ThreadingHTTPServer):
+    """OpenAI-compatible chat completions server for offline load and fault testing.
+
+    Answers are yes/no, derived deterministically from the messages (the same rule as
+    the local batch backend), so cached and uncached runs can be compared.
+    """
+
+    daemon_threads = True
+
+    def __init__(self, config=None, host=MOCK_HOST, port=0):
+        super().__init__((host, port), _MockHandler)
+        self.config = config if config is not None else MockConfig()
+        self._rng = random.Random(self.config.seed)
+        self._lock = threading.Lock()
+        self._limits = None
+        self._sync_limits()
+        self._thread = None
+        self._prefixes = set()
+        self.reset_stats()
+
+    @property
+    def base_url(self):
+        host, port = self.server_address[:2]
+        return "http://{host}:{port}/v1".format(host=host, port=port)
+
+    def _sync_limits(self):
+        """Rebuild the rate-limit buckets when `config.rpm` / `config.tpm` changed (full buckets)."""
+        limits = (self.config.rpm, self.config.tpm)
+        if limits != self._limits:
+            self._limits = limits
+            self._requests = TokenBucket(self.config.rpm) if self.config.rpm > 0 else None
+            self._tokens = TokenBucket(self.config.tpm) if self.config.tpm > 0 else None
+
+    def reset_stats(self):
+        with self._lock:
+            self.counts = {"requests": 0, "ok": 0, "429": 0, "5xx": 0, "timeout": 0}
+            self.in_flight = 0
+            self.max_in_flight = 0
+
+    def stats(self):
+        with self._lock:
+            return dict(self.counts, in_flight=self.in_flight, max_in_flight=self.max_in_flight)
+
+    def start(self):
+        self._thread = threading.Thread(target=self.serve_forever, daemon=True)
+        self._thread.start()
+        logger.info("mock OpenAI server listening on {url}".format(url=self.base_url))
+        return self
+
+    def stop(self):
+        self.shutdown()
+        self.server_close()
+        if self._thread is not None:
+            self._thread.join()
+
+    def _begin(self, tokens):
+        """Pick the outcome of one request: ("ok" | "429" | "5xx" | "timeout", latency, retry_after)."""
+        config = self.config
+        with self._lock:
+            self.counts["requests"] += 1
+            self.in_flight += 1
+            self.max_in_flight = max(self.max_in_flight, self.in_flight)
+            latency = config.sample_latency(self._rng)
+            draw = self._rng.random()
+            now = time.monotonic()
+            self._sync_limits()
+            for bucket, amount in [(self._requests, 1), (self._tokens, tokens)]:
+                if bucket is None:
+                    continue
+                wait = bucket.reserve(amount, now)
+                if wait > 0:
+                    bucket.refund(amount, now)
+                    return "429", 0.0, wait
+        if draw < config.error_429_rate:
+            return "429", latency, 1.0
+        draw -= config.error_429_rate
+        if draw < config.error_5xx_rate:
+            return "5xx", latency, None
+        draw -= config.error_5xx_rate
+        if draw < config.timeout_rate:
+            return "timeout", config.timeout_seconds, None
+        return "ok", latency, None
+
+    def _end(self, outcome):
+        with self._lock:
+            self.in_flight -= 1
+            self.counts[outcome] += 1
+
+    def cached_prefix_tokens(self, request):
+        """Simulated prefix cache: a system prompt seen in an earlier request counts as cached."""
+        messages = request["messages"]
+        if len(messages) < 2 or messages[0]["role"] != "system":
+            return 0
+        key = messages[0]["content"]
+        with self._lock:
+            hit = key in self._prefixes
+            self._prefixes.add(key)
+        return estimate_tokens(messages[:1], max_tokens=0) if hit else 0
+
+    def rate_limit_headers(self):
+        headers = {}
+        with self._lock:
+            now = time.monotonic()
+            self._sync_limits()
+            for name, bucket in [("requests", self._requests), ("tokens", self._tokens)]:
+                if bucket is None:
+                    continue
+                bucket._refill(now)
+                remaining = max(0, int(bucket.level))
+                headers["x-ratelimit-limit-" + name] = str(int(bucket.capacity))
+                headers["x-ratelimit-remaining-" + name] = str(remaining)
+                reset = (bucket.capacity - bucket.level) * 60.0 / bucket.capacity
+                headers["x-ratelimit-reset-" + name] = "{:.0f}ms".format(max(0.0, reset) * 1000)
+        return headers
+
+
+def completion_body(request, answer=None, cached_tokens=0):
+    """Build a chat.completion response for `request` (a parsed request body)."""
+    answer = answer if answer is not None else local_answer(request)
+    prompt_tokens = estimate_tokens(request["messages"], max_tokens=0)
+    n = request.get("n", 1)
+    choices = []
+    for index in range(n):
+        choice = {
+            "index": index,
+            "message": {"role": "assistant", "content": answer},
+            "finish_reason": "stop",
+            "logprobs": None,
+        }
+        if request.get("logprobs"):
+            other = "no" if answer == "yes" else "yes"
+            top = [(answer, math.log(ANSWER_PROB)), (other, math.log(1 - ANSWER_PROB))]
+            top = top[:max(1, request.get("top_logprobs") or 1)]
+            choice["logprobs"] = {"content": [{
+                "token": answer,
+                "logprob": top[0][1],
+                "bytes": list(answer.encode("utf-8")),
+                "top_logprobs": [
+                    {"token": token, "logprob": logprob, "bytes": list(token.encode("utf-8"))}
+                    for token, logprob in top
+                ],
+            }]}
+        choices.append(choice)
+    return {
+        "id": "chatcmpl-mock-" + uuid.uuid4().hex[:12],
+        "object": "chat.completion",
+        "created": int(time.time()),
+        "model": request.get("model", "mock"),
+        "choices": choices,
+        "usage": {"prompt_tokens": prompt_tokens, "completion_tokens": n, "total_tokens": prompt_tokens + n,
+                  "prompt_tokens_details": {"cached_tokens": cached_tokens}},
+    }
+
+
+class _MockHandler(BaseHTTPRequestHandler):
+
+    protocol_version = "HTTP/1.1"
+
+    def log_message(self, format, *args):
+        pass
+
+    def _send_json(self, status, body, headers=None):
+        data = json.dumps(body).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(data)))
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(data)
+
+    def do_GET(self):
+        if self.path == "/stats":
+            self._send_json(200, self.server.stats())
+        else:
+            self._send_json(404, {"error": {"message": "not found", "type": "invalid_request_error"}})
+
+    def do_POST(self):
+        length = int(self.headers.get("Content-Length", 0))
+        request = json.loads(self.rfile.read(length) or b"{}")
+        if self.path not in CHAT_PATHS:
+            self._send_json(404, {"error": {"message": "not found", "type": "invalid_request_error"}})
+            return
+
+        server = self.server
+        outcome, latency, retry_after = server._begin(estimate_tokens(request["messages"], request.get("max_tokens")))
+        try:
+            time.sleep(latency)
+            if outcome == "timeout":
+                # drop the connection without answering
+                self.close_connection = True
+                return
+            headers = server.rate_limit_headers()
+            if outcome == "429":
+                headers["retry-after-ms"] = str(int(retry_after * 1000))
+                headers["retry-after"] = str(max(1, int(math.ceil(retry_after))))
+                self._send_json(429, {"error": {"message": "Rate limit reached (mock)", "type": "requests",
+                                                "code": "rate_limit_exceeded"}}, headers)
+            elif outcome == "5xx":
+                self._send_json(500, {"error": {"message": "Internal server error (mock)", "type": "server_error"}},
+                                headers)
+            else:
+                self._send_json(200, completion_body(request, cached_tokens=server.cached_prefix_tokens(request)), headers)
+        finally:
+            server._end(outcome)
+
+
+def start_server(config=None, host=MOCK_HOST, port=0):
+    """Start a mock server on a background thread; stop it with `server.stop()`."""
+    return MockOpenAIServer(config, host=host, port=port).start()
+
+
+if pytest is not None:
+
+    @pytest.fixture
+    def mock_openai_server():
+        """A running MockOpenAIServer; change `server.config` to inject latency or faults.
+
+        Enable with `pytest_plugins = ["semslicer.model.mock_server"]`.
+        """
+        server = start_server()
+        yield server
+        server.stop()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Serve a mock OpenAI chat completions API for load and fault testing.")
+    parser.add_argument("--host", type=str, default=MOCK_HOST)
+    parser.add_argument("--port", type=int, default=8000)
+    parser.add_argument("--latency_dist", type=str, default="fixed", choices=LATENCY_DISTRIBUTIONS)
+    parser.add_argument("--latency_mean", type=float, default=0.05, help="mean latency in seconds")
+    parser.add_argument("--latency_spread", type=float, default=0.5)
+    parser.add_argument("--error_429_rate", type=float, default=0.0)
+    parser.add_argument("--error_5xx_rate", type=float, default=0.0)
+    parser.add_argument("--timeout_rate", type=float, default=0.0)
+    parser.add_argument("--timeout_seconds", type=float, default=120.0)
+    parser.add_argument("--rpm", type=int, default=0, help="requests per minute (0 = unlimited)")
+    parser.add_argument("--tpm", type=int, default=0, help="tokens per minute (0 = unlimited)")
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+
+    config = MockConfig(
+        latency_dist=args.latency_dist,
+        latency_mean=args.latency_mean,
+        latency_spread=args.latency_spread,
+        error_429_rate=args.error_429_rate,
+        error_5xx_rate=args.error_5xx_rate,
+        timeout_rate=args.timeout_rate,
+        timeout_seconds=args.timeout_seconds,
+        rpm=args.rpm,
+        tpm=args.tpm,
+        seed=args.seed,
+    )
+    server = MockOpenAIServer(config, host=args.host, port=args.port)
+    logger.info("mock OpenAI server listening on {url}".format(url=server.base_url))
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        logger.info("stats: {stats}".format(stats=server.stats()))
+
+
+if __name__ == "__main__":
+    main()
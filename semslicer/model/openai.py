@@ -1,11 +1,60 @@
-from openai import OpenAI
-from .query_utils import query_batch
+import math
+import torch
+from .query_utils import query_batch, make_query_key
+from .client_pool import get_client
+from .metering import report_usage
 import tqdm
+try:
+    import tiktoken
+except ImportError:
+    tiktoken = None
+
+# number of alternatives returned for the first token in scoring mode (API maximum)
+TOP_LOGPROBS = 20
+LABEL_LOGIT_BIAS = 100
+
+
+def label_token_bias(model_name, labels):
+    """logit_bias that restricts the first output token to the label tokens, or None without tiktoken."""
+    if tiktoken is None:
+        return None
+    try:
+        encoding = tiktoken.encoding_for_model(model_name)
+    except KeyError:
+        return None
+    bias = {}
+    for label in labels:
+        for variant in [label, label.capitalize(), " " + label, " " + label.capitalize()]:
+            token_ids = encoding.encode(variant)
+            # only single-token labels can be forced
+            if len(token_ids) == 1:
+                bias[token_ids[0]] = LABEL_LOGIT_BIAS
+    return bias if len(bias) > 0 else None
+
+
+def label_probs(top_logprobs, labels):
+    """Normalized probabilities of `labels` from the first token's top logprobs."""
+    scores = []
+    for label in labels:
+        logprobs = [logprob for token, logprob in top_logprobs.items() if token.strip().lower() == label.lower()]
+        scores.append(math.log(sum(math.exp(logprob) for logprob in logprobs)) if len(logprobs) > 0 else -math.inf)
+    if all(score == -math.inf for score in scores):
+        return [1.0 / len(labels)] * len(labels)
+    return torch.softmax(torch.tensor(scores, dtype=torch.float32), dim=0).tolist()
 
 class OpenAIModel:
-    def __init__(self, model_name="gpt-4-turbo-preview"):
-        self.model = OpenAI().chat.completions
+    def __init__(self, model_name="gpt-4-turbo-preview", use_cache=False, endpoints=None):
         self.model_name = model_name
+        self.use_cache = use_cache
+        # registry.EndpointPool for self-hosted OpenAI-compatible servers, None for the OpenAI API
+        self.endpoints = endpoints
+
+    @property
+    def model(self):
+        # process-wide pooled client, shared with query_batch's async clients' settings
+        if self.endpoints is not None:
+            return get_client(min(self.endpoints.endpoints, key=lambda e: e.in_flight).base_url).chat.completions
+        return get_client().chat.completions
 
     def _send_request(
         self,
@@ -17,20 +66,24 @@ class OpenAIModel:
         return_probs=False,
         labels=None,
         mimic_starting_response='',
-        batched_query=True
+        batched_query=True,
+        retry=100,
+        coalesce=True,
     ):
         results = []
         # if mimic_starting_response != '':
         #     dialogs = [dialog + [{"role": "assistant", "content": mimic_starting_response}] for dialog in dialogs]
         
+        if return_probs:
+            return self._score_labels(dialogs, labels if labels is not None else ["yes", "no"], batch_size=batch_size,
+                retry=retry, coalesce=coalesce)
+
         if batched_query:
-            system_prompt = dialogs[0][0]["content"]
-            prompts = [dialog[1]["content"] for dialog in dialogs]
-            results = query_batch(prompts, 
+            results = self._query_by_prefix(dialogs,
                 batch_size=batch_size,
-                model_name=self.model_name, 
-                system_msg=system_prompt, 
-                temperature=temperature
+                temperature=temperature,
+                retry=retry,
+                coalesce=coalesce,
             )
         
         else:
@@ -42,8 +95,82 @@ class OpenAIModel:
                     temperature=temperature,
                 )
                 results.append(response.choices[0].message.content)
+                if response.usage is not None:
+                    report_usage(prompt_tokens=response.usage.prompt_tokens,
+                                 completion_tokens=response.usage.completion_tokens, api_requests=1)
         return results
 
+    def _query_by_prefix(self, dialogs, **kwargs):
+        """query_batch the dialogs one system prompt at a time, returning results in input order.
+
+        Requests sharing a system prompt (question + few-shot examples) go out together,
+        so prefix-caching backends serve all but the first from cache.
+        """
+        groups = {}
+        for index, dialog in enumerate(dialogs):
+            groups.setdefault(dialog[0]["content"], []).append(index)
+        results = [None] * len(dialogs)
+        for system_prompt, indices in groups.items():
+            group_results = query_batch([dialogs[index][1]["content"] for index in indices],
+                model_name=self.model_name,
+                system_msg=system_prompt,
+                skip_cache=not self.use_cache,
+                endpoints=self.endpoints,
+                **kwargs
+            )
+            for index, result in zip(indices, group_results):
+                results[index] = result
+        return results
+
+    def _score_labels(self, dialogs, labels, batch_size=1, retry=100, coalesce=True):
+        """Label-only scoring: one output token with its top logprobs.
+
+        Returns the answers and an (n x labels) probability tensor, like the T5 prob pipeline.
+        """
+        kwargs = {"logprobs": True, "top_logprobs": TOP_LOGPROBS, "return_logprobs": True}
+        logit_bias = label_token_bias(self.model_name, labels)
+        if logit_bias is not None:
+            kwargs["logit_bias"] = logit_bias
+        results = self._query_by_prefix(dialogs,
+            batch_size=batch_size,
+            max_tokens=1,
+            temperature=0,
+            retry=retry,
+            coalesce=coalesce,
+            **kwargs
+        )
+        probs = []
+        texts = []
+        for result in results:
+            if result is None:
+                # failed request: no answer, uninformative probabilities
+                texts.append(None)
+                probs.append([1.0 / len(labels)] * len(labels))
+                continue
+            prob = label_probs(result["top_logprobs"], labels)
+            probs.append(prob)
+            texts.append(result["content"] or labels[max(range(len(labels)), key=lambda i: prob[i])])
+        return texts, torch.tensor(probs, dtype=torch.float32)
+
+    def batch_requests(self, dialogs, temperature=1):
+        """(cache key, request body) pairs for the Batch API, keyed like `_send_request` queries."""
+        requests = []
+        for dialog in dialogs:
+            system_prompt = dialog[0]["content"]
+            prompt = dialog[1]["content"]
+            key = make_query_key(prompt, self.model_name, system_prompt, temperature=temperature)
+            body = {
+                "model": self.model_name,
+                "messages": [
+                    {"role": "system", "content": system_prompt},
+                    {"role": "user", "content": prompt},
+                ],
+                "temperature": temperature,
+                "n": 1,
+            }
+            requests.append((key, body))
+        return requests
+
 if __name__ == "__main__":
     teacher = OpenAIModel()
     dialogs = [[
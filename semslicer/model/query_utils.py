@@ -4,7 +4,7 @@ import aiohttp
 import asyncio
 import json
 import os
-import pickle
+import time
 from math import ceil, log2
 from random import random
 
@@ -13,16 +13,31 @@ from random import random
 # import google.generativeai as palm
 import openai
 from tqdm.asyncio import tqdm_asyncio
+from .cache_store import get_response_cache, digest_key
+from .client_pool import get_async_client, run_async
+from .inflight import run_coalesced
+from .interaction_log import get_interaction_log, make_record
+from .metering import report_usage
+from .rate_limit import NoLimit, get_rate_limiter, estimate_tokens
+from ..utils.log import get_logger
+
+logger = get_logger("INFO", "query")
 
 openai_initialized = False
 ANTHROPIC_CLIENT = None
 palm_initialized = False
 
 HISTORY_FILE = "history.jsonl"
-CACHE_FILE = "query_cache.pkl"
 OPENAI_REFRESH_QUOTA = 60
 OPENAI_EXP_CAP = int(ceil(log2(OPENAI_REFRESH_QUOTA)))
+# number of successful responses buffered before they are written to the cache
+CACHE_FLUSH_SIZE = 32
 PALM_MAX_CANDIDATE_COUNT = 8
+OPENAI_MODELS = {"gpt-3.5-turbo", "gpt-4-turbo-preview"}
+# with a shared prefix (history + system message) of at least this many tokens, one request is
+# sent alone first so the provider's prefix cache is warm before the rest go out concurrently
+# (OpenAI caches prompts of 1024+ tokens; vLLM prefix caching has no minimum)
+PREFIX_WARMUP_TOKENS = int(os.environ.get("PREFIX_WARMUP_TOKENS", 1024))
 # BATCH_SIZE = 300  # sometimes APIs complain if we too many concurrent requests
 
 
@@ -35,10 +50,14 @@ async def query_openai(
     temperature=0,
     retry=100,
     n=1,
+    return_logprobs=False,
+    endpoints=None,
+    info=None,
     **kwargs,
 ):
     # reference: https://github.com/ekinakyurek/mylmapis/blob/b0adb192135898fba9e9dc88f09a18dc64c1f1a9/src/network_manager.py
-    model = openai.AsyncOpenAI().chat.completions
+    # `endpoints` (registry.EndpointPool): OpenAI-compatible replicas, one picked per attempt
+    # `info` (dict): filled with token usage and the number of attempts
     messages = []
     if system_msg is not None:
         messages += [{"role": "system", "content": system_msg}]
@@ -50,33 +69,103 @@ async def query_openai(
     kwargs["temperature"] = temperature
     kwargs["n"] = n
 
+    # OpenAI account budgets do not apply to self-hosted replicas
+    limiter = get_rate_limiter(model_name) if endpoints is None else NoLimit()
+    estimated_tokens = estimate_tokens(messages, max_tokens) * n
     for i in range(retry + 1):
         wait_time = (1 << min(i, OPENAI_EXP_CAP)) + random() / 10
+        reserved = await limiter.acquire(estimated_tokens)
+        # requests sharing a system message stick to one replica, whose prefix cache holds it
+        endpoint = endpoints.acquire(affinity=system_msg) if endpoints is not None else None
+        model = get_async_client(endpoint.base_url if endpoint is not None else None).chat.completions
         try:
-            response = await model.create(
+            raw_response = await model.with_raw_response.create(
                 model=model_name, messages=messages, **kwargs
             )
+            response = raw_response.parse()
             # with open(HISTORY_FILE, "a") as f:
             #     f.write(json.dumps((model_name, messages, kwargs, response)) + "\n")
             # if any(choice["finish_reason"] != "stop" for choice in response.choices):
             #     print("Truncated response!")
             #     print(response)
             contents = [choice.message.content for choice in response.choices]
+            if return_logprobs:
+                # first generated token and its top alternatives, for label scoring
+                contents = [
+                    {
+                        "content": choice.message.content,
+                        "top_logprobs": {
+                            item.token: item.logprob for item in choice.logprobs.content[0].top_logprobs
+                        } if choice.logprobs is not None and choice.logprobs.content else {},
+                    }
+                    for choice in response.choices
+                ]
+            used_tokens = response.usage.total_tokens if response.usage is not None else None
+            if info is not None:
+                info["attempts"] = i + 1
+                if response.usage is not None:
+                    info["prompt_tokens"] = response.usage.prompt_tokens
+                    info["completion_tokens"] = response.usage.completion_tokens
+                    details = getattr(response.usage, "prompt_tokens_details", None)
+                    info["cached_tokens"] = getattr(details, "cached_tokens", None)
+            limiter.release(reserved, used_tokens=used_tokens, headers=raw_response.headers)
+            if endpoint is not None:
+                endpoints.release(endpoint, ok=True)
             if n == 1:
                 return contents[0]
             else:
                 return contents
+        except openai.RateLimitError as e:
+            # the limiter shrinks its window and honours Retry-After for every caller
+            limiter.release(reserved, headers=e.response.headers, rate_limited=True)
+            if endpoint is not None:
+                endpoints.release(endpoint, ok=True)
+            if i == retry:
+                raise e
+            elif limiter.blocked_for() > 0:
+                # acquire waits out the block, so only a small jitter is added here
+                await asyncio.sleep(random())
+            else:
+                # no Retry-After and no exhausted budget reported: back off exponentially
+                await asyncio.sleep(wait_time)
+        except (
+            openai.BadRequestError,
+            openai.AuthenticationError,
+            openai.PermissionDeniedError,
+            openai.NotFoundError,
+            openai.UnprocessableEntityError,
+        ) as e:
+            # the request itself is wrong (e.g. context length exceeded): retrying will not
+            # help, and the replica that rejected it is healthy
+            limiter.release(reserved)
+            if endpoint is not None:
+                endpoints.release(endpoint, ok=True)
+            raise e
         except (
             openai.APIError,
             openai.APIConnectionError,
             openai.APITimeoutError,
             openai.InternalServerError,
-            openai.RateLimitError,
         ) as e:
+            limiter.release(reserved)
+            if endpoint is not None:
+                # only server errors, timeouts and dropped connections count against a replica
+                failed = isinstance(e, openai.APIConnectionError) or (
+                    isinstance(e, openai.APIStatusError) and e.status_code >= 500)
+                endpoints.release(endpoint, ok=not failed)
             if i == retry:
                 raise e
+            elif endpoints is not None:
+                # another replica can take the retry right away
+                await asyncio.sleep(random())
             else:
                 await asyncio.sleep(wait_time)
+        except BaseException:
+            limiter.release(reserved)
+            if endpoint is not None:
+                # e.g. cancellation: not the endpoint's fault
+                endpoints.release(endpoint, ok=True)
+            raise
 
 
 async def query_anthropic(
@@ -159,22 +248,60 @@ async def query_palm(
                 await asyncio.sleep(wait_time)
 
 
-def query_batch_wrapper(fn, prompts, batch_size, *args, **kwargs):
-    # I have never used asyncio and have no idea if this a sane way to do this, but it works
-    async def _query(prompts):
-        async_responses = [fn(prompt, *args, **kwargs) for prompt in prompts]
-        try:
-            responses = await tqdm_asyncio.gather(*async_responses)
-        except Exception as e:
-            # print(e)
-            responses = [None for _ in prompts]
+def query_batch_wrapper(fn, prompts, batch_size, *args, on_result=None, retry_failed=1, request_info=False, **kwargs):
+    # Runs on the shared background event loop, whose pooled clients keep their connections
+    # across calls. At most `batch_size` requests are in flight;
+    # the next one starts as soon as any finishes, so a slow request no longer holds
+    # up a fixed chunk. Results are returned in input order.
+    # Each request settles on its own: `on_result(index, response, info)` is called as soon as
+    # it succeeds, failed requests are retried `retry_failed` more times after the rest
+    # of the batch is done, and anything still failing is returned as None.
+    # `info` holds the request latency; with `request_info`, `fn` also gets it as `info=` to fill in.
+    failures = {}
+
+    async def _query(indices):
+        semaphore = asyncio.Semaphore(max(1, batch_size))
+
+        async def _bounded(index):
+            async with semaphore:
+                info = {}
+                start = time.monotonic()
+                try:
+                    if request_info:
+                        response = await fn(prompts[index], *args, info=info, **kwargs)
+                    else:
+                        response = await fn(prompts[index], *args, **kwargs)
+                except Exception as e:
+                    failures[index] = e
+                    return None
+                info["latency"] = time.monotonic() - start
+            failures.pop(index, None)
+            if on_result is not None:
+                on_result(index, response, info)
+            return response
+
+        async_responses = [_bounded(index) for index in indices]
+        return await tqdm_asyncio.gather(*async_responses)
+
+    async def _query_all():
+        responses = await _query(list(range(len(prompts))))
+        for attempt in range(retry_failed):
+            if len(failures) == 0:
+                break
+            failed = sorted(failures)
+            logger.info("retrying {n} failed requests (attempt {attempt})".format(n=len(failed), attempt=attempt + 1))
+            for index, response in zip(failed, await _query(failed)):
+                responses[index] = response
         return responses
 
-    all_results = []
-    for start in range(0, len(prompts), batch_size):
-        prompts_batch = prompts[start : start + batch_size]
-        all_results.extend(asyncio.run(_query(prompts_batch)))
-    return all_results
+    if len(prompts) == 0:
+        return []
+    responses = run_async(_query_all())
+    if len(failures) > 0:
+        logger.warning("{n} of {total} requests failed: {errors}".format(
+            n=len(failures), total=len(prompts),
+            errors={index: repr(e) for index, e in sorted(failures.items())}))
+    return responses
 
 
 def escape(s):
@@ -185,6 +312,33 @@ def unescape(s):
     return s.encode("utf-8").decode("unicode_escape")
 
 
+def query_key_tuple(prompt, model_name, system_msg=None, history=None, max_tokens=None, temperature=0, num_beams=1, n=1):
+    # sorry this is ugly, but for backward compatibility
+    key = (
+        prompt,
+        model_name,
+        system_msg,
+        tuple(history) if history is not None else None,
+        max_tokens,
+        temperature,
+        num_beams,
+    )
+    return key if n == 1 else key + (n,)
+
+
+def make_query_key(prompt, model_name, system_msg=None, history=None, max_tokens=None, temperature=0, num_beams=1, n=1,
+                   **openai_kwargs):
+    """Cache key of a query_batch request.
+
+    Keys are sha256 digests of the key tuple, so cached keys do not keep the full
+    prompt / system message / history strings alive.
+    """
+    key = query_key_tuple(prompt, model_name, system_msg, history, max_tokens, temperature, num_beams, n)
+    if len(openai_kwargs) > 0:
+        key = key + (openai_kwargs,)
+    return digest_key(key)
+
+
 def query_batch(
     prompts,
     model_name,
@@ -197,56 +351,76 @@ def query_batch(
     num_beams=1,
     skip_cache=True,
     n=1,
+    coalesce=True,
+    endpoints=None,
     **openai_kwargs,
 ):
-    cache = {}
-    if not skip_cache and os.path.exists(CACHE_FILE):
-        cache = pickle.load(open(CACHE_FILE, "rb"))
+    cache = None if skip_cache else get_response_cache()
 
-    # sorry this is ugly, but for backward compatibility
-    prompt2key = lambda p: (
-        p,
-        model_name,
-        system_msg,
-        tuple(history) if history is not None else None,
-        max_tokens,
-        temperature,
-        num_beams,
-    ) if n == 1 else (
-        p,
-        model_name,
-        system_msg,
-        tuple(history) if history is not None else None,
-        max_tokens,
-        temperature,
-        num_beams,
-        n,
+    prompt2key = lambda p: make_query_key(
+        p, model_name, system_msg, history, max_tokens, temperature, num_beams, n, **openai_kwargs
     )
 
-    unseen_prompts = set()
-    for prompt in prompts:
-        key = prompt2key(prompt)
-        if key not in cache:
-            unseen_prompts.add(prompt)
-    unseen_prompts = list(unseen_prompts)
+    results = {}
+    if cache is not None:
+        unique_prompts = list(dict.fromkeys(prompts))
+        for prompt, response in zip(unique_prompts, cache.get_many([prompt2key(p) for p in unique_prompts])):
+            if response is not None:
+                results[prompt] = response
 
-    if len(unseen_prompts) > 0:
-        if model_name in {"gpt-3.5-turbo", "gpt-4-turbo-preview"}:
-            if not openai_initialized:
+    unseen_prompts = [prompt for prompt in dict.fromkeys(prompts) if prompt not in results]
+    cached_prompts = set(results)
+    # per-request measurements for the interaction log, filled by on_result
+    request_infos = {}
+
+    def _query_unseen(unseen_prompts):
+        # successful responses are written to the cache as they arrive, in small batches,
+        # so an interrupted or partially failed run keeps everything that already succeeded
+        pending = []
+        written = set()
+
+        def flush_pending():
+            if cache is not None and len(pending) > 0:
+                cache.put_many(pending)
+            pending.clear()
+
+        def on_result(index, response, info):
+            pending.append((prompt2key(unseen_prompts[index]), response))
+            written.add(index)
+            request_infos[unseen_prompts[index]] = info
+            if len(pending) >= CACHE_FLUSH_SIZE:
+                flush_pending()
+
+        if model_name in OPENAI_MODELS or endpoints is not None:
+            if not openai_initialized and endpoints is None:
                 openai.api_key = os.environ["OPENAI_API_KEY"]
-            responses = query_batch_wrapper(
-                query_openai,
-                unseen_prompts,
-                batch_size,
-                model_name,
-                system_msg,
-                history,
-                max_tokens,
-                temperature,
-                retry,
-                n,
-                **openai_kwargs,
-            )
+            prefix_tokens = (len(system_msg or "") + sum(len(message["content"]) for message in history or [])) // 4
+            warmup = 1 if len(unseen_prompts) > 1 and prefix_tokens >= PREFIX_WARMUP_TOKENS else 0
+            responses = []
+            try:
+                for start, stop in [(0, warmup), (warmup, len(unseen_prompts))]:
+                    responses += query_batch_wrapper(
+                        query_openai,
+                        unseen_prompts[start:stop],
+                        batch_size,
+                        model_name,
+                        system_msg,
+                        history,
+                        max_tokens,
+                        temperature,
+                        retry,
+                        n,
+                        on_result=lambda index, response, info, start=start: on_result(start + index, response, info),
+                        request_info=True,
+                        endpoints=endpoints,
+                        **openai_kwargs,
+                    )
+            finally:
+                flush_pending()
+            if endpoints is not None:
+                logger.info("endpoint state: {state}".format(state=endpoints.state()))
+            else:
+                logger.info("rate limiter state: {state}".format(state=get_rate_limiter(model_name).state()))
         elif model_name in {"claude-v1.3"}:
             assert system_msg is None and history is None
             global ANTHROPIC_CLIENT
@@ -259,6 +433,7 @@ def query_batch(
             responses = query_batch_wrapper(
                 query_anthropic,
                 unseen_prompts,
+                batch_size,
                 model_name,
                 max_tokens,
                 temperature,
@@ -280,6 +455,7 @@ def query_batch(
             responses = query_batch_wrapper(
                 query_palm,
                 unseen_prompts,
+                batch_size,
                 model_name,
                 max_tokens,
                 temperature,
@@ -293,34 +469,47 @@ def query_batch(
         else:
             raise NotImplementedError
 
-        # Reload cache for better concurrency. Otherwise multiple query processes can overwrite
-        # each other
-        cache = {}
-        if not skip_cache:
-            if os.path.exists(CACHE_FILE):
-                cache = pickle.load(open(CACHE_FILE, "rb"))
-        for prompt, response in zip(unseen_prompts, responses):
-            key = prompt2key(prompt)
-            cache[key] = response
-        if not skip_cache:
-            pickle.dump(cache, open(CACHE_FILE, "wb"))
-
-    interactions_save_path = os.environ.get("INTERACTIONS_SAVE_PATH")
-    if interactions_save_path is not None:
-        assert not os.path.exists(interactions_save_path)
-        with open(interactions_save_path, "w") as f:
-            for prompt in prompts:
-                key = prompt2key(prompt)
-                assert isinstance(cache[key], (str, list))
-                f.write(
-                    escape(prompt)
-                    + "\t"
-                    + escape(str(cache[key]))
-                    + "\t"
-                    + str(isinstance(cache[key], list))
-                    + "\t"
-                    + "\t".join([escape(str(x)) if x is not None else "None" for x in key[1:]])
-                    + "\n"
-                )
-
-    return [cache[prompt2key(prompt)] for prompt in prompts]
\ No newline at end of file
+        # only new entries are written; failed (None) responses are not cached
+        if cache is not None:
+            cache.put_many([(prompt2key(prompt), response)
+                            for index, (prompt, response) in enumerate(zip(unseen_prompts, responses))
+                            if index not in written])
+        return responses
+
+    if len(unseen_prompts) > 0:
+        # identical requests already in flight in another thread are awaited instead of re-sent
+        key2prompt = {prompt2key(prompt): prompt for prompt in unseen_prompts}
+        if coalesce:
+            responses = run_coalesced(list(key2prompt), lambda keys: _query_unseen([key2prompt[key] for key in keys]))
+        else:
+            # e.g. hedged duplicates, which must not wait on the request they are hedging
+            responses = _query_unseen(list(key2prompt.values()))
+        for prompt, response in zip(key2prompt.values(), responses):
+            results[prompt] = response
+        failed_rows = [i for i, prompt in enumerate(prompts) if results[prompt] is None]
+        if len(failed_rows) > 0:
+            logger.warning("no response for rows {rows}".format(rows=failed_rows))
+
+    fresh_infos = [request_infos[prompt] for prompt in dict.fromkeys(prompts) if prompt in request_infos]
+    prompt_tokens = sum(info.get("prompt_tokens") or 0 for info in fresh_infos)
+    cached_tokens = sum(info.get("cached_tokens") or 0 for info in fresh_infos)
+    if cached_tokens > 0:
+        logger.info("prefix cache: {cached} of {total} prompt tokens cached".format(cached=cached_tokens, total=prompt_tokens))
+    report_usage(
+        cache_hits=len(cached_prompts),
+        prompt_tokens=prompt_tokens,
+        completion_tokens=sum(info.get("completion_tokens") or 0 for info in fresh_infos),
+        cached_tokens=cached_tokens,
+        api_requests=len(fresh_infos),
+    )
+
+    interaction_log = get_interaction_log()
+    if interaction_log is not None:
+        params = {"system_msg": system_msg, "history": history, "max_tokens": max_tokens,
+                  "temperature": temperature, "num_beams": num_beams, "n": n, **openai_kwargs}
+        interaction_log.extend([
+            make_record(model_name, params, prompt, results[prompt], prompt in cached_prompts, request_infos.get(prompt))
+            for prompt in dict.fromkeys(prompts)
+        ])
+
+    return [results[prompt] for prompt in prompts]
\ No newline at end of file
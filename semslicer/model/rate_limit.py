@@ -0,0 +1,228 @@
+import asyncio
+import os
+import re
+import threading
+import time
+from ..utils.log import get_logger
+
+logger = get_logger("INFO", "rate_limit")
+
+# account budgets; the limiter adopts the limits reported in response headers once it sees them
+OPENAI_RPM = int(os.environ.get("OPENAI_RPM", 500))
+OPENAI_TPM = int(os.environ.get("OPENAI_TPM", 300000))
+OPENAI_MAX_CONCURRENCY = int(os.environ.get("OPENAI_MAX_CONCURRENCY", 32))
+# how often a waiting request re-checks for a free concurrency slot
+POLL_INTERVAL = 0.05
+
+
+def parse_duration(value):
+    """Parse rate-limit reset durations such as '1s', '6m0s', '20ms' or '0.5' into seconds."""
+    if value is None:
+        return None
+    value = str(value).strip()
+    try:
+        return float(value)
+    except ValueError:
+        pass
+    total = 0.0
+    matched = False
+    for amount, unit in re.findall(r"([\d.]+)(ms|h|m|s)", value):
+        matched = True
+        total += float(amount) * {"ms": 0.001, "s": 1, "m": 60, "h": 3600}[unit]
+    return total if matched else None
+
+
+class TokenBucket:
+    """Continuous-refill bucket holding at most `capacity` units, refilled over 60 seconds."""
+
+    def __init__(self, capacity):
+        self.capacity = float(capacity)
+        self.level = float(capacity)
+        self.updated_at = time.monotonic()
+
+    def _refill(self, now):
+        self.level = min(self.capacity, self.level + (now - self.updated_at) * self.capacity / 60.0)
+        self.updated_at = now
+
+    def reserve(self, amount, now):
+        """Take `amount` units and return how long the caller must wait for them."""
+        self._refill(now)
+        self.level -= amount
+        if self.level >= 0:
+            return 0.0
+        return -self.level * 60.0 / self.capacity
+
+    def refund(self, amount, now):
+        self._refill(now)
+        self.level = min(self.capacity, self.level + amount)
+
+    def sync(self, limit, remaining, now):
+        """Adopt the server's view of the budget."""
+        if limit is not None and limit > 0:
+            self.capacity = float(limit)
+        if remaining is not None:
+            self._refill(now)
+            self.level = min(self.level, float(remaining))
+
+
+class RateLimiter:
+    """Shared request/token budget with AIMD concurrency control.
+
+    Every request reserves one unit from the requests-per-minute bucket and its
+    estimated tokens from the tokens-per-minute bucket before it is sent. The number
+    of requests in flight is capped by a window that grows by one per window of
+    successful requests and halves on a 429; a Retry-After or an exhausted request
+    or token budget pauses all callers.
+    """
+
+    def __init__(
+        self,
+        rpm=OPENAI_RPM,
+        tpm=OPENAI_TPM,
+        max_concurrency=OPENAI_MAX_CONCURRENCY,
+        min_concurrency=1,
+        decrease_factor=0.5,
+    ):
+        self.requests = TokenBucket(rpm)
+        self.tokens = TokenBucket(tpm)
+        self.max_concurrency = max_concurrency
+        self.min_concurrency = min_concurrency
+        self.decrease_factor = decrease_factor
+        self.window = float(max_concurrency)
+        self.in_flight = 0
+        self.blocked_until = 0.0
+        self.last_decrease = 0.0
+        self.num_success = 0
+        self.num_rate_limited = 0
+        self._lock = threading.Lock()
+
+    async def acquire(self, estimated_tokens):
+        """Wait for a concurrency slot and budget, then return the reserved token count."""
+        while True:
+            with self._lock:
+                now = time.monotonic()
+                if now >= self.blocked_until and self.in_flight < int(self.window):
+                    self.in_flight += 1
+                    wait = max(self.requests.reserve(1, now), self.tokens.reserve(estimated_tokens, now))
+                    break
+                wait = max(self.blocked_until - now, POLL_INTERVAL)
+            await asyncio.sleep(wait)
+        if wait > 0:
+            try:
+                await asyncio.sleep(wait)
+            except BaseException:
+                # e.g. cancelled while waiting for budget: give back the slot and the reservation
+                with self._lock:
+                    now = time.monotonic()
+                    self.in_flight -= 1
+                    self.requests.refund(1, now)
+                    self.tokens.refund(estimated_tokens, now)
+                raise
+        return estimated_tokens
+
+    def release(self, reserved_tokens, used_tokens=None, headers=None, rate_limited=False):
+        with self._lock:
+            now = time.monotonic()
+            self.in_flight -= 1
+            if used_tokens is not None and used_tokens < reserved_tokens:
+                self.tokens.refund(reserved_tokens - used_tokens, now)
+            if headers is not None:
+                self._update_from_headers(headers, now)
+            if rate_limited:
+                self.num_rate_limited += 1
+                # one decrease per burst of 429s
+                if now - self.last_decrease > 1.0:
+                    self.window = max(self.min_concurrency, self.window * self.decrease_factor)
+                    self.last_decrease = now
+            else:
+                self.num_success += 1
+                self.window = min(self.max_concurrency, self.window + 1.0 / self.window)
+        if rate_limited:
+            logger.info("rate limited, limiter state: {state}".format(state=self.state()))
+
+    def _update_from_headers(self, headers, now):
+        def _int(name):
+            value = headers.get(name)
+            try:
+                return int(value) if value is not None else None
+            except ValueError:
+                return None
+
+        self.requests.sync(_int("x-ratelimit-limit-requests"), _int("x-ratelimit-remaining-requests"), now)
+        self.tokens.sync(_int("x-ratelimit-limit-tokens"), _int("x-ratelimit-remaining-tokens"), now)
+
+        retry_after = None
+        if headers.get("retry-after-ms") is not None:
+            retry_after = parse_duration(headers.get("retry-after-ms"))
+            retry_after = retry_after / 1000 if retry_after is not None else None
+        if retry_after is None:
+            retry_after = parse_duration(headers.get("retry-after"))
+        if retry_after is not None:
+            self.blocked_until = max(self.blocked_until, now + retry_after)
+            return
+        # an exhausted request or token budget pauses every caller until it resets
+        for name in ["requests", "tokens"]:
+            if _int("x-ratelimit-remaining-" + name) == 0:
+                reset = parse_duration(headers.get("x-ratelimit-reset-" + name))
+                if reset is not None:
+                    self.blocked_until = max(self.blocked_until, now + reset)
+
+    def blocked_for(self):
+        """Seconds until callers may send again after a Retry-After or an exhausted budget."""
+        with self._lock:
+            return max(0.0, self.blocked_until - time.monotonic())
+
+    def state(self):
+        with self._lock:
+            now = time.monotonic()
+            self.requests._refill(now)
+            self.tokens._refill(now)
+            return {
+                "window": round(self.window, 2),
+                "in_flight": self.in_flight,
+                "rpm_limit": self.requests.capacity,
+                "requests_available": round(self.requests.level, 1),
+                "tpm_limit": self.tokens.capacity,
+                "tokens_available": round(self.tokens.level),
+                "blocked_for": round(max(0.0, self.blocked_until - now), 2),
+                "success": self.num_success,
+                "rate_limited": self.num_rate_limited,
+            }
+
+
+class NoLimit:
+    """Limiter interface without limits, for self-hosted endpoints.
+
+    Their capacity grows with the number of replicas and each server queues
+    its own requests; concurrency is still bounded by query_batch.
+    """
+
+    async def acquire(self, estimated_tokens):
+        return estimated_tokens
+
+    def release(self, reserved_tokens, used_tokens=None, headers=None, rate_limited=False):
+        pass
+
+    def blocked_for(self):
+        return 0.0
+
+    def state(self):
+        return {}
+
+
+_limiters = {}
+_limiters_lock = threading.Lock()
+
+
+def get_rate_limiter(model_name):
+    """Return the process-wide limiter for `model_name` (budgets are per model)."""
+    with _limiters_lock:
+        if model_name not in _limiters:
+            _limiters[model_name] = RateLimiter()
+        return _limiters[model_name]
+
+
+def estimate_tokens(messages, max_tokens=None):
+    # rough estimate (4 characters per token) used only to reserve budget
+    prompt_tokens = sum(len(message["content"]) for message in messages) // 4 + 4 * len(messages)
+    return prompt_tokens + (max_tokens if max_tokens is not None else 16)
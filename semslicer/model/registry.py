@@ -0,0 +1,124 @@
+import hashlib
+import threading
+import time
+from ..utils.log import get_logger
+
+logger = get_logger("INFO", "registry")
+
+# consecutive failures before an endpoint is taken out of rotation, and for how long
+ENDPOINT_MAX_FAILURES = 3
+ENDPOINT_COOLDOWN = 30.0
+# a request keeps its prefix's replica unless that replica has this many more requests in flight than the least-loaded one
+AFFINITY_SLACK = 8
+
+_backends = []
+
+
+def register_backend(kind, matcher):
+    """Register `factory(model_name, model_size, batch_size, use_cache)` for model names accepted by `matcher`.
+
+    Backends are tried in registration order; `kind` tells Generator how to call the result.
+    """
+    def decorator(factory):
+        _backends.append((kind, matcher, factory))
+        return factory
+    return decorator
+
+
+def create_backend(model_name, **kwargs):
+    """Return (kind, backend) for the first registered backend accepting `model_name`, or (None, None)."""
+    for kind, matcher, factory in _backends:
+        if matcher(model_name):
+            return kind, factory(model_name, **kwargs)
+    return None, None
+
+
+class Endpoint:
+
+    def __init__(self, base_url):
+        self.base_url = base_url
+        self.in_flight = 0
+        self.consecutive_failures = 0
+        self.unhealthy_until = 0.0
+        self.num_requests = 0
+        self.num_failures = 0
+
+    def is_healthy(self, now):
+        return now >= self.unhealthy_until
+
+
+class EndpointPool:
+    """OpenAI-compatible replicas serving one model; requests go to the least-loaded healthy one,
+    or to the replica that already served their prompt prefix while it is not overloaded.
+
+    An endpoint that fails `max_failures` times in a row is skipped for `cooldown`
+    seconds, then gets traffic again (a single failure sends it back out).
+    """
+
+    def __init__(self, base_urls, max_failures=ENDPOINT_MAX_FAILURES, cooldown=ENDPOINT_COOLDOWN):
+        self.endpoints = [Endpoint(base_url) for base_url in base_urls]
+        self.max_failures = max_failures
+        self.cooldown = cooldown
+        self._lock = threading.Lock()
+
+    def acquire(self, affinity=None):
+        """Pick an endpoint; requests with the same `affinity` (e.g. shared prompt prefix) prefer the same one."""
+        with self._lock:
+            now = time.monotonic()
+            healthy = [endpoint for endpoint in self.endpoints if endpoint.is_healthy(now)]
+            if len(healthy) > 0:
+                endpoint = min(healthy, key=lambda endpoint: endpoint.in_flight)
+                if affinity is not None:
+                    # rendezvous hashing: the preferred replica only changes if it goes down
+                    preferred = max(healthy, key=lambda endpoint: hashlib.sha256(
+                        (endpoint.base_url + "\0" + affinity).encode("utf-8")).digest())
+                    if preferred.in_flight - endpoint.in_flight < AFFINITY_SLACK:
+                        endpoint = preferred
+            else:
+                # everything is down: try the one that comes back first
+                endpoint = min(self.endpoints, key=lambda endpoint: endpoint.unhealthy_until)
+            endpoint.in_flight += 1
+            endpoint.num_requests += 1
+            return endpoint
+
+    def release(self, endpoint, ok=True):
+        with self._lock:
+            endpoint.in_flight -= 1
+            if ok:
+                endpoint.consecutive_failures = 0
+                return
+            endpoint.consecutive_failures += 1
+            endpoint.num_failures += 1
+            if endpoint.consecutive_failures >= self.max_failures:
+                endpoint.unhealthy_until = time.monotonic() + self.cooldown
+                # one more failure after the cooldown takes it out again
+                endpoint.consecutive_failures = self.max_failures - 1
+                logger.warning("endpoint {url} taken out of rotation for {cooldown}s".format(
+                    url=endpoint.base_url, cooldown=self.cooldown))
+
+    def state(self):
+        with self._lock:
+            now = time.monotonic()
+            return [{
+                "base_url": endpoint.base_url,
+                "healthy": endpoint.is_healthy(now),
+                "in_flight": endpoint.in_flight,
+                "requests": endpoint.num_requests,
+                "failures": endpoint.num_failures,
+            } for endpoint in self.endpoints]
+
+
+_endpoint_pools = {}
+
+
+def configure_endpoints(endpoints):
+    """Read the `MODEL.ENDPOINTS` config section: {model name: base URL or list of base URLs}."""
+    for model_name, base_urls in (endpoints or {}).items():
+        if isinstance(base_urls, str):
+            base_urls = [base_urls]
+        _endpoint_pools[model_name] = EndpointPool(base_urls)
+        logger.info("{model}: {n} endpoints".format(model=model_name, n=len(base_urls)))
+
+
+def get_endpoint_pool(model_name):
+    return _endpoint_pools.get(model_name)
@@ -5,6 +5,7 @@ import torch.cuda
 import torch.backends.cudnn
 import torch.nn.functional as F
 import argparse
+import threading
 from transformers import (
     AutoTokenizer,
     AutoModelForCausalLM,
@@ -13,13 +14,21 @@ from transformers import (
 from typing import List, Dict
 import time
 import concurrent.futures
+from functools import partial
 from ..utils.log import get_logger
 from transformers import T5Tokenizer, T5ForConditionalGeneration, pipeline
 from .prob_pipeline import Text2TextGenerationPipelineWithProbs
+from .constrained import generate_labels
+from .batching import PaddingMeter, run_batched
 
 
 logger = get_logger("INFO", "t5")
 
+# how return_prob requests are answered: "single_step" scores the labels with one encoder pass
+# and one decoder step, "generate" runs the generation pipeline and reads the first step's scores
+T5_SCORING_MODE = os.environ.get("T5_SCORING_MODE", "single_step")
+LABEL_SPACE = ['yes', 'no']
+
 def _divide_list_into_sublists(input_list, num_sublists, batch_size):
     avg_len = int(len(input_list) / num_sublists) + 1
     if avg_len >= batch_size:
@@ -35,6 +44,10 @@ def _divide_list_into_sublists(input_list, num_sublists, batch_size):
     return sublists
 
 
+def _format_dialog(dialog):
+    return dialog[0]["content"] + '\n' + dialog[1]["content"]
+
+
 class FlanT5Wrapper:
     def __init__(
         self,
@@ -45,7 +58,7 @@ class FlanT5Wrapper:
         batch_size=40,
     ):
         self.model_name = model_name
-        self.no_cuda = (os.environ["CUDA_VISIBLE_DEVICES"] == "")
+        self.no_cuda = (os.environ.get("CUDA_VISIBLE_DEVICES") == "")
         self.use_cuda = not self.no_cuda
         START_TIME = time.perf_counter()
         logger.info("Start loading {}...".format(model_name))
@@ -73,6 +86,11 @@ class FlanT5Wrapper:
                 )
             )
             self.model[-1].eval()
+        if self.device_count == 0:
+            # no GPU: a single full-precision copy on the CPU
+            self.model.append(T5ForConditionalGeneration.from_pretrained(model_name))
+            self.model[-1].eval()
+            self.device_count = 1
         logger.info("Done with {:.2f} seconds.".format(time.perf_counter() - START_TIME))
         self.debug_mode = debug_mode
         
@@ -85,14 +103,26 @@ class FlanT5Wrapper:
             ) for device, model in enumerate(self.model)
         ]
 
-        self.prob_pipeline = [
-            Text2TextGenerationPipelineWithProbs(
-                model=model,
-                tokenizer=self.tokenizer,
-                batch_size=batch_size,
-                label_space=['yes', 'no'], # TODO: customized label space
-            ) for device, model in enumerate(self.model)
-        ]
+        # per device: label space -> probability pipeline scoring those labels
+        self.batch_size = batch_size
+        self.prob_pipeline = [{} for _ in self.model]
+        self._prob_pipeline_lock = threading.Lock()
+        for device in range(self.device_count):
+            self.get_prob_pipeline(device, LABEL_SPACE)
+        self.padding = PaddingMeter()
+
+    def get_prob_pipeline(self, device, labels):
+        """Probability pipeline of `device` for `labels`, built on first use."""
+        key = tuple(labels)
+        with self._prob_pipeline_lock:
+            if key not in self.prob_pipeline[device]:
+                self.prob_pipeline[device][key] = Text2TextGenerationPipelineWithProbs(
+                    model=self.model[device],
+                    tokenizer=self.tokenizer,
+                    batch_size=self.batch_size,
+                    label_space=list(labels),
+                )
+            return self.prob_pipeline[device][key]
 
     @torch.no_grad()
     def completion(
@@ -105,30 +135,131 @@ class FlanT5Wrapper:
     ) -> List[
         List[Dict[str, str]]
     ]:  
+        labels = labels or LABEL_SPACE
+        if return_prob:
+            get_pipeline = lambda device: self.get_prob_pipeline(device, labels)
+        else:
+            get_pipeline = lambda device: self.pipeline[device]
+        generated_results = self._run_on_devices(
+            lambda device, prompts: get_pipeline(device)(prompts, batch_size=len(prompts), max_new_tokens=max_gen_len),
+            dialogs, batch_size,
+        )
+        for pipeline in self.pipeline:
+            pipeline.call_count=0
+        return generated_results
+
+    def padding_stats(self):
+        return self.padding.state()
+
+    def _run_batched(self, run, prompts, batch_size):
+        """`run(batch_prompts)` over length-bucketed batches of `prompts`; results come back in input order."""
+        lengths = [len(ids) for ids in self.tokenizer(prompts, truncation=True)["input_ids"]]
+        return run_batched(run, prompts, lengths, batch_size, meter=self.padding)
+
+    def _run_on_devices(self, run, dialogs, batch_size):
+        """Split `dialogs` over the devices and call `run(device, batch_prompts)` batch by batch."""
         divided_dialogs = _divide_list_into_sublists(dialogs, self.device_count, batch_size)
-        dialog_input = []
-        for dialogs in divided_dialogs:
-            prompt_tokens = []
-            for dialog in dialogs:
-                dialog_tokens = dialog[0]["content"] + '\n' + dialog[1]["content"]
-                prompt_tokens.append(dialog_tokens)
-                logger.debug(dialog_tokens)
-            dialog_input.append(prompt_tokens)
-        
-        generated_results = []
         with concurrent.futures.ThreadPoolExecutor(max_workers=self.device_count) as executor:
             futures = []
-            for i in range(self.device_count):
-                if len(dialog_input[i]) > 0:
-                    futures.append(
-                        executor.submit(
-                            self.prob_pipeline[i] if return_prob else self.pipeline[i],
-                            dialog_input[i],
-                            batch_size=batch_size,
-                        )
-                    )
-            for future in futures:
-                generated_results += future.result()
-        for pipeline in self.pipeline:
-            pipeline.call_count=0
-        return generated_results
\ No newline at end of file
+            for device, part in enumerate(divided_dialogs):
+                if len(part) > 0:
+                    prompts = [_format_dialog(dialog) for dialog in part]
+                    logger.debug(prompts)
+                    futures.append(executor.submit(self._run_batched, partial(run, device), prompts, batch_size))
+            results = [result for future in futures for result in future.result()]
+        logger.info("padding: {stats}".format(stats=self.padding.state()))
+        return results
+
+    def label_ids(self, labels):
+        """Token id each label starts with; labels are told apart by their first token."""
+        ids = [self.tokenizer(label, add_special_tokens=False)["input_ids"][0] for label in labels]
+        assert len(set(ids)) == len(ids), "labels {} share their first token".format(labels)
+        return ids
+
+    @torch.no_grad()
+    def _score_batch(self, model, prompts, label_ids):
+        inputs = self.tokenizer(prompts, return_tensors="pt", padding=True, truncation=True).to(model.device)
+        decoder_input_ids = torch.full(
+            (inputs["input_ids"].shape[0], 1), model.config.decoder_start_token_id,
+            dtype=torch.long, device=model.device,
+        )
+        logits = model(**inputs, decoder_input_ids=decoder_input_ids).logits[:, 0, :]
+        return list(F.softmax(logits[:, label_ids].to(torch.float32), dim=1).cpu())
+
+    def score_labels(self, dialogs, labels=None, batch_size=40):
+        """Label probabilities from the first decoder step, without running generate.
+
+        Returns (texts, probs): the most likely label of each dialog and a
+        len(dialogs) x len(labels) tensor.
+        """
+        labels = labels or LABEL_SPACE
+        label_ids = self.label_ids(labels)
+        if len(dialogs) == 0:
+            return [], torch.empty(0, len(labels))
+        probs = torch.stack(self._run_on_devices(
+            lambda device, prompts: self._score_batch(self.model[device], prompts, label_ids),
+            dialogs, batch_size,
+        ))
+        texts = [labels[i] for i in probs.argmax(dim=1).tolist()]
+        return texts, probs
+
+    def generate_labels(self, dialogs, labels=None, batch_size=40):
+        """Greedy answers restricted to `labels`; decoding stops once each answer is a full label."""
+        labels = labels or LABEL_SPACE
+        return self._run_on_devices(
+            lambda device, prompts: generate_labels(self.model[device], self.tokenizer, prompts, labels,
+                                                    len(prompts), decoder_only=False),
+            dialogs, batch_size,
+        )
+
+
+def benchmark(model_name, n, batch_size, repeat):
+    """Time yes/no scoring with the generation pipeline against `score_labels`."""
+    wrapper = FlanT5Wrapper(model_name, is_chat_model=True, batch_size=batch_size)
+    questions = ['Does the text mention anything about age?',
+        'Does the text discuss age in any way?',
+        'Does the text have any content related to crime?']
+    texts = ['A young man and his parents had a meeting scheduled together for the next morning.',
+        'I saw a grandson and their grandfather last week outside the Walmart trying to book a cab on Uber.',
+        "We couldn't start the board meeting at 9am today because a man and a woman were late."]
+    dialogs = [
+        [
+            {"role": "system", "content": questions[i % len(questions)] + " Answer ONLY yes or no."},
+            {"role": "user", "content": "Text: {text}\nAnswer:".format(text=texts[i // len(questions) % len(texts)])},
+        ] for i in range(n)
+    ]
+
+    def run_pipeline():
+        results = wrapper.completion(dialogs, max_gen_len=5, temperature=0.01, top_p=0.9,
+                                     return_prob=True, batch_size=batch_size)
+        return [result['generated_text'].strip() for result in results], torch.stack([result['probs'] for result in results])
+
+    def run_single_step():
+        return wrapper.score_labels(dialogs, batch_size=batch_size)
+
+    timings = {}
+    outputs = {}
+    for name, run in [("pipeline", run_pipeline), ("single_step", run_single_step)]:
+        run()  # warm-up
+        start = time.perf_counter()
+        for _ in range(repeat):
+            outputs[name] = run()
+        timings[name] = (time.perf_counter() - start) / repeat
+        logger.info("{name}: {seconds:.3f}s for {n} dialogs ({rate:.1f} dialogs/s)".format(
+            name=name, seconds=timings[name], n=n, rate=n / timings[name]))
+    pipeline_texts, pipeline_probs = outputs["pipeline"]
+    texts, probs = outputs["single_step"]
+    agreement = sum(a == b for a, b in zip(pipeline_texts, texts)) / n
+    logger.info("speedup {speedup:.2f}x, answer agreement {agreement:.1%}, max prob difference {diff:.2e}".format(
+        speedup=timings["pipeline"] / timings["single_step"], agreement=agreement,
+        diff=(pipeline_probs.cpu() - probs).abs().max().item()))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark single-step label scoring against the generation pipeline.")
+    parser.add_argument("--model", type=str, default="google/flan-t5-small")
+    parser.add_argument("--n", type=int, default=200, help="number of dialogs")
+    parser.add_argument("--batch_size", type=int, default=20)
+    parser.add_argument("--repeat", type=int, default=3)
+    args = parser.parse_args()
+    benchmark(args.model, args.n, args.batch_size, args.repeat)
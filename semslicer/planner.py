@@ -0,0 +1,247 @@
+import glob
+import math
+import os
+import pandas as pd
+from .utils.config import config
+from .utils.log import get_logger
+from .utils.file import read_csv_file
+from .slicer import to_dialog, to_packed_dialogs, to_multi_dialogs, to_few_shot_str, SYSTEM_PROMPT, PROMPT
+from .model.cache_store import get_response_cache, query_cache_enabled
+from .model.interaction_log import INTERACTIONS_SAVE_PATH, read_interactions
+from .model.metering import count_text_tokens, estimate_cost, USAGE_SUMMARY_FILE
+from .model.query_utils import OPENAI_MODELS, make_query_key
+from .model.rate_limit import OPENAI_RPM, OPENAI_TPM
+from .model.registry import get_endpoint_pool
+
+logger = get_logger("INFO", "planner")
+
+# dialogs built, tokenized and looked up in the cache at a time
+PLAN_CHUNK = 500
+# expected completion length of a yes/no answer
+ANSWER_TOKENS = 2
+# temperature Generator._send_request uses for annotation (part of the cache key)
+ANNOTATION_TEMPERATURE = 0.01
+PLAN_FILE = "plan.csv"
+
+
+def token_counter(model_name):
+    """Return `count(text)` using the tokenizer of `model_name` (without loading the model)."""
+    if 'flan-t5' in model_name:
+        from transformers import T5Tokenizer
+        tokenizer = T5Tokenizer.from_pretrained(f"google/{model_name}")
+        return lambda text: len(tokenizer.encode(text))
+    return lambda text: count_text_tokens(model_name, text)
+
+
+def dialog_text(dialog):
+    return '\n'.join(message["content"] for message in dialog)
+
+
+def seconds_per_request(model_name, batch_size, result_dir):
+    """Measured wall time per request: from the interaction log, else from earlier usage summaries."""
+    if INTERACTIONS_SAVE_PATH is not None and os.path.exists(INTERACTIONS_SAVE_PATH):
+        df = read_interactions(INTERACTIONS_SAVE_PATH)
+        fresh = df[(df["model"] == model_name) & (~df["cache_hit"])] if len(df) > 0 else df
+        if len(fresh) > 0 and fresh["latency"].notna().any():
+            # requests run `batch_size` at a time
+            return fresh["latency"].mean() / max(1, batch_size)
+    summaries = [read_csv_file(path) for path in glob.glob(os.path.join(result_dir, "..", "*", "*" + USAGE_SUMMARY_FILE))]
+    if len(summaries) > 0:
+        usage = pd.concat(summaries)
+        usage = usage[(usage["model"] == model_name) & (usage["stage"] == "annotation")]
+        requests = (usage["requests"] - usage["cache_hits"]).sum()
+        if requests > 0:
+            return usage["wall_time"].sum() / requests
+    return None
+
+
+class Planner:
+    """Estimates what a `--task slicing` run would send, without sending anything."""
+
+    def __init__(self, student_model, teacher_model, batch_size=5, execution="online", pack_size=1,
+                 multi_keyword_size=1, sample_rows=None):
+        self.student_model = student_model
+        self.teacher_model = teacher_model
+        self.batch_size = batch_size
+        self.pack_size = pack_size
+        self.multi_keyword_size = multi_keyword_size
+        self.sample_rows = sample_rows
+        self.count_tokens = token_counter(student_model)
+        # API students (OpenAI or MODEL.ENDPOINTS) read the response cache when it is switched on,
+        # and always in batch execution
+        api_student = student_model in OPENAI_MODELS or get_endpoint_pool(student_model) is not None
+        use_cache = query_cache_enabled() or execution == "batch"
+        self.cache = get_response_cache() if use_cache and api_student else None
+
+    def _measure(self, dialog_chunks, scale):
+        """Requests, cache hits and prompt tokens of the dialogs, scaled up from a row sample."""
+        requests, hits, prompt_tokens = 0, 0, 0
+        for dialogs in dialog_chunks:
+            requests += len(dialogs)
+            prompt_tokens += sum(self.count_tokens(dialog_text(dialog)) for dialog in dialogs)
+            if self.cache is not None:
+                keys = [make_query_key(dialog[1]["content"], self.student_model, dialog[0]["content"],
+                                       temperature=ANNOTATION_TEMPERATURE) for dialog in dialogs]
+                hits += sum(value is not None for value in self.cache.get_many(keys))
+        return {"requests": requests * scale, "cache_hits": hits * scale, "prompt_tokens": prompt_tokens * scale}
+
+    def _chunks(self, data, build):
+        # dialogs are built PLAN_CHUNK rows at a time, never for the whole dataset at once
+        step = PLAN_CHUNK * self.pack_size
+        for start in range(0, len(data), step):
+            yield build(data.iloc[start : start + step])
+
+    def plan_keyword(self, data, prompts, few_shot_str, scale, calibrate=False):
+        # packing is off with few-shot examples, as in Slicer.annotate
+        packed = self.pack_size > 1 and not calibrate and few_shot_str == ""
+        if packed:
+            build = lambda rows, prompt: to_packed_dialogs(rows, prompt, self.pack_size, few_shot_str=few_shot_str)
+        else:
+            build = lambda rows, prompt: to_dialog(rows, prompt, few_shot_str=few_shot_str)
+        plan = {"requests": 0, "cache_hits": 0, "prompt_tokens": 0}
+        for prompt in prompts:
+            measured = self._measure(self._chunks(data, lambda rows: build(rows, prompt)), scale)
+            for name in plan:
+                plan[name] += measured[name]
+            if calibrate:
+                # one content-free request per prompt
+                plan["requests"] += 1
+                plan["prompt_tokens"] += self.count_tokens(SYSTEM_PROMPT.format(question=prompt) + few_shot_str
+                                                           + PROMPT.format(passage=""))
+        plan["completion_tokens"] = plan["requests"] * ANSWER_TOKENS * (self.pack_size if packed else 1)
+        return plan
+
+    def plan_multi(self, data, questions, scale):
+        plan = {"requests": 0, "cache_hits": 0, "prompt_tokens": 0}
+        for start in range(0, len(questions), self.multi_keyword_size):
+            chunk = questions[start : start + self.multi_keyword_size]
+            measured = self._measure(self._chunks(data, lambda rows: to_multi_dialogs(rows, chunk)), scale)
+            for name in plan:
+                plan[name] += measured[name]
+        plan["completion_tokens"] = plan["requests"] * ANSWER_TOKENS * min(self.multi_keyword_size, len(questions))
+        return plan
+
+    def plan_few_shot(self, data, prompt, num, label_source, sample_strategy="random"):
+        """Requests for one keyword's few-shot examples, estimated from sampled rows.
+
+        Returns [(stage, model, plan)] and a stand-in few-shot string of the right length.
+        """
+        rows = data.sample(n=min(num, len(data)), random_state=42)
+        dialogs = to_dialog(rows, prompt)
+        plans = []
+        if sample_strategy in ["usp", "active_learning"]:
+            # candidates are scored by the student first
+            candidates = to_dialog(data.sample(n=min(num * 4, len(data)), random_state=42), prompt)
+            plans.append(("few_shot_sampling", self.student_model, {
+                "requests": len(candidates),
+                "cache_hits": 0,
+                "prompt_tokens": sum(self.count_tokens(dialog_text(dialog)) for dialog in candidates),
+                "completion_tokens": len(candidates) * ANSWER_TOKENS,
+            }))
+        if label_source != "human":
+            model_name = self.teacher_model if label_source == "teacher" else self.student_model
+            count = token_counter(model_name) if model_name != self.student_model else self.count_tokens
+            plans.append(("few_shot_labeling", model_name, {
+                "requests": len(dialogs),
+                "cache_hits": 0,
+                "prompt_tokens": sum(count(dialog_text(dialog)) for dialog in dialogs),
+                "completion_tokens": len(dialogs) * ANSWER_TOKENS,
+            }))
+        return plans, to_few_shot_str(dialogs, ["yes"] * len(dialogs))
+
+    def estimate_seconds(self, model_name, plan, result_dir):
+        fresh = plan["requests"] - plan["cache_hits"]
+        per_request = seconds_per_request(model_name, self.batch_size, result_dir)
+        seconds = fresh * per_request if per_request is not None else None
+        if model_name in OPENAI_MODELS:
+            # the rate limits bound the run from below
+            fresh_tokens = (plan["prompt_tokens"] + plan["completion_tokens"]) * (fresh / max(plan["requests"], 1))
+            limit = max(fresh / OPENAI_RPM, fresh_tokens / OPENAI_TPM) * 60
+            seconds = max(seconds or 0.0, limit)
+        return seconds
+
+    def run(self, data, keywords, prompt_df, few_shot_df=None, use_calibrate=False, add_few_shot=False,
+            few_shot_size=8, label_source="teacher", sample_strategy="random"):
+        """Return a DataFrame with one row per (stage, keyword)."""
+        scale = 1.0
+        if self.sample_rows is not None and len(data) > self.sample_rows:
+            scale = len(data) / self.sample_rows
+            data = data.sample(n=self.sample_rows, random_state=42)
+        result_dir = os.path.dirname(config["EXPERIMENT"]["SLICE_RESULT_PATH"])
+
+        rows = []
+        for keyword in keywords:
+            prompts = prompt_df["{keyword}_prompt".format(keyword=keyword)].dropna().tolist()
+            few_shot_str = ""
+            if add_few_shot:
+                if few_shot_df is not None:
+                    few_shot_str = few_shot_df.at[0, keyword]
+                else:
+                    plans, few_shot_str = self.plan_few_shot(data, prompts[0], few_shot_size, label_source, sample_strategy)
+                    rows += [dict(stage=stage, keyword=keyword, model=model_name, **plan) for stage, model_name, plan in plans]
+            if self.multi_keyword_size > 1 and not use_calibrate:
+                continue
+            plan = self.plan_keyword(data, prompts, few_shot_str, scale, calibrate=use_calibrate)
+            rows.append(dict(stage="annotation", keyword=keyword, model=self.student_model, **plan))
+
+        if self.multi_keyword_size > 1 and not use_calibrate:
+            questions = [prompt for keyword in keywords
+                         for prompt in prompt_df["{keyword}_prompt".format(keyword=keyword)].dropna().tolist()]
+            plan = self.plan_multi(data, questions, scale)
+            rows.append(dict(stage="annotation", keyword="+".join(keywords), model=self.student_model, **plan))
+
+        for row in rows:
+            row["seconds"] = self.estimate_seconds(row["model"], row, result_dir)
+            row["cost"] = estimate_cost(row["model"], row["prompt_tokens"] * (1 - row["cache_hits"] / max(row["requests"], 1)),
+                                        row["completion_tokens"], row["seconds"] or 0.0)
+        plan_df = pd.DataFrame(rows, columns=["stage", "keyword", "model", "requests", "cache_hits", "prompt_tokens",
+                                              "completion_tokens", "seconds", "cost"])
+        for name in ["requests", "cache_hits", "prompt_tokens", "completion_tokens"]:
+            plan_df[name] = plan_df[name].round().astype(int)
+        return plan_df
+
+
+def plan_slicing(data, keywords):
+    """Plan a `--task slicing` run with the current config and write it next to slice_result.csv."""
+    slicing = config["SLICING"]
+    planner = Planner(
+        student_model=config["MODEL"]["STUDENT"],
+        teacher_model=config["MODEL"]["TEACHER"],
+        batch_size=slicing["BATCH_SIZE"],
+        execution=slicing.get("EXECUTION", "online"),
+        pack_size=slicing.get("PACK_SIZE", 1),
+        multi_keyword_size=slicing.get("MULTI_KEYWORD_SIZE", 1),
+        sample_rows=config.config.get("PLAN", {}).get("SAMPLE_ROWS"),
+    )
+    if slicing["SAMPLING"]:
+        data = data.sample(n=slicing["SAMPLE_SIZE"], random_state=42)
+
+    prompt_path = config["EXPERIMENT"]["PROMPT_PATH"]
+    if os.path.exists(prompt_path):
+        prompt_df = read_csv_file(prompt_path)
+    else:
+        # find_prompts has not run yet: plan with the template prompts
+        logger.warning("{path} not found, planning with template prompts".format(path=prompt_path))
+        prompt_df = pd.DataFrame({"{keyword}_prompt".format(keyword=keyword): [f"Is the text related to {keyword.lower()}?"]
+                                  for keyword in keywords})
+    few_shot_path = config["EXPERIMENT"]["FEW_SHOT_PATH"]
+    few_shot_df = read_csv_file(few_shot_path) if os.path.exists(few_shot_path) else None
+
+    plan_df = planner.run(
+        data, keywords, prompt_df, few_shot_df=few_shot_df,
+        use_calibrate=slicing["CALIBRATE"],
+        add_few_shot=config["EXAMPLES"]["USE_FEW_SHOT"],
+        few_shot_size=config["EXAMPLES"]["FEW_SHOT_SIZE"],
+        label_source=config["EXAMPLES"]["LABEL_SOURCE"],
+        sample_strategy=config["EXAMPLES"]["SAMPLE_STRATEGY"],
+    )
+    plan_path = os.path.join(os.path.dirname(config["EXPERIMENT"]["SLICE_RESULT_PATH"]), PLAN_FILE)
+    plan_df.to_csv(plan_path, index=False)
+    logger.info("plan:\n{plan}".format(plan=plan_df.to_string(index=False)))
+    # no throughput measurement yet for some model: the total time is unknown
+    seconds = plan_df["seconds"]
+    logger.info("total: {requests} requests, {tokens} prompt tokens, ~{seconds} s, ~${cost:.2f}; written to {path}".format(
+        requests=plan_df["requests"].sum(), tokens=plan_df["prompt_tokens"].sum(),
+        seconds="unknown" if seconds.isna().any() else int(math.ceil(seconds.sum())),
+        cost=plan_df["cost"].sum(), path=plan_path))
+    return plan_df
@@ -14,7 +14,7 @@ class Cubam(nn.Module):
     
     def forward(self, L):
         self.sigma.data = self.sigma.data.clamp_(0.05, 200)
-        loss = torch.tensor([0.0], device=0)
+        loss = torch.tensor([0.0], device=L.device)
         negative_prob = self.normal.cdf(torch.stack([(self.tau - self.x[i]) / self.sigma for i in range(self.text_num)]))
         pi = torch.where(L != 1, negative_prob, 1.0 - negative_prob).clamp_(0.0001, 0.9999)
         loss -= torch.sum(torch.log(pi))
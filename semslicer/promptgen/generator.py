@@ -10,6 +10,7 @@ from multi_rake import Rake
 from ..utils.config import config
 from .paraphraser import Paraphraser
 from ..model.llm_server import Generator
+from ..model import metering
 from difflib import SequenceMatcher
 
 logger = get_logger("INFO", "prompt")
@@ -210,10 +211,11 @@ class PromptGenerator:
         prompt_df = pd.DataFrame()
         for key_idx, (keyword, descrp) in enumerate(zip(keyword_list, description_list)):
 
-            prompts = self.generate_prompts([keyword if descrp == '' else descrp])
-            if self.num_prompts > 1:
-                paraphrased_prompts = self.paraphraser.paraphrase_prompt(prompts[0], keyword, self.num_prompts - 1)
-                prompts = prompts + paraphrased_prompts
+            with metering.stage("prompt_generation", keyword):
+                prompts = self.generate_prompts([keyword if descrp == '' else descrp])
+                if self.num_prompts > 1:
+                    paraphrased_prompts = self.paraphraser.paraphrase_prompt(prompts[0], keyword, self.num_prompts - 1)
+                    prompts = prompts + paraphrased_prompts
 
             # deduplicate
             prompts = list(set(prompts))
@@ -43,7 +43,8 @@ class Paraphraser:
                 {"role": "system", "content": FIND_PROMPT.format(n=n, keyword=keyword)}, 
                 {"role": "user", "content": "{}".format(prompt)}
             ]], 
-            temperature=0.1
+            temperature=0.1,
+            task="paraphrase",
         )[0]
 
         logger.info(results)
@@ -7,7 +7,7 @@ class Refiner:
         self.few_shot_examples = pd.read_csv(config["EXPERIMENT"]["FEW_SHOT_PATH"]) if config["EXAMPLES"]["USE_FEW_SHOT"] else None
         self.prompts = pd.read_csv(config["EXPERIMENT"]["PROMPT_PATH"])
         self.annotated_examples = pd.read_csv(config["EXPERIMENT"]["SLICE_RESULT_PATH"])
-        self.slicer = Slicer(model_name="dummy")
+        self.slicer = Slicer(student_model="dummy")
 
     def sample_examples(self, keyword, label, sample_size):
         '''
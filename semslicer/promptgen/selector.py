@@ -64,11 +64,12 @@ class PromptSelector:
         # L = df[[f"{key}_prompt{prompt_id}"]].values
 
         # train network
+        device = 0 if torch.cuda.is_available() else "cpu"
         cubam = Cubam(len(df), prompt_num)
-        cubam.to(0)
+        cubam.to(device)
         cubam.train()
         optimizer = torch.optim.Adam(cubam.parameters(), lr=0.1)
-        L = torch.tensor(L, dtype=torch.float32, device=0)
+        L = torch.tensor(L, dtype=torch.float32, device=device)
         for i in range(1600):
             loss = cubam(L)
             loss.backward()
@@ -141,10 +142,10 @@ class PromptSelector:
                     break
             
             # calculate pseudo accuracy
-            prompt_df["{key}_pseudo_acc"] = self.accuracy_estimate(df, key, prompt_num)
+            prompt_df["{key}_pseudo_acc".format(key=key)] = self.accuracy_estimate(df, key, prompt_num)
 
             if self.noise_estimate_flag:
-                prompt_df["{key}_tau"], prompt_df["{key}_sigma"] = self.noise_estimate(df, key, prompt_num)
+                prompt_df["{key}_tau".format(key=key)], prompt_df["{key}_sigma".format(key=key)] = self.noise_estimate(df, key, prompt_num)
             
 
             # # estimated labels
@@ -1,5 +1,6 @@
 import os
 import re
+import json
 import torch
 import pandas as pd
 from typing import List, Dict
@@ -8,6 +9,8 @@ from .utils.log import get_logger
 from .utils.file import read_txt_file, read_csv_file
 from .utils.config import config
 from .model.llm_server import Generator
+from .model.batch_api import BatchRunner, OpenAIBatchBackend, LocalBatchBackend
+from .model import metering
 from .promptgen.generator import ExampleGenerator, PromptGenerator
 from .promptgen.selector import PromptSelector, select_usp_examples, select_boundary_examples, select_random_examples
 
@@ -42,10 +45,25 @@ Answer: {{answer}}
 PROMPT_COT = '''Text: {passage}
 Rationale: Let's think step by step.'''
 
+# packed mode: several numbered passages per request, answered as one JSON object
+SYSTEM_PROMPT_PACKED = '''{question} You will receive several numbered texts. Answer ONLY yes or no for each text.
+Reply with a JSON object mapping each text number to its answer, e.g. {{"1": "yes", "2": "no"}}.\n\n'''
+PROMPT_PACKED_ITEM = '''Text {index}: {passage}'''
+PROMPT_PACKED_SUFFIX = '''\n\nAnswers: '''
+
+# multi-keyword mode: several slicing questions about the same text in one request
+SYSTEM_PROMPT_MULTI = '''Answer each numbered question about the text ONLY yes or no.
+Reply with a JSON object mapping each question number to its answer, e.g. {{"1": "yes", "2": "no"}}.
+
+{questions}\n\n'''
+PROMPT_MULTI_QUESTION = '''Question {index}: {question}'''
+
 COT_FLAG = False
 if COT_FLAG:
     SYSTEM_PROMPT = SYSTEM_PROMPT_COT
     PROMPT = PROMPT_COT
+# task type of single-question answers, which bounds how long local models may generate
+ANSWER_TASK = "rationale" if COT_FLAG else "label"
    
 
 def from_few_shot_str(few_shot_str):
@@ -76,19 +94,81 @@ def to_dialog(data, prompt, few_shot_str=""):
     ]
     return dialogs
 
+def to_packed_dialogs(data, prompt, pack_size, few_shot_str=""):
+    """Dialogs holding `pack_size` numbered passages each (the last one may hold fewer)."""
+    passages = data['context'].tolist()
+    dialogs = []
+    for start in range(0, len(passages), pack_size):
+        items = [PROMPT_PACKED_ITEM.format(index=i + 1, passage=passage)
+            for i, passage in enumerate(passages[start : start + pack_size])]
+        dialogs.append([
+            {"role": "system", "content": SYSTEM_PROMPT_PACKED.format(question=prompt) + few_shot_str},
+            {"role": "user", "content": "\n\n".join(items) + PROMPT_PACKED_SUFFIX}
+        ])
+    return dialogs
+
+def parse_packed_answer(answer, num_items, labels=["yes", "no"]):
+    """Split a packed answer into per-item labels; items that cannot be parsed are None."""
+    parsed = [None] * num_items
+    if answer is None:
+        return parsed
+    match = re.search(r'\{.*\}', answer, re.DOTALL)
+    if match is None:
+        return parsed
+    try:
+        answers = json.loads(match.group(0))
+    except json.JSONDecodeError:
+        return parsed
+    if not isinstance(answers, dict):
+        return parsed
+    for index in range(num_items):
+        value = answers.get(str(index + 1))
+        if isinstance(value, str) and value.strip().lower() in labels:
+            parsed[index] = value.strip().lower()
+    return parsed
+
+def to_multi_dialogs(data, questions):
+    """One dialog per passage asking every question in `questions`."""
+    question_str = "\n".join([PROMPT_MULTI_QUESTION.format(index=i + 1, question=question)
+        for i, question in enumerate(questions)])
+    dialogs = [
+        [
+            {"role": "system", "content": SYSTEM_PROMPT_MULTI.format(questions=question_str)},
+            {"role": "user", "content": PROMPT.format(passage=passage)}
+        ]
+        for passage in data['context']
+    ]
+    return dialogs
+
+def to_binary_result(meta_result, label_map={"yes": 1, "no": 0}):
+    return [label_map['yes'] if x.lower().find("yes") != -1 and x.lower().find("no") == -1 else label_map['no'] for x in meta_result]
+
 class Slicer(object):
 
     def __init__(self, 
         student_model="dummy", 
         creator_model="gpt-4-turbo-preview",
         teacher_model="gpt-4-turbo-preview",
-        batch_size=5
+        batch_size=5,
+        execution="online",
+        batch_backend="openai",
+        pack_size=1,
+        multi_keyword_size=1,
     ):
-        self.generator = Generator(model_name=student_model)
+        # "batch" execution sends annotation requests through the offline Batch API first;
+        # the answers land in the response cache, which the student then reads from
+        self.execution = execution
+        self.batch_backend = batch_backend
+        # batch execution reads its answers back from the cache, so it needs the cache on
+        self.generator = Generator(model_name=student_model, use_cache=True if execution == "batch" else None)
         self.prompt_selector = PromptSelector()
         self.example_generator = ExampleGenerator(model_name=creator_model)
         self.teacher = Generator(model_name=teacher_model)
         self.batch_size = batch_size
+        # number of passages per request in `annotate` (1 = one request per passage)
+        self.pack_size = pack_size
+        # number of slicing questions per request in `annotate_batch` (1 = one keyword prompt at a time)
+        self.multi_keyword_size = multi_keyword_size
 
         logger.info("Slicer initialized. Student model: {student_model}, Teacher model: {teacher_model}, Creator model: {creator_model}".format(
             student_model=student_model, teacher_model=teacher_model, creator_model=creator_model))
@@ -103,7 +183,8 @@ class Slicer(object):
                 {"role": "user", "content": PROMPT.format(question=prompt, passage="")}
             ]
         ]
-        _, base_probs = self.generator._send_request(dialogs, return_probs=True, labels=labels)
+        with metering.stage("calibration"):
+            _, base_probs = self.generator._send_request(dialogs, return_probs=True, labels=labels)
         logger.info("base_probs = {base_probs}".format(base_probs=base_probs))
 
         # calibrate the probability for n*2 tensor
@@ -119,7 +200,8 @@ class Slicer(object):
         use_calibrate: bool=False, 
         few_shot_str: str="",
         labels: List[str] = ["yes", "no"],
-        label_map: Dict[str, int] = {"yes": 1, "no": 0}
+        label_map: Dict[str, int] = {"yes": 1, "no": 0},
+        pack_size: int = None,
     ):
         """Annotate data."""
         logger.info("prompt = {prompt}".format(prompt=prompt))
@@ -129,26 +211,132 @@ class Slicer(object):
         dialogs = to_dialog(data, prompt, few_shot_str=few_shot_str)
         logger.info("generated dialogs")
 
+        pack_size = pack_size if pack_size is not None else self.pack_size
+        if pack_size > 1 and few_shot_str != "":
+            # few-shot examples answer one text each, which contradicts the packed JSON answer format
+            logger.info("packed mode is off: not supported with few-shot examples")
+            pack_size = 1
         probs = None
         # generate results
-        if return_probs:
-            results, probs = self.generator._send_request(dialogs, batch_size=self.batch_size, return_probs=True)
+        if pack_size > 1 and not return_probs:
+            meta_result = self.annotate_packed(data, prompt, dialogs, pack_size, few_shot_str=few_shot_str, labels=labels)
+        elif return_probs:
+            results, probs = self.generator._send_request(dialogs, batch_size=self.batch_size, return_probs=True,
+                                                          labels=labels)
+            meta_result = [result for result in results]
             if use_calibrate:
                 meta_result, probs = self.calibrate_prob(prompt, probs, labels, few_shot_str=few_shot_str)
         else:
-            results = self.generator._send_request(dialogs, batch_size=self.batch_size)
+            results = self.generator._send_request(dialogs, batch_size=self.batch_size, task=ANSWER_TASK, labels=labels)
             meta_result = [result for result in results]
         
+        failed_rows = [i for i, x in enumerate(meta_result) if x is None]
+        if len(failed_rows) > 0:
+            # failed requests are not cached, so re-running only pays for these rows
+            logger.warning("no answer for {n} rows, treated as 'no': {rows}".format(n=len(failed_rows), rows=failed_rows))
+            meta_result = ["" if x is None else x for x in meta_result]
+
         logger.info("generated results")
         logger.info(f"total_tokens = {self.generator.compute_total_tokens(dialogs)}")
         
-        binary_result = [label_map['yes'] if x.lower().find("yes") != -1 and x.lower().find("no") == -1 else label_map['no'] for x in meta_result]
+        binary_result = to_binary_result(meta_result, label_map)
         # if COT_FLAG:
         #     answer_result = [result.split('Answer:')[1] for result in meta_result]
         #     binary_result = [label_map['yes'] if x.lower().find("yes") != -1 and x.lower().find("no") == -1 else label_map['no'] for x in answer_result]
         
         return meta_result, binary_result, probs
 
+    def annotate_packed(self, data, prompt, dialogs, pack_size, few_shot_str="", labels=["yes", "no"]):
+        """Answer `pack_size` passages per request; unparsable items fall back to single `dialogs`."""
+        packed_dialogs = to_packed_dialogs(data, prompt, pack_size, few_shot_str=few_shot_str)
+        packed_results = self.generator._send_request(packed_dialogs, batch_size=self.batch_size)
+
+        meta_result = []
+        for start, answer in zip(range(0, len(dialogs), pack_size), packed_results):
+            meta_result += parse_packed_answer(answer, min(pack_size, len(dialogs) - start), labels)
+
+        fallback_idx = [i for i, result in enumerate(meta_result) if result is None]
+        if len(fallback_idx) > 0:
+            logger.info("packed mode: {n} items could not be parsed, re-asking them one by one".format(n=len(fallback_idx)))
+            fallback_results = self.generator._send_request([dialogs[i] for i in fallback_idx], batch_size=self.batch_size,
+                                                            task=ANSWER_TASK, labels=labels)
+            for i, result in zip(fallback_idx, fallback_results):
+                meta_result[i] = result
+
+        single_tokens = self.generator.compute_total_tokens(dialogs)
+        packed_tokens = self.generator.compute_total_tokens(packed_dialogs)
+        if len(fallback_idx) > 0:
+            packed_tokens += self.generator.compute_total_tokens([dialogs[i] for i in fallback_idx])
+        logger.info("packed mode: {requests} requests instead of {single_requests}, {packed} prompt tokens instead of {single} ({saved:.1%} saved)".format(
+            requests=len(packed_dialogs) + len(fallback_idx), single_requests=len(dialogs),
+            packed=packed_tokens, single=single_tokens, saved=1 - packed_tokens / max(single_tokens, 1)))
+        return meta_result
+
+    def annotate_multi(self, data, questions, few_shot_strs=None, labels=["yes", "no"]):
+        """Answer all `questions` for each passage in one request.
+
+        Returns one list of answers per question. Answers that cannot be parsed are
+        re-asked with the single-question prompt (and that question's few-shot string).
+        """
+        few_shot_strs = few_shot_strs if few_shot_strs is not None else [""] * len(questions)
+        multi_dialogs = to_multi_dialogs(data, questions)
+        multi_results = self.generator._send_request(multi_dialogs, batch_size=self.batch_size)
+        parsed = [parse_packed_answer(answer, len(questions), labels) for answer in multi_results]
+        meta_results = [[row[q] for row in parsed] for q in range(len(questions))]
+
+        num_fallback = 0
+        fallback_tokens = 0
+        for question, few_shot_str, meta_result in zip(questions, few_shot_strs, meta_results):
+            fallback_idx = [i for i, result in enumerate(meta_result) if result is None]
+            if len(fallback_idx) == 0:
+                continue
+            dialogs = to_dialog(data.iloc[fallback_idx], question, few_shot_str=few_shot_str)
+            for i, result in zip(fallback_idx, self.generator._send_request(dialogs, batch_size=self.batch_size,
+                                                                            task=ANSWER_TASK, labels=labels)):
+                meta_result[i] = result
+            num_fallback += len(fallback_idx)
+            fallback_tokens += self.generator.compute_total_tokens(dialogs)
+
+        for question, meta_result in zip(questions, meta_results):
+            failed_rows = [i for i, x in enumerate(meta_result) if x is None]
+            if len(failed_rows) > 0:
+                # failed requests are not cached, so re-running only pays for these rows
+                logger.warning("no answer for {n} rows of '{question}', treated as 'no': {rows}".format(
+                    n=len(failed_rows), question=question.split("\n")[0], rows=failed_rows))
+                meta_result[:] = ["" if x is None else x for x in meta_result]
+
+        single_tokens = sum(self.generator.compute_total_tokens(to_dialog(data, question, few_shot_str=few_shot_str))
+            for question, few_shot_str in zip(questions, few_shot_strs))
+        multi_tokens = self.generator.compute_total_tokens(multi_dialogs) + fallback_tokens
+        logger.info("multi-keyword mode: {requests} requests instead of {single_requests}, {multi} prompt tokens instead of {single} ({saved:.1%} saved), {fallback} single-question fallbacks".format(
+            requests=len(multi_dialogs) + num_fallback, single_requests=len(data) * len(questions),
+            multi=multi_tokens, single=single_tokens, saved=1 - multi_tokens / max(single_tokens, 1), fallback=num_fallback))
+        return meta_results
+
+    def annotate_batch_multi(self, data, keyword_jobs):
+        """Fill the `{keyword}_prompt{id}` and `{keyword}_result` columns with multi-keyword requests."""
+        questions = [(keyword, index, prompt, few_shot_str)
+            for keyword, (prompts, few_shot_str) in keyword_jobs.items() for index, prompt in enumerate(prompts)]
+        meta_results = {}
+        for start in range(0, len(questions), self.multi_keyword_size):
+            chunk = questions[start : start + self.multi_keyword_size]
+            logger.info("processing questions: {questions}".format(questions=[prompt.split("\n")[0] for _, _, prompt, _ in chunk]))
+            # one request answers questions of several keywords, so usage is not split by keyword
+            with metering.stage("annotation", "+".join(dict.fromkeys(keyword for keyword, _, _, _ in chunk))):
+                chunk_results = self.annotate_multi(data, [prompt for _, _, prompt, _ in chunk],
+                    few_shot_strs=[few_shot_str for _, _, _, few_shot_str in chunk])
+            for (keyword, index, _, _), meta_result in zip(chunk, chunk_results):
+                meta_results[(keyword, index)] = meta_result
+
+        for keyword, (prompts, _) in keyword_jobs.items():
+            data["{}_result".format(keyword)] = 0.0
+            for index in range(len(prompts)):
+                meta_result = meta_results[(keyword, index)]
+                data["{keyword}_prompt{id}_meta".format(keyword=keyword, id=index)] = meta_result
+                data["{keyword}_prompt{id}".format(keyword=keyword, id=index)] = to_binary_result(meta_result)
+                data["{}_result".format(keyword)] += data["{keyword}_prompt{id}".format(keyword=keyword, id=index)]
+            data.to_csv(config["EXPERIMENT"]["SLICE_RESULT_PATH"], index=False)
+
     def synthesize_examples(self,
         prompt,
         selected_dialogs, 
@@ -213,26 +401,30 @@ class Slicer(object):
             selected_results = ['yes' if clusters[i] else 'no' for i in selected_idx]
         elif input_sampling_strategy == "usp":
             data = data.sample(n=num*4, random_state=42)
-            results, _, probs = self.annotate(data, prompt, return_probs=True)
+            with metering.stage("few_shot_sampling"):
+                results, _, probs = self.annotate(data, prompt, return_probs=True)
             selected_dialogs, selected_results = select_usp_examples(dialogs, results, probs, num)
         elif input_sampling_strategy == "active_learning":
             data = data.sample(n=num*4, random_state=42)
-            results, _, probs = self.annotate(data, prompt, return_probs=True)
+            with metering.stage("few_shot_sampling"):
+                results, _, probs = self.annotate(data, prompt, return_probs=True)
             selected_dialogs = select_boundary_examples(dialogs, probs, num)
         else:
             raise NotImplementedError("input_sampling_strategy = {input_sampling_strategy} is not implemented".format(input_sampling_strategy=input_sampling_strategy))
         
-        if output_label_source == "self":
-            selected_results = self.generator._send_request(selected_dialogs, temperature=0)
-        elif output_label_source == "teacher":
-            selected_results = self.teacher._send_request(selected_dialogs, temperature=0)
-        elif output_label_source == "human":
-            pass
-        else:
-            raise NotImplementedError("output_label_source = {output_label_source} is not implemented".format(output_label_source=output_label_source))
+        with metering.stage("few_shot_labeling"):
+            if output_label_source == "self":
+                selected_results = self.generator._send_request(selected_dialogs, temperature=0, task=ANSWER_TASK)
+            elif output_label_source == "teacher":
+                selected_results = self.teacher._send_request(selected_dialogs, temperature=0, task=ANSWER_TASK)
+            elif output_label_source == "human":
+                pass
+            else:
+                raise NotImplementedError("output_label_source = {output_label_source} is not implemented".format(output_label_source=output_label_source))
             
         if synthesize:
-            selected_dialogs, selected_results = self.synthesize_examples(prompt, selected_dialogs, selected_results, labels, num)
+            with metering.stage("few_shot_synthesis"):
+                selected_dialogs, selected_results = self.synthesize_examples(prompt, selected_dialogs, selected_results, labels, num)
         
         few_shot_str = to_few_shot_str(selected_dialogs, selected_results)
         
@@ -270,12 +462,40 @@ class Slicer(object):
                 clusters = data[keyword].astype(int).tolist()
 
             # select prompt
-            few_shot_str = self.generate_few_shot_example(data, prompt, num=num, 
-                input_sampling_strategy=input_sampling_strategy, output_label_source=output_label_source, 
-                synthesize=synthesize, clusters=clusters)
+            with metering.stage("few_shot", keyword):
+                few_shot_str = self.generate_few_shot_example(data, prompt, num=num, 
+                    input_sampling_strategy=input_sampling_strategy, output_label_source=output_label_source, 
+                    synthesize=synthesize, clusters=clusters)
             few_shot_str_df.at[0, keyword] = few_shot_str
             few_shot_str_df.to_csv(config["EXPERIMENT"]["FEW_SHOT_PATH"], index=False)
 
+    def run_offline_batch(self, data, keyword_jobs, multi_keyword=False):
+        """Send every annotation request of `keyword_jobs` over `data` through the Batch API.
+
+        Answers are merged into the response cache; progress is kept next to the slice
+        results so an interrupted run resumes polling instead of resubmitting.
+        """
+        jobs = [(prompt, few_shot_str) for prompts, few_shot_str in keyword_jobs.values() for prompt in prompts]
+        requests = []
+        if multi_keyword:
+            for start in range(0, len(jobs), self.multi_keyword_size):
+                questions = [prompt for prompt, _ in jobs[start : start + self.multi_keyword_size]]
+                requests += self.generator.batch_requests(to_multi_dialogs(data, questions))
+        else:
+            for prompt, few_shot_str in jobs:
+                if self.pack_size > 1 and few_shot_str == "":
+                    dialogs = to_packed_dialogs(data, prompt, self.pack_size, few_shot_str=few_shot_str)
+                else:
+                    dialogs = to_dialog(data, prompt, few_shot_str=few_shot_str)
+                requests += self.generator.batch_requests(dialogs)
+        work_dir = os.path.join(os.path.dirname(config["EXPERIMENT"]["SLICE_RESULT_PATH"]), "batch")
+        if self.batch_backend == "local":
+            backend = LocalBatchBackend(os.path.join(work_dir, "local_backend"))
+            runner = BatchRunner(backend, work_dir, poll_interval=0)
+        else:
+            runner = BatchRunner(OpenAIBatchBackend(), work_dir)
+        runner.run(requests)
+
     def annotate_batch(self, data, keywords, select_prompt=False, use_calibrate=False, add_few_shot=False, use_cache=False):
         """Annotate data in batch.
         
@@ -315,10 +535,9 @@ class Slicer(object):
         # partial results exist
         if use_cache and os.path.exists(config["EXPERIMENT"]["SLICE_RESULT_PATH"]):
             data = pd.read_csv(config["EXPERIMENT"]["SLICE_RESULT_PATH"])
-            
-        for keyword in keywords:
-            logger.info("processing keyword: {key}".format(key=keyword))
 
+        keyword_jobs = {}
+        for keyword in keywords:
             few_shot_str = ""
             if add_few_shot:
                 few_shot_str = few_shot_str_df.at[0, keyword]
@@ -332,12 +551,40 @@ class Slicer(object):
             # skip if exists
             if use_cache and "{keyword}_result".format(keyword=keyword) in data.columns:
                 continue
+            keyword_jobs[keyword] = (prompts, few_shot_str)
+
+        # multi-keyword requests carry no probabilities or per-keyword few-shot examples,
+        # so calibration and few-shot runs use the per-keyword path
+        multi_keyword = self.multi_keyword_size > 1 and not use_calibrate and not add_few_shot
+        if self.multi_keyword_size > 1 and not multi_keyword:
+            logger.info("multi-keyword mode is off: not supported with calibration or few-shot examples")
+
+        if self.execution == "batch":
+            if self.generator.backend_kind != "openai":
+                # local and dummy students answer in-process, there is no Batch API to prefetch from
+                logger.warning("batch execution is not supported for student model {model}, annotating online".format(
+                    model=self.generator.model_name))
+            elif use_calibrate:
+                # calibrated annotation scores labels with logprobs, keyed differently from the
+                # plain chat requests the Batch API would prefetch, so every row would be paid twice
+                logger.warning("batch execution is not supported with calibration, annotating online")
+            else:
+                self.run_offline_batch(data, keyword_jobs, multi_keyword=multi_keyword)
+
+        if multi_keyword:
+            self.annotate_batch_multi(data, keyword_jobs)
+            logger.info(data.info())
+            return
+
+        for keyword, (prompts, few_shot_str) in keyword_jobs.items():
+            logger.info("processing keyword: {key}".format(key=keyword))
 
             data["{}_result".format(keyword)] = 0.0
             for index, prompt in enumerate(prompts):
                 logger.info("processing prompt: {prompt}".format(prompt=prompt.split("\n")[0]))
                 
-                meta_result, binary_result, _ = self.annotate(data, prompt, return_probs=use_calibrate, use_calibrate=use_calibrate, few_shot_str=few_shot_str)
+                with metering.stage("annotation", keyword):
+                    meta_result, binary_result, _ = self.annotate(data, prompt, return_probs=use_calibrate, use_calibrate=use_calibrate, few_shot_str=few_shot_str)
 
                 data["{keyword}_prompt{id}_meta".format(keyword=keyword, id=index)] = meta_result
                 data["{keyword}_prompt{id}".format(keyword=keyword, id=index)] = binary_result
@@ -377,7 +624,12 @@ class InteractiveSlicer:
             'student-model': str,
             'teacher-model': str,
             'creator-model': str,
+            'deadline': float,
+            'hedge': bool,
         }
+
+        `deadline` bounds each call of the slicing function (seconds, None for no bound);
+        `hedge` re-sends a call that runs past the p95 of recent latencies.
         """
 
         self.prompt = ""
@@ -417,6 +669,8 @@ class InteractiveSlicer:
             'student-model': 'flan-t5-xxl',
             'teacher-model': 'gpt-4-turbo-preview',
             'creator-model': 'gpt-4-turbo-preview',
+            'deadline': 30,
+            'hedge': True,
         }
         default_config.update(func_config)
         return default_config
@@ -438,13 +692,26 @@ class InteractiveSlicer:
                     {"role": "user", "content": PROMPT.format(question=self.prompt, passage=example)}
                 ]
             ]
-            results = self.slicer.generator._send_request(dialogs)
+            try:
+                results = self.slicer.generator._send_request(dialogs,
+                    deadline=self.config["deadline"], hedge=self.config["hedge"], task=ANSWER_TASK)
+            except TimeoutError as e:
+                # one slow row must not abort the whole slice
+                logger.warning("no answer within the deadline, treated as not in the slice: {error}".format(error=e))
+                return False
+            if results[0] is None:
+                logger.warning("request failed, treated as not in the slice")
+                return False
             meta_result = [result for result in results]
             binary_result = [True if x.lower().find("yes") != -1 and x.lower().find("no") == -1 else False for x in meta_result]
             return binary_result[0]
         
         return generic_slicing_function 
 
+    def latency_stats(self):
+        """p50/p95/p99 latency (seconds) of recent slicing function calls."""
+        return self.slicer.generator.latency_stats()
+
 
 if __name__ == "__main__":
     args = parseArg()